@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+    Benchmark the parsing of Windows Security Event XML in agent.py
+    using synthetic events. Runs on Linux, winevt isn't needed:
+
+    $ PYTHONPATH=src/ python benchmarks/bench_parse_event_xml.py [count]
+"""
+
+from __future__ import print_function
+
+import sys
+import json
+import time
+import xml.etree.ElementTree as ET
+
+import agent
+
+EVENT_TEMPLATE = """<Event xmlns='http://schemas.microsoft.com/win/2004/08/events/event'>
+    <System>
+        <Provider Name='Microsoft-Windows-Security-Auditing' Guid='{54849625-5478-4994-A5BA-3E3B0328C30D}'/>
+        <EventID>%(event_id)d</EventID>
+        <Version>0</Version>
+        <Level>0</Level>
+        <Task>12548</Task>
+        <Opcode>0</Opcode>
+        <Keywords>0x8020000000000000</Keywords>
+        <TimeCreated SystemTime='2017-07-01T14:%(minute)02d:%(second)02d.774505000Z'/>
+        <EventRecordID>%(event_record_id)d</EventRecordID>
+        <Correlation ActivityID='{9675755E-F26F-0000-8275-75966FF2D201}'/>
+        <Execution ProcessID='708' ThreadID='748'/>
+        <Channel>Security</Channel>
+        <Computer>EC2AMAZ-BBN7IEM</Computer>
+        <Security/>
+    </System>
+    <EventData>
+        <Data Name='SubjectUserSid'>S-1-5-18</Data>
+        <Data Name='SubjectUserName'>SYSTEM</Data>
+        <Data Name='SubjectDomainName'>NT AUTHORITY</Data>
+        <Data Name='SubjectLogonId'>0x3e7</Data>
+        <Data Name='PrivilegeList'>SeAssignPrimaryTokenPrivilege
+\t\t\tSeTcbPrivilege\r\n\t\t\tSeSecurityPrivilege\r\n\t\t\tSeTakeOwnershipPrivilege</Data>
+    </EventData>
+</Event>"""
+
+
+def synthetic_events(count):
+    """
+        Returns a list of @count event XML strings!
+    """
+    return [EVENT_TEMPLATE % {
+        'event_id': 4624 + i % 64,
+        'event_record_id': 47822 + i,
+        'minute': (i // 60) % 60,
+        'second': i % 60,
+    } for i in range(count)]
+
+
+def reference_parse_event_xml(xml):
+    """
+        The original implementation of agent.parse_event_xml()
+        which evaluates a namespaced path for every property.
+    """
+    xmlns = {'_': 'http://schemas.microsoft.com/win/2004/08/events/event'}
+
+    event_log = {}
+    event_xml = ET.fromstring(xml)
+
+    for tag in ['EventID', 'Version', 'Level', 'Task', 'Opcode', 'EventRecordID']:
+        event_log[tag] = int(event_xml.find('_:System/_:%s' % tag, xmlns).text)
+
+    for tag in ['Keywords', 'Computer', 'Security']:
+        event_log[tag] = event_xml.find('_:System/_:%s' % tag, xmlns).text
+
+    event_log['TimeCreated'] = event_xml.find(
+        '_:System/_:TimeCreated', xmlns).attrib['SystemTime'][:-4]
+
+    try:
+        event_log['Correlation'] = event_xml.find(
+            '_:System/_:Correlation', xmlns).attrib['ActivityID']
+    except KeyError:
+        event_log['Correlation'] = None
+
+    event_log['ProcessID'] = int(event_xml.find('_:System/_:Execution', xmlns).attrib['ProcessID'])
+
+    event_data = {}
+    for data in event_xml.findall('_:EventData/_:Data', xmlns):
+        event_data[data.attrib['Name']] = data.text
+    if 'PrivilegeList' in event_data:
+        event_data['PrivilegeList'] = event_data['PrivilegeList'].replace(
+            '\t', '').replace('\r', '').split('\n')
+    event_log['EventData'] = json.dumps(event_data)
+
+    return event_log
+
+
+def _measure(name, function, xmls):
+    started_at = time.time()
+    events = function(xmls)
+    elapsed = time.time() - started_at
+
+    print('%-28s %8d events %8.3f s %10.0f events/s' % (
+        name, len(events), elapsed, len(events) / elapsed))
+    return events
+
+
+def main(argv=sys.argv): # pylint: disable=dangerous-default-value
+    count = 20000
+    if len(argv) == 2:
+        count = int(argv[1])
+
+    xmls = synthetic_events(count)
+
+    reference = _measure('reference per-path find()',
+                         lambda xmls: [reference_parse_event_xml(xml) for xml in xmls], xmls)
+    single = _measure('agent.parse_event_xml',
+                      lambda xmls: [agent.parse_event_xml(xml) for xml in xmls], xmls)
+    batch = _measure('agent.parse_event_xml_batch',
+                     lambda xmls: list(agent.parse_event_xml_batch(xmls)), xmls)
+
+    if not reference == single == batch:
+        print('ERROR: parsers returned different results!')
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+"""
+    End-to-end benchmark of the collector against a simulated fleet.
+
+    Every client is a paramiko SSH server listening on its own loopback
+    address, 127.0.x.y, in one or more child processes. The simulated
+    clients accept any password, keep uploaded agents in memory over SFTP
+    and answer the agent.py command line with generated responses after
+    a configurable latency. Windows clients generate new Security events
+    on every poll and honour --batch-size, --events-only and --format
+    like the real agent does.
+
+    The real server.run_once() polls the fleet and writes into sqlite.
+    Reported are hosts/second, p50/p99 per-host latency, i.e. the sum of
+    the connect, upload, exec and response phases recorded by the
+    collector itself, and DB rows/second. Runs on Linux without any
+    client systems:
+
+    $ PYTHONPATH=src/ python benchmarks/bench_ssh_fleet.py [hosts] [options]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import stat
+import time
+import random
+import socket
+import argparse
+import tempfile
+import contextlib
+import selectors
+import threading
+import multiprocessing
+from datetime import datetime, timedelta
+import xml.etree.ElementTree as ET
+
+import paramiko
+import sqlalchemy as sql
+
+import orm
+import agent
+import config
+import server
+
+from bench_parse_event_xml import synthetic_events
+
+# timings of the collector which add up to the latency of a host
+LATENCY_PHASES = ['connect', 'upload', 'exec', 'response']
+
+_FIRST_EVENT_CREATED = datetime(2017, 7, 1)
+
+CONFIG_TEMPLATE = """<config>
+    <smtp host="localhost" username="bench@localhost" password="bench"/>
+    <database layout="%(layout)s" flush_size="%(flush_size)d" rollup_interval="0"%(spool)s/>
+    <collector concurrency="%(concurrency)d" batch_size="%(batch_size)d"
+               compress="%(compress)s" self_metrics="yes"/>
+%(clients)s
+</config>"""
+
+CLIENT_TEMPLATE = """    <client ip="%(ip)s" port="%(port)d" username="bench" password="bench"
+            mail="bench@localhost" platform="%(platform)s"/>"""
+
+
+def fleet_addresses(count):
+    """
+        Returns @count distinct loopback addresses!
+    """
+    return ['127.0.%d.%d' % (i // 250, i % 250 + 1) for i in range(count)]
+
+
+class SimulatedHost(object):
+    """
+        State of one simulated client which outlives its SSH connections!
+    """
+    def __init__(self, ip, platform, latency, jitter, events): # pylint: disable=too-many-arguments
+        self.ip = ip
+        self.platform = platform
+        self.latency = latency
+        self.jitter = jitter
+        # new Windows events per poll
+        self.events = events
+        # remote path -> content uploaded over SFTP
+        self.files = {}
+        self.directories = set(['.'])
+        self.last_event_record_id = 0
+        self.lock = threading.Lock()
+
+    def respond(self, command, event_template):
+        """
+            Returns what agent.py would print for @command, or None
+            if the agent wasn't uploaded!
+        """
+        argv = command.split()[1:]
+        if argv[0] not in self.files:
+            return None
+
+        args = agent._parse_args(argv) # pylint: disable=protected-access
+        time.sleep(max(0, random.uniform(self.latency - self.jitter, self.latency + self.jitter)))
+
+        if self.platform == 'Linux':
+            metrics = {
+                'system': 'Linux',
+                'cpu': random.uniform(0, 100),
+                'memory': random.uniform(0, 100),
+                'uptime': random.randint(0, 10**7),
+            }
+            return agent.encode_response(metrics, args.format)
+
+        if args.events_only:
+            metrics = {'system': 'Windows'}
+        else:
+            metrics = {
+                'system': 'Windows',
+                'cpu': random.uniform(0, 100),
+                'memory': random.uniform(0, 100),
+                'uptime': random.randint(0, 10**7),
+            }
+            with self.lock:
+                self.last_event_record_id += self.events
+
+        with self.lock:
+            last_id = min(self.last_event_record_id,
+                          args.last_event_record_id + args.batch_size)
+
+        event_data = event_template['EventData']
+        if args.format == 'json':
+            event_data = event_template['EncodedEventData']
+
+        metrics['security_event_logs'] = []
+        for event_record_id in range(args.last_event_record_id + 1, last_id + 1):
+            event_log = dict(event_template['event'])
+            event_log['EventRecordID'] = event_record_id
+            event_log['EventData'] = event_data
+            event_log['TimeCreated'] = (
+                _FIRST_EVENT_CREATED + timedelta(seconds=event_record_id)
+            ).strftime('%Y-%m-%dT%H:%M:%S.%f')
+            metrics['security_event_logs'].append(event_log)
+
+        return agent.encode_response(metrics, args.format)
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+    """
+        A file which is kept in memory!
+    """
+    def __init__(self, host, path, flags=0):
+        paramiko.SFTPHandle.__init__(self, flags)
+        self.host = host
+        self.path = path
+        self.writing = bool(flags & (os.O_WRONLY | os.O_RDWR))
+        self.content = bytearray() if self.writing else bytearray(host.files[path])
+
+    def read(self, offset, length):
+        return bytes(self.content[offset:offset + length])
+
+    def write(self, offset, data):
+        self.content[offset:offset + len(data)] = data
+        return paramiko.SFTP_OK
+
+    def close(self):
+        if self.writing:
+            self.host.files[self.path] = bytes(self.content)
+        paramiko.SFTPHandle.close(self)
+
+
+class _SFTPServer(paramiko.SFTPServerInterface):
+    """
+        Just enough SFTP for server._ensure_agent()!
+    """
+    def __init__(self, ssh_server, *args, **kwargs):
+        paramiko.SFTPServerInterface.__init__(self, ssh_server, *args, **kwargs)
+        self.host = ssh_server.host
+
+    def stat(self, path):
+        attributes = paramiko.SFTPAttributes()
+        attributes.st_uid = os.getuid()
+        if path in ['.', server.AGENT_DIRECTORY] and path in self.host.directories:
+            attributes.st_mode = stat.S_IFDIR | 0o700
+            return attributes
+
+        if path not in self.host.files:
+            return paramiko.SFTP_NO_SUCH_FILE
+
+        attributes.st_size = len(self.host.files[path])
+        attributes.st_mode = stat.S_IFREG | 0o644
+        return attributes
+
+    lstat = stat
+
+    def mkdir(self, path, attr):
+        if path in self.host.directories:
+            return paramiko.SFTP_FAILURE
+        self.host.directories.add(path)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
+
+    def open(self, path, flags, attr):
+        if not flags & (os.O_WRONLY | os.O_RDWR) and path not in self.host.files:
+            return paramiko.SFTP_NO_SUCH_FILE
+
+        return _SFTPHandle(self.host, path, flags)
+
+
+class _SSHServer(paramiko.ServerInterface):
+    """
+        Accepts any password and answers agent.py invocations!
+    """
+    def __init__(self, host, event_template):
+        self.host = host
+        self.event_template = event_template
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self._exec, args=(channel, command.decode('utf8')))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _exec(self, channel, command):
+        try:
+            response = self.host.respond(command, self.event_template)
+            if response is None:
+                channel.sendall_stderr("python: can't open file '%s'\n" % command.split()[1])
+                channel.send_exit_status(2)
+            else:
+                channel.sendall((response + '\n').encode('utf8'))
+                channel.send_exit_status(0)
+        finally:
+            channel.close()
+
+
+def _event_template():
+    """
+        Returns a Windows Security event as parsed by the agent, with its
+        EventData both as JSON string and as object!
+    """
+    event = list(agent.parse_event_xml_batch(synthetic_events(1), encode_event_data=False))[0]
+    return {
+        'event': event,
+        'EventData': event['EventData'],
+        'EncodedEventData': list(agent.parse_event_xml_batch(synthetic_events(1)))[0]['EventData'],
+    }
+
+
+def serve_fleet(listeners, hosts, host_key):
+    """
+        Accept SSH connections on all @listeners until killed!
+
+        @listeners - list of listening sockets
+        @hosts - dict - local address -> SimulatedHost
+        @host_key - paramiko.PKey
+    """
+    event_template = _event_template()
+    selector = selectors.DefaultSelector()
+    for listener in listeners:
+        selector.register(listener, selectors.EVENT_READ)
+
+    while True:
+        for key, _ in selector.select():
+            connection, _ = key.fileobj.accept()
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _SFTPServer)
+            host = hosts[key.fileobj.getsockname()[0]]
+            transport.start_server(server=_SSHServer(host, event_template))
+
+
+def start_fleet(args):
+    """
+        Start the simulated clients in @args.processes child processes!
+
+        @return - (XML string of the <client> tags, list of processes)
+    """
+    host_key = paramiko.RSAKey.generate(2048)
+
+    clients = []
+    listeners = []
+    hosts = {}
+    for i, ip in enumerate(fleet_addresses(args.hosts)):
+        platform = 'Windows' if i < args.hosts * args.windows else 'Linux'
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((ip, 0))
+        listener.listen(128)
+
+        listeners.append(listener)
+        hosts[ip] = SimulatedHost(ip, platform, args.latency, args.jitter, args.events)
+        clients.append(CLIENT_TEMPLATE % {
+            'ip': ip,
+            'port': listener.getsockname()[1],
+            'platform': platform,
+        })
+
+    # sockets are inherited by the forked children
+    context = multiprocessing.get_context('fork')
+    processes = []
+    for i in range(args.processes):
+        process = context.Process(target=serve_fleet,
+                                  args=(listeners[i::args.processes], hosts, host_key))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+
+    for listener in listeners:
+        listener.close()
+
+    return '\n'.join(clients), processes
+
+
+def percentile(values, percent):
+    """
+        Returns the nearest-rank @percent percentile of @values!
+    """
+    values = sorted(values)
+    rank = max(0, int(round(percent / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def host_latencies(db):
+    """
+        Returns the latency of every poll of every host, in seconds,
+        from the timings which run_once() stored in the self_metric table!
+    """
+    table = orm.SelfMetric.__table__
+    query = orm.select(sql.func.sum(table.c.sum)).where(
+        table.c.name == 'collector_phase_seconds'
+    ).where(
+        table.c.phase.in_(LATENCY_PHASES)
+    ).group_by(table.c.collected_at, table.c.host)
+    return [row[0] for row in db.execute(query)]
+
+
+def stored_rows(db):
+    """
+        Returns the number of metric and event rows in the DB!
+    """
+    return sum(db.execute(orm.select(sql.func.count()).select_from(model.__table__)).scalar()
+               for model in [orm.CpuUsage, orm.MemUsage, orm.Uptime, orm.Sample,
+                             orm.WinEventLog])
+
+
+def main(argv=sys.argv): # pylint: disable=dangerous-default-value
+    parser = argparse.ArgumentParser(description='Benchmark the collector against a '
+                                     'simulated SSH fleet')
+    parser.add_argument('hosts', type=int, nargs='?', default=100,
+                        help='number of simulated clients')
+    parser.add_argument('--rounds', type=int, default=3, help='number of run_once() calls')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds each agent invocation takes')
+    parser.add_argument('--jitter', type=float, default=0.02,
+                        help='max random deviation from --latency')
+    parser.add_argument('--windows', type=float, default=0.25,
+                        help='fraction of Windows clients')
+    parser.add_argument('--events', type=int, default=500,
+                        help='new security events per Windows client and poll')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='<collector batch_size>')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='<collector concurrency>')
+    parser.add_argument('--compress', action='store_true', help='<collector compress="yes">')
+    parser.add_argument('--layout', choices=['legacy', 'wide'], default='legacy',
+                        help='<database layout>')
+    parser.add_argument('--flush-size', type=int, default=500, help='<database flush_size>')
+    parser.add_argument('--spool', metavar='DIR', help='<database spool>')
+    parser.add_argument('--processes', type=int, default=2,
+                        help='number of processes simulating the clients')
+    parser.add_argument('--db', help='path to the sqlite file, temporary by default')
+    args = parser.parse_args(argv[1:])
+
+    db_path = args.db
+    if db_path is None:
+        db_fd, db_path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(db_fd)
+        os.unlink(db_path)
+
+    clients_xml, processes = start_fleet(args)
+    try:
+        config_xml = ET.fromstring(CONFIG_TEMPLATE % {
+            'layout': args.layout,
+            'flush_size': args.flush_size,
+            'concurrency': args.concurrency,
+            'batch_size': args.batch_size,
+            'compress': 'yes' if args.compress else 'no',
+            'spool': ' spool="%s"' % args.spool if args.spool else '',
+            'clients': clients_xml,
+        })
+        clients = config.parse_clients(config_xml)
+        smtp_cfg = config.parse_smtp(config_xml)
+        collector_cfg = config.parse_collector(config_xml)
+        storage_cfg = config.parse_storage(config_xml)
+
+        db = orm.connect('sqlite:///%s' % db_path)
+
+        elapsed = 0.0
+        for i in range(args.rounds):
+            # the connection messages of the collector would hide the results
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                started_at = time.time()
+                server.run_once(db, clients, smtp_cfg, collector_cfg, storage_cfg)
+                round_time = time.time() - started_at
+            elapsed += round_time
+            print('round %-3d %8d hosts %8.3f s %10.1f hosts/s' % (
+                i + 1, len(clients), round_time, len(clients) / round_time))
+    finally:
+        for process in processes:
+            process.terminate()
+
+    latencies = host_latencies(db)
+    rows = stored_rows(db)
+
+    print('%-28s %10.1f' % ('hosts/s', len(clients) * args.rounds / elapsed))
+    print('%-28s %10.1f ms' % ('p50 host latency', percentile(latencies, 50) * 1000))
+    print('%-28s %10.1f ms' % ('p99 host latency', percentile(latencies, 99) * 1000))
+    print('%-28s %10.0f (%d rows)' % ('DB rows/s', rows / elapsed, rows))
+
+    if args.db is None:
+        os.unlink(db_path)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,8 +2,14 @@
 
 from __future__ import print_function
 
+import os
 import sys
 import json
+import time
+import zlib
+import heapq
+import base64
+import argparse
 import platform
 from datetime import datetime
 import xml.etree.ElementTree as ET
@@ -11,66 +17,192 @@ import xml.etree.ElementTree as ET
 import psutil # pylint: disable=import-error
 
 
-def basic_metrics():
+# first line of compressed responses, must match wire.HEADER on the server
+WIRE_HEADER = 'MC1 zlib'
+
+# where the previous CPU times are kept between runs in non-blocking mode,
+# next to the agent in its private directory instead of the shared /tmp
+CPU_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'cpu-times.json')
+
+
+def basic_metrics(cpu=None):
     """
         Retuns a dict with basic metrics like
         CPU and memory usage!
+
+        @cpu - float - CPU usage computed by the caller. If None
+               CPU usage is measured over the next 0.5 seconds.
     """
     # this is a timedelta object
     uptime = datetime.now() - datetime.fromtimestamp(psutil.boot_time())
 
+    if cpu is None:
+        cpu = psutil.cpu_percent(interval=0.5)
+
     return {
         'system': platform.system(),                    # Windows, Linux, etc
-        'cpu': psutil.cpu_percent(interval=0.5),        # a percent
+        'cpu': cpu,                                     # a percent
         'memory': psutil.virtual_memory().percent,      # a percent
         'uptime': uptime.days*24*3600 + uptime.seconds, # in seconds
     }
 
 
-def parse_event_xml(xml):
+def cpu_snapshot():
     """
-        Parse the event XML and return it as dict!
+        Returns the cumulative (busy, total) CPU times in seconds!
+    """
+    times = psutil.cpu_times()
+    # on Linux guest times are part of user and nice already, like psutil.cpu_percent()
+    total = sum(times) - getattr(times, 'guest', 0) - getattr(times, 'guest_nice', 0)
+    idle = times.idle + getattr(times, 'iowait', 0)
+    return (total - idle, total)
 
-        @xml - string
-        @return - dict
+
+def cpu_percent_between(before, after):
     """
-    xmlns = {'_': 'http://schemas.microsoft.com/win/2004/08/events/event'}
+        Returns the CPU usage in percent between two cpu_snapshot()s
+        or None if it can't be computed, e.g. b/c the system was rebooted
+        and the counters started from zero again!
+    """
+    busy = after[0] - before[0]
+    total = after[1] - before[1]
+    if total <= 0 or busy < 0:
+        return None
+
+    return round(min(100.0, 100.0 * busy / total), 1)
 
-    event_log = {}
-    event_xml = ET.fromstring(xml)
 
-    # integer properties
-    for tag in ['EventID', 'Version', 'Level', 'Task', 'Opcode', 'EventRecordID']:
-        event_log[tag] = int(event_xml.find('_:System/_:%s' % tag, xmlns).text)
+def nonblocking_cpu_percent(path=CPU_BASELINE_PATH):
+    """
+        Returns the CPU usage in percent since the previous call,
+        which may have been made by a previous run of the agent,
+        without sleeping. Returns None on the very first call!
 
-    # string properties
-    for tag in ['Keywords', 'Computer', 'Security']:
-        event_log[tag] = event_xml.find('_:System/_:%s' % tag, xmlns).text
+        @path - string - file holding the previous cpu_snapshot()
+    """
+    snapshot = cpu_snapshot()
 
-    # other properties
-    event_log['TimeCreated'] = event_xml.find(
-        '_:System/_:TimeCreated', xmlns).attrib['SystemTime'][:-4]
+    try:
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)
+    except (IOError, ValueError):
+        baseline = None
 
     try:
-        event_log['Correlation'] = event_xml.find(
-            '_:System/_:Correlation', xmlns).attrib['ActivityID']
-    except KeyError:
-        event_log['Correlation'] = None
+        with open(path, 'w') as baseline_file:
+            json.dump(snapshot, baseline_file)
+    except IOError:
+        pass
+
+    if baseline is None:
+        return None
+
+    return cpu_percent_between(baseline, snapshot)
+
+
+def _sample_cpu(duration, samples):
+    """
+        Sleep for @duration seconds while measuring the CPU usage
+        @samples times at regular intervals!
+
+        @return - list of CPU usage percentages
+    """
+    results = []
+    before = cpu_snapshot()
+    for _ in range(samples):
+        time.sleep(max(0, duration) / samples)
+
+        after = cpu_snapshot()
+        cpu = cpu_percent_between(before, after)
+        if cpu is not None:
+            results.append(cpu)
+        before = after
+
+    return results
+
+
+# qualified tag names of the event XML, computed once instead of
+# formatting and evaluating a namespaced path for every property
+_EVENT_NS = '{http://schemas.microsoft.com/win/2004/08/events/event}'
+_SYSTEM_TAG = _EVENT_NS + 'System'
+_EVENT_DATA_TAG = _EVENT_NS + 'EventData'
+_DATA_TAG = _EVENT_NS + 'Data'
+_TIME_CREATED_TAG = _EVENT_NS + 'TimeCreated'
+_CORRELATION_TAG = _EVENT_NS + 'Correlation'
+_EXECUTION_TAG = _EVENT_NS + 'Execution'
+
+# integer properties
+_INT_TAGS = dict((_EVENT_NS + tag, tag) for tag in [
+    'EventID', 'Version', 'Level', 'Task', 'Opcode', 'EventRecordID'])
+
+# string properties
+_STR_TAGS = dict((_EVENT_NS + tag, tag) for tag in ['Keywords', 'Computer', 'Security'])
+
+
+def _parse_event_element(event_xml, encode_event_data=True):
+    """
+        Convert the <Event> element to dict making a single
+        pass over the children of <System>!
 
-    event_log['ProcessID'] = int(event_xml.find('_:System/_:Execution', xmlns).attrib['ProcessID'])
+        @encode_event_data - bool - return EventData as JSON string or dict
+    """
+    event_log = {'Correlation': None}
+
+    for child in event_xml.find(_SYSTEM_TAG):
+        tag = child.tag
+        if tag in _INT_TAGS:
+            event_log[_INT_TAGS[tag]] = int(child.text)
+        elif tag in _STR_TAGS:
+            event_log[_STR_TAGS[tag]] = child.text
+        elif tag == _TIME_CREATED_TAG:
+            event_log['TimeCreated'] = child.attrib['SystemTime'][:-4]
+        elif tag == _CORRELATION_TAG:
+            event_log['Correlation'] = child.attrib.get('ActivityID')
+        elif tag == _EXECUTION_TAG:
+            event_log['ProcessID'] = int(child.attrib['ProcessID'])
 
     # event log data in JSON format
     event_data = {}
-    for data in event_xml.findall('_:EventData/_:Data', xmlns):
-        event_data[data.attrib['Name']] = data.text
+    event_data_xml = event_xml.find(_EVENT_DATA_TAG)
+    if event_data_xml is not None:
+        for data in event_data_xml:
+            if data.tag == _DATA_TAG:
+                event_data[data.attrib['Name']] = data.text
     if 'PrivilegeList' in event_data:
         event_data['PrivilegeList'] = event_data['PrivilegeList'].replace(
             '\t', '').replace('\r', '').split('\n')
-    event_log['EventData'] = json.dumps(event_data)
+    if encode_event_data:
+        event_data = json.dumps(event_data)
+    event_log['EventData'] = event_data
 
     return event_log
 
 
+def parse_event_xml(xml):
+    """
+        Parse the event XML and return it as dict!
+
+        @xml - string
+        @return - dict
+    """
+    return _parse_event_element(ET.fromstring(xml))
+
+
+def parse_event_xml_batch(xmls, encode_event_data=True):
+    """
+        Parse many event XMLs, this is the hot loop of the agent
+        on busy Windows systems!
+
+        @xmls - iterable of strings
+        @encode_event_data - bool - return EventData as JSON string or dict
+        @return - generator of dicts, same as parse_event_xml()
+    """
+    fromstring = ET.fromstring
+    for xml in xmls:
+        yield _parse_event_element(fromstring(xml), encode_event_data)
+
+
 def trim_down_events(events, batch_size):
     """
         Trim down the events dictionary to the specified
@@ -91,45 +223,240 @@ def trim_down_events(events, batch_size):
     return results
 
 
-def windows_event_logs(last_event_record_id, batch_size=1000):
+def _event_record_id(xml):
+    """
+        Returns the EventRecordID of the event XML without parsing it
+        or None if it can't be found this way!
+    """
+    start = xml.find('<EventRecordID>')
+    if start == -1:
+        return None
+
+    start += len('<EventRecordID>')
+    try:
+        return int(xml[start:xml.find('<', start)])
+    except ValueError:
+        return None
+
+
+def select_lowest_events(xmls, batch_size, ordered=False, encode_event_data=True):
+    """
+        Returns the parsed events with the @batch_size lowest
+        EventRecordIDs, sorted by EventRecordID!
+
+        Only @batch_size unparsed events are kept in memory, in a heap,
+        no matter how many events are pending, and only the selected
+        ones are parsed.
+
+        @xmls - iterable of event XML strings
+        @batch_size - int - how many events to return
+        @ordered - bool - @xmls are known to be sorted by EventRecordID
+                   so stop reading them once the batch is complete
+        @encode_event_data - bool - return EventData as JSON string or dict
+        @return - list of dicts
+    """
+    if batch_size < 1:
+        return []
+
+    # max-heap of (-EventRecordID, xml) holding the lowest IDs seen so far
+    heap = []
+    selected = set()
+    for xml in xmls:
+        _id = _event_record_id(xml)
+        if _id is None:
+            _id = parse_event_xml(xml)['EventRecordID']
+
+        if _id in selected:
+            continue
+
+        if len(heap) < batch_size:
+            heapq.heappush(heap, (-_id, xml))
+            selected.add(_id)
+        elif _id < -heap[0][0]:
+            removed, _ = heapq.heapreplace(heap, (-_id, xml))
+            selected.discard(-removed)
+            selected.add(_id)
+        elif ordered:
+            break
+
+    heap.sort(reverse=True)
+    return list(parse_event_xml_batch((xml for _, xml in heap), encode_event_data))
+
+
+def windows_event_logs(last_event_record_id, batch_size=1000, ordered=False,
+                       encode_event_data=True):
     """
         Queries Windows Security Event logs and
         returns a list of events represented as
         dictionaries!
+
+        @ordered - bool - trust Windows to return the events sorted
+                   by EventRecordID and stop reading after @batch_size
+        @encode_event_data - bool - return EventData as JSON string or dict
     """
     from winevt import EventLog # pylint: disable=import-error
 
-    events = {}
-    for event in EventLog.Query(
-            'Security',
-            "Event/System[EventRecordID>%d]" % last_event_record_id):
-        event_log = parse_event_xml(event.xml)
-        events[event_log['EventRecordID']] = event_log
-        # NOTE: I don't know if Windows will return the events in a sorted order
-        # or not, that's why I've implemented my own sort & trim function!
-        # If it turns out Windows always guarantees the order we can use
-        # a simple counter and break out of the loop once we reach the treshold!
+    query = EventLog.Query('Security', "Event/System[EventRecordID>%d]" % last_event_record_id)
 
-    return trim_down_events(events, batch_size)
+    # NOTE: I don't know if Windows will return the events in a sorted order
+    # or not, that's why by default all of them are read and only the lowest
+    # @batch_size are kept! If Windows guarantees the order use @ordered.
+    return select_lowest_events((event.xml for event in query), batch_size, ordered,
+                                encode_event_data)
 
 
-def main(argv=sys.argv): # pylint: disable=dangerous-default-value
+def collect(last_event_record_id, cpu=None, **event_options):
     """
-        Collect all metrics and return them as
-        a JSON dump.
+        Collect all metrics, including the Windows Security Event logs
+        newer than @last_event_record_id, and return them as a dict!
+
+        @cpu - float - CPU usage if already known, see basic_metrics()
+        @event_options - passed to windows_event_logs()
     """
-    metrics = basic_metrics()
+    metrics = basic_metrics(cpu)
 
     # collect Windows Security Event logs
     if metrics['system'] == 'Windows':
-        last_event_record_id = 0
-        if len(argv) == 2:
-            last_event_record_id = int(argv[1])
+        metrics['security_event_logs'] = windows_event_logs(last_event_record_id,
+                                                            **event_options)
+
+    return metrics
+
+
+def stream(interval, last_event_record_id, out=sys.stdout, count=None, cpu_samples=1, # pylint: disable=too-many-arguments
+           **event_options):
+    """
+        Keep running and write one JSON document per line
+        every @interval seconds until the reader goes away! Each sample
+        carries the time it was measured at as collected_at, in seconds
+        since the epoch, b/c the server may read it much later.
+
+        CPU usage is computed from the CPU times at the previous sample
+        so the agent doesn't have to sleep to measure it. With @cpu_samples
+        greater than 1 the usage is also measured that many times during each
+        interval and reported as cpu_min and cpu_max.
+
+        @interval - float - seconds between samples
+        @last_event_record_id - int - EventRecordID for filtering
+        @out - file object to write the samples to
+        @count - int - stop after that many samples, None means never
+        @cpu_samples - int - CPU measurements per interval
+        @event_options - passed to windows_event_logs()
+    """
+    baseline = None
+    sub_samples = []
+    while count is None or count > 0:
+        started_at = time.time()
+
+        snapshot = cpu_snapshot()
+        cpu = None
+        if baseline is not None:
+            cpu = cpu_percent_between(baseline, snapshot)
+        baseline = snapshot
+
+        metrics = collect(last_event_record_id, cpu, **event_options)
+        metrics['collected_at'] = started_at
+        if len(sub_samples) > 1:
+            metrics['cpu_min'] = min(sub_samples)
+            metrics['cpu_max'] = max(sub_samples)
+
+        for event_log in metrics.get('security_event_logs', []):
+            last_event_record_id = max(last_event_record_id, event_log['EventRecordID'])
+
+        try:
+            out.write(json.dumps(metrics) + '\n')
+            out.flush()
+        except IOError:
+            # the server closed the channel
+            return
+
+        if count is not None:
+            count -= 1
+            if count == 0:
+                return
+
+        sub_samples = _sample_cpu(interval - (time.time() - started_at), cpu_samples)
+
+
+def encode_response(metrics, response_format='json'):
+    """
+        Encode the collected metrics for the server!
+
+        'json' is a plain JSON dump. 'zjson' is a version header line
+        followed by the zlib compressed JSON dump encoded as base64, so that
+        it survives the text mode stdout on Windows. In 'zjson' EventData
+        is sent as a JSON object instead of a JSON encoded string.
+
+        @metrics - dict
+        @response_format - string - 'json' or 'zjson'
+        @return - string
+    """
+    if response_format == 'json':
+        return json.dumps(metrics)
+
+    payload = zlib.compress(json.dumps(metrics, separators=(',', ':')).encode('utf8'))
+    return WIRE_HEADER + '\n' + base64.b64encode(payload).decode('ascii')
+
+
+def _parse_args(argv):
+    """
+        Parse the command line arguments passed by the server!
+    """
+    parser = argparse.ArgumentParser(prog=argv[0] or 'agent.py')
+    parser.add_argument('last_event_record_id', type=int, nargs='?', default=0)
+    parser.add_argument('--stream', type=float, metavar='INTERVAL', default=None,
+                        help='keep running and write a sample every INTERVAL seconds')
+    parser.add_argument('--nonblocking', action='store_true',
+                        help='compute CPU usage since the previous run instead of sleeping')
+    parser.add_argument('--cpu-samples', type=int, default=1, metavar='N',
+                        help='in streaming mode measure CPU usage N times per interval')
+    parser.add_argument('--ordered-events', action='store_true',
+                        help='Windows returns security events sorted by EventRecordID')
+    parser.add_argument('--batch-size', type=int, default=1000, metavar='N',
+                        help='return at most N security events')
+    parser.add_argument('--events-only', action='store_true',
+                        help="return only security events, don't collect basic metrics")
+    parser.add_argument('--format', choices=['json', 'zjson'], default='json',
+                        help='response format, zjson is compressed JSON, see encode_response()')
+    return parser.parse_args([str(arg) for arg in argv[1:]])
+
+
+def main(argv=sys.argv): # pylint: disable=dangerous-default-value
+    """
+        Collect all metrics and return them as
+        a JSON dump. In streaming mode samples are written
+        to stdout as they are collected and None is returned.
+    """
+    args = _parse_args(argv)
+    event_options = {
+        'batch_size': args.batch_size,
+        'ordered': args.ordered_events,
+    }
+
+    if args.stream is not None:
+        stream(args.stream, args.last_event_record_id, cpu_samples=args.cpu_samples,
+               **event_options)
+        return None
+
+    # compressed responses carry EventData as JSON object
+    event_options['encode_event_data'] = args.format == 'json'
+
+    # a continuation request for the next batch of events
+    if args.events_only:
+        metrics = {'system': platform.system()}
+        if metrics['system'] == 'Windows':
+            metrics['security_event_logs'] = windows_event_logs(args.last_event_record_id,
+                                                                **event_options)
+        return encode_response(metrics, args.format)
 
-        metrics['security_event_logs'] = windows_event_logs(last_event_record_id)
+    cpu = None
+    if args.nonblocking:
+        cpu = nonblocking_cpu_percent()
 
-    return json.dumps(metrics)
+    return encode_response(collect(args.last_event_record_id, cpu, **event_options), args.format)
 
 
 if __name__ == '__main__':
-    print(main())
+    RESPONSE = main()
+    if RESPONSE is not None:
+        print(RESPONSE)
@@ -0,0 +1,51 @@
+import json
+
+
+class AgentStream(object):
+    """
+        Reads the newline delimited JSON samples written by
+        `agent.py --stream` from a paramiko.Channel without blocking!
+    """
+    def __init__(self, channel, name):
+        """
+            @channel - paramiko.Channel on which the agent was started
+            @name - string - used in error messages, usually the client IP
+        """
+        self.channel = channel
+        self.name = name
+        self._buffer = b''
+
+    def read_samples(self):
+        """
+            Returns the list of samples received since the last call.
+            Incomplete lines are kept until the rest of them arrives.
+
+            Raises RuntimeError if the agent wrote something on stderr
+            and EOFError if the agent has exited!
+        """
+        if self.channel.recv_stderr_ready():
+            errors = self.channel.recv_stderr(65536).strip().decode('utf8')
+            raise RuntimeError('Execution on %s failed with:\n%s' % (self.name, errors))
+
+        while self.channel.recv_ready():
+            data = self.channel.recv(65536)
+            if not data:
+                break
+            self._buffer += data
+
+        lines = self._buffer.split(b'\n')
+        self._buffer = lines.pop()
+
+        samples = [json.loads(line.decode('utf8')) for line in lines if line.strip()]
+
+        exited = self.channel.closed or self.channel.exit_status_ready()
+        if not samples and exited and not self.channel.recv_ready():
+            raise EOFError('Agent stream on %s has exited' % self.name)
+
+        return samples
+
+    def close(self):
+        """
+            Stop the agent by closing its channel!
+        """
+        self.channel.close()
@@ -0,0 +1,183 @@
+import time
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class _Series(object):
+    """
+        Rolling state of one metric of one client. Keeps only the last
+        @size values and their sum so the average is computed in O(1)!
+    """
+    def __init__(self, size):
+        self.values = collections.deque(maxlen=size)
+        self.total = 0.0
+
+        # when the average went over the limit, None while below it
+        self.breached_since = None
+        self.firing = False
+        self.notified_at = None
+
+    def add(self, value):
+        if len(self.values) == self.values.maxlen:
+            self.total -= self.values[0]
+        self.values.append(value)
+        self.total += value
+
+    def average(self):
+        """
+            Returns the average of the window or None until it is full!
+        """
+        if len(self.values) < self.values.maxlen:
+            return None
+        return self.total / len(self.values)
+
+
+class AlertEngine(object):
+    """
+        Decides when to notify about the alert rules of each client.
+
+        A rule fires when the average of its metric over the last
+        `samples` values has been greater than `limit` for at least
+        `for` seconds. It is notified once and then again every `repeat`
+        seconds while it keeps firing, never if `repeat` is 0. It is
+        resolved when the average drops to `resolve` or below, which can
+        be lower than `limit` to avoid flapping around the threshold.
+
+        Rules are taken from client['alert_rules'], see config.parse_clients().
+    """
+    def __init__(self):
+        self._series = {}
+
+    def _get_series(self, client, _type, rule):
+        key = (client['ip'], _type)
+        series = self._series.get(key)
+        if series is None or series.values.maxlen != rule['samples']:
+            series = _Series(rule['samples'])
+            self._series[key] = series
+        return series
+
+    def evaluate(self, client, metrics, now=None):
+        """
+            Update the state of @client with one sample and return
+            the alerts which need to be notified!
+
+            @client - dict - client configuration
+            @metrics - dict - as returned by the agent
+            @now - float - when the sample was collected, time.time() by default
+            @return - list of (type, average value) tuples
+        """
+        if now is None:
+            now = time.time()
+
+        notify = []
+        for _type, rule in client['alert_rules'].items():
+            value = metrics.get(_type)
+            if value is None:
+                continue
+
+            series = self._get_series(client, _type, rule)
+            series.add(value)
+            average = series.average()
+            if average is None:
+                continue
+
+            if series.firing:
+                if average <= rule['resolve']:
+                    series.firing = False
+                    series.breached_since = None
+                elif rule['repeat'] and now - series.notified_at >= rule['repeat']:
+                    series.notified_at = now
+                    notify.append((_type, average))
+            elif average > rule['limit']:
+                if series.breached_since is None:
+                    series.breached_since = now
+
+                if now - series.breached_since >= rule['for']:
+                    series.firing = True
+                    series.notified_at = now
+                    notify.append((_type, average))
+            else:
+                series.breached_since = None
+
+        return notify
+
+    def forget(self, client):
+        """
+            Drop the state of @client, e.g. when it is removed!
+        """
+        for key in [key for key in self._series if key[0] == client['ip']]:
+            del self._series[key]
+
+
+class FleetEvaluator(object):
+    """
+        Checks the plain `limit` of every alert of every client for a
+        whole batch of samples at once.
+
+        The limits are compiled once into a clients x metrics matrix, with
+        infinity where a client has no alert. With NumPy installed a batch
+        is compared against it in a single vectorized operation, otherwise
+        the same matrix is walked in pure Python.
+    """
+    def __init__(self, clients):
+        """
+            @clients - list - as returned by config.parse_clients()
+        """
+        self.types = sorted(set(_type for client in clients for _type in client['alerts']))
+        self._rows = {}
+
+        limits = []
+        for client in clients:
+            self._rows[client['ip']] = len(limits)
+            limits.append([client['alerts'].get(_type, float('inf')) for _type in self.types])
+
+        # fixed here so that limits and values are always of the same kind
+        self._numpy = numpy
+        if self._numpy is not None:
+            limits = self._numpy.array(limits, dtype=float).reshape(len(limits), len(self.types))
+        self._limits = limits
+
+    def _values(self, samples):
+        """
+            Returns a samples x metrics matrix, NaN where a metric is missing!
+        """
+        nan = float('nan')
+        values = []
+        for _, metrics in samples:
+            row = []
+            for _type in self.types:
+                value = metrics.get(_type)
+                row.append(nan if value is None else value)
+            values.append(row)
+        return values
+
+    def evaluate(self, samples):
+        """
+            Returns the alerts violated by @samples!
+
+            @samples - list of (client, metrics) tuples
+            @return - list of (client, metrics, type) tuples
+        """
+        samples = [sample for sample in samples if sample[0]['ip'] in self._rows]
+        if not samples or not self.types:
+            return []
+
+        rows = [self._rows[client['ip']] for client, _ in samples]
+        values = self._values(samples)
+
+        if self._numpy is not None:
+            values = self._numpy.array(values, dtype=float)
+            # NaN > limit is False so missing metrics never alert
+            over = self._numpy.argwhere(values > self._limits[rows])
+            return [(samples[i][0], samples[i][1], self.types[j]) for i, j in over]
+
+        violations = []
+        for i, (row, sample_values) in enumerate(zip(rows, values)):
+            for j, (value, limit) in enumerate(zip(sample_values, self._limits[row])):
+                if value > limit:
+                    violations.append((samples[i][0], samples[i][1], self.types[j]))
+        return violations
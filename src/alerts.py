@@ -1,29 +1,71 @@
+from __future__ import print_function
+
+import sys
+import time
+import queue
 import smtplib
+import threading
 from email.message import EmailMessage
 
-def _send_email(cfg, to, subject, body):
+import instrument
+
+def _message(cfg, to, subject, body):
     """
-        Sends an email using specified SMTP configuration
+        Returns an EmailMessage from the configured sender!
     """
     msg = EmailMessage()
     msg['From'] = cfg['from']
     msg['To'] = to
     msg['Subject'] = subject
     msg.set_content(body)
+    return msg
+
+
+def _connect(cfg):
+    """
+        Returns an authenticated smtplib.SMTP session!
+    """
+    smtp = smtplib.SMTP(cfg['host'], cfg['port'])
+    try:
+        if cfg['starttls']:
+            smtp.starttls()
+
+        smtp.login(cfg['username'], cfg['password'])
+    except Exception:
+        smtp.close()
+        raise
+
+    return smtp
+
+
+def _send_email(cfg, to, subject, body):
+    """
+        Sends an email using specified SMTP configuration
+    """
+    msg = _message(cfg, to, subject, body)
 
     # this can raise a variety of exceptions
     # for the moment we leave it escape to the caller
     # b/c we can't test it via unit tests without
     # heavy mocking. If there is a problem it will be seen
     # during execution
-    with smtplib.SMTP(cfg['host'], cfg['port']) as smtp:
-        if cfg['starttls']:
-            smtp.starttls()
-
-        smtp.login(cfg['username'], cfg['password'])
+    with _connect(cfg) as smtp:
         smtp.send_message(msg)
 
 
+def _alert_email(client, metrics, _type):
+    """
+        Returns the recipient, subject and body of the alert
+        for the metric of type @_type!
+    """
+    subject = 'Monitoring warning for %s: %s too high' % (client['ip'], _type)
+    body = """%s usage of %s is greater than configured limit of %s!
+
+Check-out what's going on with the system or increase the
+limits!""" % (_type, metrics[_type], client['alerts'][_type])
+
+    return client['mail'], subject, body.strip()
+
 
 def _send_alert(smtp_cfg, client, metrics, _type):
     """
@@ -35,20 +77,220 @@ def _send_alert(smtp_cfg, client, metrics, _type):
         @metrics - dict - all client metrics
         @_type - string - the metric type which triggered the alert
     """
-    to = client['mail']
-    subject = 'Monitoring warning for %s: %s too high' % (client['ip'], _type)
-    body = """%s usage of %s is greater than configured limit of %s!
+    _send_email(smtp_cfg, *_alert_email(client, metrics, _type))
 
-Check-out what's going on with the system or increase the
-limits!""" % (_type, metrics[_type], client['alerts'][_type])
 
-    _send_email(smtp_cfg, to, subject, body.strip())
+def check_for_alerts(smtp_cfg, client, metrics, dispatcher=None, engine=None):
+    """
+        Check for alerts and send emails if necessary! With an
+        AlertDispatcher the emails are sent in the background.
 
+        Without an alertengine.AlertEngine every sample over the limit
+        is notified, otherwise the engine decides when to notify and the
+        email reports the average which triggered the alert.
+    """
+    with instrument.REGISTRY.timed('alerts', client.get('ip', '')):
+        if engine is None:
+            violations = [(_type, metrics[_type]) for _type, _limit in client['alerts'].items()
+                          if metrics[_type] > _limit]
+        else:
+            violations = engine.evaluate(client, metrics)
+            if violations:
+                metrics = dict(metrics)
+                metrics.update(violations)
 
-def check_for_alerts(smtp_cfg, client, metrics):
+    for _type, _ in violations:
+        if dispatcher is None:
+            _send_alert(smtp_cfg, client, metrics, _type)
+        else:
+            dispatcher.submit(*_alert_email(client, metrics, _type))
+
+
+def notify(smtp_cfg, violations, dispatcher=None):
     """
-        Check for alerts and send emails if necessary!
+        Send emails for the @violations returned by
+        alertengine.FleetEvaluator.evaluate()!
     """
-    for _type, _limit in client['alerts'].items():
-        if metrics[_type] > _limit:
+    for client, metrics, _type in violations:
+        if dispatcher is None:
             _send_alert(smtp_cfg, client, metrics, _type)
+        else:
+            dispatcher.submit(*_alert_email(client, metrics, _type))
+
+
+# queue items which aren't alerts
+_FLUSH = object()
+_STOP = object()
+
+
+class _SmtpSession(object):
+    """
+        One authenticated SMTP session which is opened when the first
+        email is sent and closed after being idle for @idle_timeout seconds!
+    """
+    def __init__(self, smtp_cfg, idle_timeout):
+        self.smtp_cfg = smtp_cfg
+        self.idle_timeout = idle_timeout
+
+        self._smtp = None
+        self._used_at = time.time()
+
+    def send(self, msg):
+        with instrument.REGISTRY.timed('smtp', self.smtp_cfg['host']):
+            if self._smtp is None:
+                self._smtp = _connect(self.smtp_cfg)
+            self._smtp.send_message(msg)
+        self._used_at = time.time()
+
+    def close_if_idle(self):
+        if time.time() - self._used_at >= self.idle_timeout:
+            self.close()
+
+    def close(self):
+        """
+            Close the SMTP session, if any!
+        """
+        if self._smtp is None:
+            return
+
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self._smtp.close()
+        self._smtp = None
+
+
+class AlertDispatcher(object):
+    """
+        Sends alert emails from a background thread so that a slow or
+        unreachable SMTP server never stalls the collection of metrics.
+
+        All alerts for the same recipient which are submitted within
+        @cycle seconds, or until flush() is called, are sent as a single
+        digest email. One authenticated SMTP session is reused for all
+        emails and closed after being idle for @idle_timeout seconds.
+
+        At most @queue_size alerts are queued. When the queue is full new
+        alerts are dropped instead of blocking the caller. Failed emails
+        are retried @retries times, @retry_delay seconds apart.
+    """
+    def __init__(self, smtp_cfg, cycle=None, queue_size=1000, # pylint: disable=too-many-arguments
+                 retries=3, retry_delay=5, idle_timeout=60):
+        """
+            @smtp_cfg - dict - configuration of outgoing smtp
+            @cycle - float - seconds alerts are collected into a digest,
+                             None to wait for flush() or stop()
+        """
+        self.cycle = cycle
+        # seconds to wait before each retry
+        self.retry_delays = [retry_delay] * retries
+
+        self.dropped = 0
+        self.sent = 0
+
+        self._session = _SmtpSession(smtp_cfg, idle_timeout)
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+
+    def start(self):
+        """
+            Start the background thread!
+        """
+        self._thread = threading.Thread(target=self._run, name='alert-dispatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, to, subject, body):
+        """
+            Queue an alert without blocking!
+
+            @return - bool - False if the queue was full and the alert was dropped
+        """
+        try:
+            self._queue.put_nowait((to, subject, body))
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+        return True
+
+    def flush(self):
+        """
+            Send the collected digests without waiting for the cycle to end!
+        """
+        self._put(_FLUSH)
+
+    def stop(self, timeout=None):
+        """
+            Send the collected digests and stop the background thread!
+        """
+        self._put(_STOP)
+        self._thread.join(timeout)
+
+    def _put(self, item):
+        """
+            Queue a control @item. Unlike alerts they are never dropped!
+        """
+        while True:
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                if not self._thread.is_alive():
+                    return
+
+    def _run(self):
+        pending = {}
+        deliver_at = None
+
+        while True:
+            timeout = self._session.idle_timeout
+            if deliver_at is not None:
+                timeout = max(0, deliver_at - time.time())
+
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, tuple):
+                to, subject, body = item
+                pending.setdefault(to, []).append((subject, body))
+                if deliver_at is None and self.cycle is not None:
+                    deliver_at = time.time() + self.cycle
+                continue
+
+            if pending and (item is not None or deliver_at is not None):
+                for to, alerts in pending.items():
+                    self._deliver(to, alerts)
+                pending = {}
+                deliver_at = None
+            elif item is None:
+                self._session.close_if_idle()
+
+            if item is _STOP:
+                self._session.close()
+                return
+
+    def _deliver(self, to, alerts):
+        """
+            Send a digest of @alerts to @to, retrying on errors!
+        """
+        if len(alerts) == 1:
+            subject, body = alerts[0]
+        else:
+            subject = 'Monitoring warning: %d alerts' % len(alerts)
+            body = '\n\n'.join('%s\n\n%s' % alert for alert in alerts)
+
+        msg = _message(self._session.smtp_cfg, to, subject, body)
+        for retry_delay in self.retry_delays + [None]:
+            try:
+                self._session.send(msg)
+                self.sent += 1
+                return
+            except (smtplib.SMTPException, OSError) as err:
+                self._session.close()
+                if retry_delay is None:
+                    print('***** SENDING ALERTS TO %s FAILED: %s' % (to, err), file=sys.stderr)
+                    return
+                time.sleep(retry_delay)
@@ -2,6 +2,10 @@ import os
 import xml.etree.ElementTree as ET
 
 
+# tables which support <retention>, see retention.TABLES
+_RETENTION_TABLES = ['cpu_usage', 'mem_usage', 'uptime', 'sample', 'win_event_log']
+
+
 def parse_config(config_path):
     """
         Parse a XML config file
@@ -25,34 +29,168 @@ def parse_clients(config):
         @config - Element - the <config> element from the XML
         @return - list - list of dicts describing each client
     """
-    clients = []
-    for client_config in config.findall('client'):
+    return [_parse_client(client_config) for client_config in config.findall('client')]
+
+
+def _parse_client(client_config):
+    """
+        Returns the dict describing the client in @client_config!
+    """
+    try:
         client = {'port': int(client_config.attrib.get('port', 22))}
+    except ValueError:
+        raise RuntimeError('Invalid attribute port for %s' % ET.tostring(client_config))
 
-        for key in ['ip', 'username', 'password', 'mail', 'platform']:
-            try:
-                if not client_config.attrib[key]:
-                    raise RuntimeError('Empty attribute %s for %s' % (
-                        key, ET.tostring(client_config)))
+    # polling interval in seconds, if missing the <collector> default is used
+    client['interval'] = None
+    if 'interval' in client_config.attrib:
+        try:
+            client['interval'] = int(client_config.attrib['interval'])
+            if client['interval'] < 1:
+                raise ValueError()
+        except ValueError:
+            raise RuntimeError('Invalid attribute interval for %s' % (
+                ET.tostring(client_config)))
 
-                client[key] = client_config.attrib[key]
-            except KeyError:
-                raise RuntimeError('Missing attribute %s for %s' % (
+    for key in ['ip', 'username', 'password', 'mail', 'platform']:
+        try:
+            if not client_config.attrib[key]:
+                raise RuntimeError('Empty attribute %s for %s' % (
                     key, ET.tostring(client_config)))
 
-        client['alerts'] = {}
-        for alert in client_config.findall('alert'):
-            try:
-                _type = alert.attrib['type']
-                _limit = float(alert.attrib['limit'].replace('%', ''))
-            except KeyError:
-                raise RuntimeError('Invalid type or limit attributes for %s' % ET.tostring(alert))
+            client[key] = client_config.attrib[key]
+        except KeyError:
+            raise RuntimeError('Missing attribute %s for %s' % (
+                key, ET.tostring(client_config)))
+
+    client['alerts'] = {}
+    client['alert_rules'] = {}
+    for alert in client_config.findall('alert'):
+        try:
+            _type = alert.attrib['type']
+            _limit = float(alert.attrib['limit'].replace('%', ''))
+        except (KeyError, ValueError):
+            raise RuntimeError('Invalid type or limit attributes for %s' % ET.tostring(alert))
+
+        client['alerts'][_type] = _limit
+        client['alert_rules'][_type] = _parse_alert_rule(alert, _limit)
+
+    return client
+
+
+def load_config(config_path):
+    """
+        Parse a XML config file in a single streaming pass. Each <client>
+        is turned into a dict as soon as it has been read and its element
+        is discarded, so configs with many clients don't have to fit into
+        memory as a tree!
+
+        @config_path - string - the configuration filename
+        @return - (Element, list) - the XML config root node, without the
+                  <client> elements, and the list of client dicts
+    """
+    if not os.path.exists(config_path):
+        raise RuntimeError('File "%s" not found!' % config_path)
+
+    root = None
+    depth = 0
+    clients = []
+    try:
+        for event, element in ET.iterparse(config_path, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if root is None:
+                    root = element
+                continue
+
+            depth -= 1
+            if depth == 1 and element.tag == 'client':
+                clients.append(_parse_client(element))
+                root.remove(element)
+    except ET.ParseError:
+        raise RuntimeError('Invalid XML for "%s"' % config_path)
+
+    return root, clients
+
+
+class ConfigWatcher(object):
+    """
+        Tells when the config file has been changed, either in place
+        or replaced by another file, e.g. with an atomic rename!
+    """
+    def __init__(self, config_path):
+        self.config_path = config_path
+        self._stat = self._current()
+
+    def _current(self):
+        try:
+            stat = os.stat(self.config_path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def changed(self):
+        """
+            Returns True once after each change of the file!
+        """
+        current = self._current()
+        # a missing file is most likely being replaced
+        if current is None or current == self._stat:
+            return False
+
+        self._stat = current
+        return True
+
+
+def diff_clients(old, new, key):
+    """
+        Compare two lists of clients!
+
+        @key - function - returns the identity of a client, e.g. scheduler.client_key
+        @return - (added, removed, updated) - lists of clients, updated
+                  holds (old client, new client) tuples
+    """
+    old = dict((key(client), client) for client in old)
+    new = dict((key(client), client) for client in new)
+
+    added = [client for client_key, client in new.items() if client_key not in old]
+    removed = [client for client_key, client in old.items() if client_key not in new]
+    updated = [(old[client_key], client) for client_key, client in new.items()
+               if client_key in old and old[client_key] != client]
+
+    return added, removed, updated
+
+
+def _parse_alert_rule(alert, limit):
+    """
+        Returns the optional windowing attributes of an <alert>,
+        see alertengine.AlertEngine!
+    """
+    rule = {'limit': limit}
+    try:
+        # number of samples which are averaged
+        rule['samples'] = int(alert.attrib.get('samples', 1))
+        if rule['samples'] < 1:
+            raise ValueError('samples')
 
-            client['alerts'][_type] = _limit
+        # seconds the average must stay over the limit before notifying
+        rule['for'] = float(alert.attrib.get('for', 0))
+        if rule['for'] < 0:
+            raise ValueError('for')
 
-        clients.append(client)
+        # the alert is resolved when the average drops to this or below
+        rule['resolve'] = float(alert.attrib.get('resolve', str(limit)).replace('%', ''))
+        if rule['resolve'] > limit:
+            raise ValueError('resolve')
 
-    return clients
+        # seconds between repeated notifications, 0 notifies only once
+        rule['repeat'] = float(alert.attrib.get('repeat', 0))
+        if rule['repeat'] < 0:
+            raise ValueError('repeat')
+    except ValueError:
+        raise RuntimeError('Invalid alert attributes for %s' % ET.tostring(alert))
+
+    return rule
 
 
 def parse_db(config):
@@ -74,6 +212,71 @@ def parse_db(config):
 
 
 
+def parse_storage(config):
+    """
+        Returns the optional storage settings from the <database> tag!
+    """
+    database = config.find('database')
+    if database is None:
+        database = ET.Element('database')
+
+    defaults = {
+        'flush_size': 500,  # number of buffered samples which triggers a write
+        'flush_age': 10,    # max seconds a sample is buffered before it is written
+        'spool_segment_size': 16,   # MB per spool segment file
+        'spool_max_size': 1024,     # MB the spool may take on disk
+    }
+
+    storage_cfg = {}
+    for attrib, default in defaults.items():
+        try:
+            storage_cfg[attrib] = int(database.attrib.get(attrib, default))
+            if storage_cfg[attrib] < 1:
+                raise ValueError()
+        except ValueError:
+            raise RuntimeError('Invalid <database> attribute %s' % attrib)
+
+    # 'legacy' stores CPU, memory and uptime in separate tables,
+    # 'wide' stores all metrics of a sample in a single row
+    storage_cfg['layout'] = database.attrib.get('layout', 'legacy')
+    if storage_cfg['layout'] not in ['legacy', 'wide']:
+        raise RuntimeError('Invalid <database> attribute layout')
+
+    # create the optional indexes on metric values, see orm.VALUE_INDEXES
+    storage_cfg['value_indexes'] = database.attrib.get('value_indexes', 'no') == 'yes'
+
+    # seconds between rollup updates in daemon mode, 0 disables rollups
+    try:
+        storage_cfg['rollup_interval'] = int(database.attrib.get('rollup_interval', 60))
+        if storage_cfg['rollup_interval'] < 0:
+            raise ValueError()
+    except ValueError:
+        raise RuntimeError('Invalid <database> attribute rollup_interval')
+
+    # directory of the local spool which decouples collecting from the DB, see spool.py
+    storage_cfg['spool'] = database.attrib.get('spool') or None
+
+    storage_cfg['spool_fsync'] = database.attrib.get('spool_fsync', 'interval')
+    if storage_cfg['spool_fsync'] not in ['always', 'interval', 'never']:
+        raise RuntimeError('Invalid <database> attribute spool_fsync')
+
+    # number of days rows are kept in each table, forever if missing
+    storage_cfg['retention'] = {}
+    for retention in database.findall('retention'):
+        table = retention.attrib.get('table')
+        if table not in _RETENTION_TABLES:
+            raise RuntimeError('Invalid <retention> attribute table')
+
+        try:
+            storage_cfg['retention'][table] = int(retention.attrib.get('days', ''))
+            if storage_cfg['retention'][table] < 1:
+                raise ValueError()
+        except ValueError:
+            raise RuntimeError('Invalid <retention> attribute days for %s' % table)
+
+    return storage_cfg
+
+
 def parse_smtp(config):
     """
         Returns outgoing SMTP configuration dict from the XML configuration!
@@ -101,3 +304,75 @@ def parse_smtp(config):
     smtp_cfg['starttls'] = _smtp.attrib.get('starttls', 'no') == 'yes'
 
     return smtp_cfg
+
+
+def parse_collector(config):
+    """
+        Returns the collector configuration dict from the XML configuration!
+        The <collector> tag is optional and all of its attributes have defaults.
+    """
+    _collector = config.find('collector')
+    if _collector is None:
+        _collector = ET.Element('collector')
+
+    defaults = {
+        'concurrency': 1,
+        'keepalive': 30,    # seconds between SSH keepalive packets, 0 disables
+        'max_idle': 300,    # seconds before an unused SSH connection is closed
+        'interval': 60,     # seconds between polls in daemon mode
+        'jitter': 0,        # max random delay in seconds for the first poll
+        'cpu_samples': 1,   # CPU measurements per interval by streaming agents
+        'batch_size': 1000, # initial number of Windows events requested per round
+        'drain_time': 0,    # seconds a poll may spend draining the event backlog
+        'drain_events': 10000, # max number of Windows events collected per poll
+        'lease_time': 30,   # seconds before the clients of a dead worker move, see sharding.py
+    }
+
+    collector_cfg = {}
+    for attrib, default in defaults.items():
+        try:
+            collector_cfg[attrib] = int(_collector.attrib.get(attrib, default))
+        except ValueError:
+            raise RuntimeError('Invalid <collector> attribute %s' % attrib)
+
+    if collector_cfg['concurrency'] < 1:
+        raise RuntimeError('<collector> concurrency must be at least 1')
+
+    if collector_cfg['interval'] < 1:
+        raise RuntimeError('<collector> interval must be at least 1')
+
+    if collector_cfg['cpu_samples'] < 1:
+        raise RuntimeError('<collector> cpu_samples must be at least 1')
+
+    if collector_cfg['batch_size'] < 1:
+        raise RuntimeError('<collector> batch_size must be at least 1')
+
+    if collector_cfg['lease_time'] < 1:
+        raise RuntimeError('<collector> lease_time must be at least 1')
+
+    if collector_cfg['drain_events'] < 1:
+        raise RuntimeError('<collector> drain_events must be at least 1')
+
+    for attrib in ['keepalive', 'max_idle', 'jitter', 'drain_time']:
+        if collector_cfg[attrib] < 0:
+            raise RuntimeError('<collector> %s must not be negative' % attrib)
+
+    # keep the agent running on the clients in daemon mode
+    collector_cfg['stream'] = _collector.attrib.get('stream', 'no') == 'yes'
+
+    # measure CPU usage since the previous poll instead of sleeping in the agent
+    collector_cfg['nonblocking_cpu'] = _collector.attrib.get('nonblocking_cpu', 'no') == 'yes'
+
+    # Windows returns security events sorted so agents can stop reading early
+    collector_cfg['ordered_events'] = _collector.attrib.get('ordered_events', 'no') == 'yes'
+
+    # agents send zlib compressed responses
+    collector_cfg['compress'] = _collector.attrib.get('compress', 'no') == 'yes'
+
+    # Prometheus text file with the timings of the collector itself
+    collector_cfg['metrics_file'] = _collector.attrib.get('metrics_file') or None
+
+    # store the timings of the collector in the self_metric table too
+    collector_cfg['self_metrics'] = _collector.attrib.get('self_metrics', 'no') == 'yes'
+
+    return collector_cfg
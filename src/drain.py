@@ -0,0 +1,79 @@
+import threading
+
+
+class EventDrain(object):
+    """
+        Decides how many Windows Security Events are requested from
+        a client in each round and when to stop asking for more.
+
+        After the first batch the server keeps requesting batches past
+        the highest EventRecordID it has received, over the same SSH
+        connection, until a batch comes back incomplete (the backlog is
+        drained) or the time or event budget of the poll is spent.
+
+        The batch size of each client adapts to its observed throughput
+        so that a single round takes about @round_time seconds.
+    """
+    def __init__(self, batch_size=1000, max_time=0, max_events=10000, round_time=5): # pylint: disable=too-many-arguments
+        """
+            @batch_size - int - initial number of events per round
+            @max_time - float - seconds a poll may spend draining, 0 disables draining
+            @max_events - int - max number of events collected in one poll
+            @round_time - float - desired duration of a round in seconds
+        """
+        self.initial_batch_size = batch_size
+        self.max_time = max_time
+        self.max_events = max_events
+        self.round_time = round_time
+
+        self._batch_sizes = {}
+        self._lock = threading.Lock()
+
+    @property
+    def min_batch_size(self):
+        return max(1, self.initial_batch_size // 10)
+
+    @property
+    def max_batch_size(self):
+        return self.initial_batch_size * 20
+
+    def batch_size(self, client, collected=0):
+        """
+            Returns the number of events to request from @client after
+            @collected events were received during this poll already!
+        """
+        with self._lock:
+            size = self._batch_sizes.get(client['ip'], self.initial_batch_size)
+        return max(0, min(size, self.max_events - collected))
+
+    def observe(self, client, requested, received, elapsed):
+        """
+            Adapt the batch size of @client after a round which returned
+            @received out of @requested events in @elapsed seconds!
+        """
+        # an incomplete batch says nothing about the throughput
+        if received < requested or received == 0:
+            return
+
+        if elapsed <= 0:
+            target = self.max_batch_size
+        else:
+            target = received / elapsed * self.round_time
+
+        with self._lock:
+            current = self._batch_sizes.get(client['ip'], self.initial_batch_size)
+            # move half way to the target to smooth out noisy measurements
+            size = int((current + target) / 2)
+            self._batch_sizes[client['ip']] = max(self.min_batch_size,
+                                                  min(self.max_batch_size, size))
+
+    def should_continue(self, requested, received, total, elapsed):
+        """
+            Returns True if another round should be requested after one
+            which returned @received out of @requested events, given that
+            @total events were collected in @elapsed seconds so far!
+        """
+        if received < requested:
+            return False
+
+        return elapsed < self.max_time and total < self.max_events
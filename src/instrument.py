@@ -0,0 +1,180 @@
+import os
+import time
+import bisect
+import threading
+import contextlib
+
+import orm
+
+
+# upper bounds of the histogram buckets
+SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+BYTES_BUCKETS = [1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216]
+
+_HELP = {
+    'collector_phase_seconds': 'Time spent in each phase of collecting from a host',
+    'collector_payload_bytes': 'Size of the agent responses',
+}
+
+
+class Histogram(object):
+    """
+        Counts observations into fixed buckets, like a Prometheus histogram!
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last bucket is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry(object):
+    """
+        Thread safe collection of histograms keyed by metric name and
+        phase. The number and sum of the observations are also kept per
+        host, for persist(), which is much cheaper than a histogram per host!
+    """
+    def __init__(self):
+        self._histograms = {}
+        # (name, host, phase) -> [count, sum]
+        self._totals = {}
+        self._persisted = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, host='', phase='', buckets=None): # pylint: disable=too-many-arguments
+        """
+            @buckets - list - upper bounds of the histogram buckets,
+                              SECONDS_BUCKETS by default
+        """
+        with self._lock:
+            histogram = self._histograms.get((name, phase))
+            if histogram is None:
+                histogram = Histogram(SECONDS_BUCKETS if buckets is None else buckets)
+                self._histograms[(name, phase)] = histogram
+            histogram.observe(value)
+
+            totals = self._totals.setdefault((name, host, phase), [0, 0.0])
+            totals[0] += 1
+            totals[1] += value
+
+    @contextlib.contextmanager
+    def timed(self, phase, host=''):
+        """
+            Record how long the body of the with statement takes, errors included!
+        """
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.observe('collector_phase_seconds', time.time() - started_at, host, phase)
+
+    def render(self):
+        """
+            Returns all histograms in the Prometheus text exposition format!
+        """
+        with self._lock:
+            items = sorted((key, histogram.buckets, list(histogram.counts), histogram.sum,
+                            histogram.count) for key, histogram in self._histograms.items())
+
+        lines = []
+        current = None
+        for (name, phase), buckets, counts, total, count in items:
+            if name != current:
+                current = name
+                lines.append('# HELP %s %s' % (name, _HELP.get(name, name)))
+                lines.append('# TYPE %s histogram' % name)
+
+            labels = ['phase="%s"' % _escape(phase)] if phase else []
+
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket{%s} %d' % (name, ','.join(labels + ['le="%s"' % bound]),
+                                                   cumulative))
+            suffix = '{%s}' % ','.join(labels) if labels else ''
+            lines.append('%s_sum%s %s' % (name, suffix, repr(float(total))))
+            lines.append('%s_count%s %d' % (name, suffix, count))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """
+            Atomically replace @path with render(), e.g. for the
+            textfile collector of the Prometheus node exporter!
+        """
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'w') as textfile:
+            textfile.write(self.render())
+        os.replace(temp_path, path)
+
+    def persist(self, db, collected_at):
+        """
+            Store what was observed since the previous call as orm.SelfMetric
+            rows, one per metric, host and phase!
+
+            @return - int - number of stored rows
+        """
+        rows = []
+        previous = {}
+        with self._lock:
+            for key, (current_count, current_total) in self._totals.items():
+                count, total = self._persisted.get(key, (0, 0.0))
+                if current_count == count:
+                    continue
+
+                previous[key] = (count, total)
+                self._persisted[key] = (current_count, current_total)
+                rows.append({
+                    'collected_at': collected_at,
+                    'name': key[0],
+                    'host': key[1],
+                    'phase': key[2],
+                    'count': current_count - count,
+                    'sum': current_total - total,
+                })
+
+        if rows:
+            try:
+                db.execute(orm.SelfMetric.__table__.insert(), rows)
+                db.commit()
+            except Exception:
+                db.rollback()
+                # store them on the next call
+                with self._lock:
+                    self._persisted.update(previous)
+                raise
+
+        return len(rows)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class CountingReader(object):
+    """
+        Wraps a file-like object and counts the bytes read from it!
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.size += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self.stream.readline(*args)
+        self.size += len(data)
+        return data
+
+
+# used by server.py and alerts.py
+REGISTRY = Registry()
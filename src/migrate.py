@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import sys
+
+import sqlalchemy as sql
+
+import orm
+import query
+import config
+
+
+def _delete_duplicate_events(db, chunk_size):
+    """
+        Delete all but the first stored copy of every event, one
+        transaction per @chunk_size duplicated events!
+
+        @return - int - number of deleted rows
+    """
+    table = orm.WinEventLog.__table__
+    key = [table.c[column] for column in orm.EVENT_RECORD_COLUMNS]
+
+    deleted = 0
+    while True:
+        # rows with a NULL TimeCreated don't violate the constraint
+        duplicates = db.execute(
+            orm.select(*(key + [sql.func.min(table.c.id)])).where(
+                table.c.TimeCreated.isnot(None)
+            ).group_by(*key).having(sql.func.count() > 1).limit(chunk_size)
+        ).fetchall()
+
+        if not duplicates:
+            return deleted
+
+        for system_id, event_record_id, time_created, first_id in duplicates:
+            deleted += db.execute(table.delete().where(
+                table.c.system_id == system_id
+            ).where(
+                table.c.EventRecordID == event_record_id
+            ).where(
+                table.c.TimeCreated == time_created
+            ).where(table.c.id != first_id)).rowcount
+        db.commit()
+
+
+def add_event_constraint(db, chunk_size=1000, attempts=3):
+    """
+        Add the unique constraint of orm.WinEventLog, as a unique index, to
+        a win_event_log table created by an older version, deleting the
+        duplicate events stored meanwhile first.
+
+        A collector which is running meanwhile may store new duplicates before
+        the index exists, in which case it is tried again up to @attempts times.
+        The collectors use the constraint only after they are restarted.
+
+        @db - DB session
+        @chunk_size - int - number of duplicated events deleted per transaction
+        @return - int - number of deleted duplicate rows
+    """
+    if orm.has_event_constraint(db.get_bind()):
+        return 0
+
+    table = orm.WinEventLog.__table__
+    index = sql.Index('uq_win_event_log_record',
+                      *[table.c[column] for column in orm.EVENT_RECORD_COLUMNS], unique=True)
+    # the index isn't part of the declared schema
+    table.indexes.discard(index)
+
+    deleted = 0
+    for attempt in range(attempts):
+        deleted += _delete_duplicate_events(db, chunk_size)
+        try:
+            index.create(db.get_bind())
+            return deleted
+        except sql.exc.IntegrityError:
+            if attempt == attempts - 1:
+                raise
+
+    return deleted
+
+
+def backfill_samples(db, chunk_size=10000):
+    """
+        Copy the samples stored in CpuUsage, MemUsage and Uptime into
+        the wide orm.Sample table, one transaction per @chunk_size rows.
+
+        Samples which are already in orm.Sample are skipped, so the
+        backfill can be interrupted and started again, and can run
+        while the collector is already writing with the wide layout.
+
+        @db - DB session
+        @chunk_size - int - number of samples copied per transaction
+        @return - int - number of copied samples
+    """
+    cpu = orm.CpuUsage.__table__
+    sample = orm.Sample.__table__
+
+    copied = 0
+    last_id = 0
+    while True:
+        rows = db.execute(
+            query.legacy_samples().add_columns(cpu.c.id).where(
+                cpu.c.id > last_id
+            ).order_by(cpu.c.id).limit(chunk_size)
+        ).fetchall()
+
+        if not rows:
+            return copied
+
+        last_id = rows[-1].id
+        start = min(row.collected_at for row in rows)
+        end = max(row.collected_at for row in rows)
+
+        existing = set(
+            (row.system_id, row.collected_at) for row in db.execute(
+                orm.select(sample.c.system_id, sample.c.collected_at).where(
+                    sample.c.collected_at.between(start, end)
+                )
+            )
+        )
+
+        new_samples = []
+        for row in rows:
+            if (row.system_id, row.collected_at) in existing:
+                continue
+            existing.add((row.system_id, row.collected_at))
+
+            new_samples.append({
+                'system_id': row.system_id,
+                'collected_at': row.collected_at,
+                'cpu': row.cpu,
+                'memory': row.memory,
+                'uptime': row.uptime,
+            })
+
+        if new_samples:
+            db.execute(sample.insert(), new_samples)
+        db.commit()
+        copied += len(new_samples)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print('USAGE: migrate.py path/to/config.xml')
+        sys.exit(1)
+
+    db = orm.connect(config.parse_db(config.parse_config(sys.argv[1])))
+    print('***** DELETED %d DUPLICATE EVENTS' % add_event_constraint(db))
+    print('***** COPIED %d SAMPLES' % backfill_samples(db))
@@ -3,6 +3,30 @@ from sqlalchemy.ext.declarative import declarative_base
 
 _Base = declarative_base()
 
+# SQLAlchemy 1.3, the last release for Python 3.5, takes the columns of
+# select() as a list and 1.4+ positionally, see select()
+_LIST_SELECT = tuple(int(part) for part in sql.__version__.split('.')[:2]) < (1, 4)
+
+# max number of bound parameters in a single IN (...) lookup
+LOOKUP_CHUNK = 500
+
+
+def select(*columns):
+    """
+        Returns a SELECT of @columns with any SQLAlchemy version!
+    """
+    if _LIST_SELECT:
+        return sql.select(list(columns))
+    return sql.select(*columns)
+
+
+def mappings(result):
+    """
+        Returns the rows of @result as dicts keyed by column name,
+        which only 1.4+ result objects can do themselves!
+    """
+    return [dict(zip(result.keys(), row)) for row in result.fetchall()]
+
 
 class System(_Base):
     __tablename__ = 'system'
@@ -16,7 +40,7 @@ class CpuUsage(_Base):
 
     id = sql.Column(sql.Integer, primary_key=True)
     system_id = sql.Column(sql.Integer, sql.ForeignKey('system.id'), nullable=False)
-    usage = sql.Column(sql.Float, index=True)
+    usage = sql.Column(sql.Float)
     collected_at = sql.Column(sql.DateTime, index=True, nullable=False)
 
 
@@ -25,7 +49,7 @@ class MemUsage(_Base):
 
     id = sql.Column(sql.Integer, primary_key=True)
     system_id = sql.Column(sql.Integer, sql.ForeignKey('system.id'), nullable=False)
-    usage = sql.Column(sql.Float, index=True)
+    usage = sql.Column(sql.Float)
     collected_at = sql.Column(sql.DateTime, index=True, nullable=False)
 
 class Uptime(_Base):
@@ -33,12 +57,140 @@ class Uptime(_Base):
 
     id = sql.Column(sql.Integer, primary_key=True)
     system_id = sql.Column(sql.Integer, sql.ForeignKey('system.id'), nullable=False)
-    uptime = sql.Column(sql.Integer, index=True)
+    uptime = sql.Column(sql.Integer)
+    collected_at = sql.Column(sql.DateTime, index=True, nullable=False)
+
+
+# Metrics from the agent response which are stored in Sample. To store
+# another metric add a nullable column with the same name to Sample.
+SAMPLE_METRICS = ['cpu', 'cpu_min', 'cpu_max', 'memory', 'uptime']
+
+
+# Indexes on the metric values are created only by connect(value_indexes=True).
+# Nothing in the collector reads by value so they are pure write overhead
+# unless ad-hoc queries filter on them.
+VALUE_INDEXES = [
+    sql.Index('ix_cpu_usage_usage', CpuUsage.__table__.c.usage),
+    sql.Index('ix_mem_usage_usage', MemUsage.__table__.c.usage),
+    sql.Index('ix_uptime_uptime', Uptime.__table__.c.uptime),
+]
+for _index in VALUE_INDEXES:
+    _index.table.indexes.discard(_index)
+
+
+class Sample(_Base):
+    """
+        All metrics collected from a system at once, in a single row.
+        Used instead of CpuUsage, MemUsage and Uptime with the wide layout!
+    """
+    __tablename__ = 'sample'
+
+    id = sql.Column(sql.Integer, primary_key=True)
+    system_id = sql.Column(sql.Integer, sql.ForeignKey('system.id'), nullable=False)
+    collected_at = sql.Column(sql.DateTime, nullable=False)
+
+    cpu = sql.Column(sql.Float)
+    cpu_min = sql.Column(sql.Float)
+    cpu_max = sql.Column(sql.Float)
+    memory = sql.Column(sql.Float)
+    uptime = sql.Column(sql.Integer)
+
+
+class EventWatermark(_Base):
+    """
+        The highest EventRecordID stored for each system. Updated in
+        the same transaction as the events, see writer.save_event_logs()!
+    """
+    __tablename__ = 'event_watermark'
+
+    system_id = sql.Column(sql.Integer, sql.ForeignKey('system.id'), primary_key=True)
+    last_event_record_id = sql.Column(sql.Integer, nullable=False)
+
+
+class Rollup(_Base):
+    """
+        Aggregated values of one metric of a system during
+        a bucket of @resolution seconds, see rollup.py!
+    """
+    __tablename__ = 'rollup'
+    __table_args__ = (
+        sql.UniqueConstraint('resolution', 'system_id', 'metric', 'bucket',
+                             name='uq_rollup_bucket'),
+    )
+
+    id = sql.Column(sql.Integer, primary_key=True)
+    resolution = sql.Column(sql.Integer, nullable=False)
+    system_id = sql.Column(sql.Integer, sql.ForeignKey('system.id'), nullable=False)
+    metric = sql.Column(sql.String(32), nullable=False)
+    bucket = sql.Column(sql.DateTime, nullable=False)
+
+    min = sql.Column(sql.Float, nullable=False)
+    max = sql.Column(sql.Float, nullable=False)
+    sum = sql.Column(sql.Float, nullable=False)
+    count = sql.Column(sql.Integer, nullable=False)
+
+
+class RollupWatermark(_Base):
+    """
+        The highest id of each raw table which is included in Rollup!
+    """
+    __tablename__ = 'rollup_watermark'
+
+    source = sql.Column(sql.String(32), primary_key=True)
+    last_id = sql.Column(sql.Integer, nullable=False)
+
+
+class SelfMetric(_Base):
+    """
+        Timings of the collector itself, see instrument.Registry.persist()!
+    """
+    __tablename__ = 'self_metric'
+
+    id = sql.Column(sql.Integer, primary_key=True)
     collected_at = sql.Column(sql.DateTime, index=True, nullable=False)
+    name = sql.Column(sql.String(64), nullable=False)
+    host = sql.Column(sql.String(255), nullable=False)
+    phase = sql.Column(sql.String(32), nullable=False)
+
+    # number of observations and their total since the previous row
+    count = sql.Column(sql.Integer, nullable=False)
+    sum = sql.Column(sql.Float, nullable=False)
+
+
+class CollectorWorker(_Base):
+    """
+        A collector process polling a share of the clients and
+        when it was last seen alive, see sharding.Shard!
+    """
+    __tablename__ = 'collector_worker'
+
+    name = sql.Column(sql.String(255), primary_key=True)
+    heartbeat_at = sql.Column(sql.DateTime, nullable=False)
+
+
+class HostLease(_Base):
+    """
+        Which collector worker may poll a client and until
+        when, see sharding.Shard!
+    """
+    __tablename__ = 'host_lease'
+
+    host = sql.Column(sql.String(255), primary_key=True)
+    worker = sql.Column(sql.String(255), index=True, nullable=False)
+    expires_at = sql.Column(sql.DateTime, nullable=False)
+
+
+# columns which identify a stored event, see WinEventLog
+EVENT_RECORD_COLUMNS = ['system_id', 'EventRecordID', 'TimeCreated']
 
 
 class WinEventLog(_Base):
     __tablename__ = 'win_event_log'
+    __table_args__ = (
+        # an event is stored only once, see writer.save_event_logs(). Tables
+        # created by older versions get it from migrate.add_event_constraint()
+        sql.UniqueConstraint(*EVENT_RECORD_COLUMNS, name='uq_win_event_log_record'),
+    )
 
     id = sql.Column(sql.Integer, primary_key=True)
     system_id = sql.Column(sql.Integer, sql.ForeignKey('system.id'), nullable=False)
@@ -68,14 +220,107 @@ class WinEventLog(_Base):
     collected_at = sql.Column(sql.DateTime, index=True, nullable=False)
 
 
-def connect(db_connection):
+# Indexes for the queries in query.py, rollup.py and retention.py. They were
+# added after the tables so connect() creates them in existing databases too.
+QUERY_INDEXES = [
+    sql.Index('ix_cpu_usage_system_id_collected_at',
+              CpuUsage.__table__.c.system_id, CpuUsage.__table__.c.collected_at),
+    sql.Index('ix_mem_usage_system_id_collected_at',
+              MemUsage.__table__.c.system_id, MemUsage.__table__.c.collected_at),
+    sql.Index('ix_uptime_system_id_collected_at',
+              Uptime.__table__.c.system_id, Uptime.__table__.c.collected_at),
+    sql.Index('ix_sample_system_id_collected_at',
+              Sample.__table__.c.system_id, Sample.__table__.c.collected_at),
+    sql.Index('ix_win_event_log_system_id_time_created',
+              WinEventLog.__table__.c.system_id, WinEventLog.__table__.c.TimeCreated),
+    sql.Index('ix_win_event_log_event_id_time_created',
+              WinEventLog.__table__.c.EventID, WinEventLog.__table__.c.TimeCreated),
+]
+
+
+def connect(db_connection, value_indexes=False):
     """
         Connects to the database, creating the schema if it
         doesn't exist and returns a session object!
 
         A session object can be used to query, insert and delete
         records from the database!
+
+        The indexes in QUERY_INDEXES are added to existing tables and with
+        @value_indexes the ones in VALUE_INDEXES too. Existing indexes are
+        never dropped.
     """
     db_engine = sql.create_engine(db_connection)
     _Base.metadata.create_all(db_engine)
+
+    # Index.create() can't check first before SQLAlchemy 1.4
+    inspector = sql.inspect(db_engine)
+    for index in QUERY_INDEXES + (VALUE_INDEXES if value_indexes else []):
+        if index.name not in [existing['name'] for existing in
+                              inspector.get_indexes(index.table.name)]:
+            index.create(db_engine)
+
     return sql.orm.sessionmaker(bind=db_engine)()
+
+
+def has_event_constraint(bind):
+    """
+        Returns True if the win_event_log table in the DB has a unique
+        constraint, or unique index, on EVENT_RECORD_COLUMNS!
+
+        @bind - sqlalchemy Engine or Connection
+    """
+    inspector = sql.inspect(bind)
+    table = WinEventLog.__tablename__
+    unique = inspector.get_unique_constraints(table) + [
+        index for index in inspector.get_indexes(table) if index['unique']]
+
+    return any(set(constraint['column_names']) == set(EVENT_RECORD_COLUMNS)
+               for constraint in unique)
+
+
+def _system_ids(db, names):
+    """
+        Returns the ids of the existing systems in @names, keyed by name,
+        with one query per chunk!
+    """
+    table = System.__table__
+    names = sorted(names)
+
+    ids = {}
+    for i in range(0, len(names), LOOKUP_CHUNK):
+        ids.update(db.execute(select(table.c.name, table.c.id).where(
+            table.c.name.in_(names[i:i + LOOKUP_CHUNK])
+        )).fetchall())
+
+    return ids
+
+
+def ensure_systems(db, names):
+    """
+        Returns the ids of the systems in @names, keyed by name,
+        inserting the missing ones with a single multi-row INSERT!
+    """
+    names = set(names)
+    table = System.__table__
+    ids = _system_ids(db, names)
+    missing = names - set(ids)
+    if missing:
+        try:
+            db.execute(table.insert(), [{'name': name} for name in sorted(missing)])
+            db.commit()
+        except sql.exc.IntegrityError:
+            # another collector worker inserted some of them meanwhile
+            db.rollback()
+            for name in sorted(missing):
+                try:
+                    db.execute(table.insert().values(name=name))
+                    db.commit()
+                except sql.exc.IntegrityError:
+                    db.rollback()
+        except Exception:
+            db.rollback()
+            raise
+        ids = _system_ids(db, names)
+
+    return ids
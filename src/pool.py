@@ -0,0 +1,151 @@
+import time
+import threading
+
+import paramiko
+
+
+def new_ssh_client():
+    """
+        Returns a new paramiko.SSHClient object which accepts
+        unknown host keys!
+    """
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    return ssh
+
+
+class _Connection(object):
+    """
+        A pooled SSH connection and the lock serializing (re)connects to it!
+    """
+    def __init__(self):
+        self.ssh = None
+        # not 0, or evict_idle() could close a connection which is being made
+        self.last_used = time.time()
+        # number of get() calls not released yet, guarded by the pool lock
+        self.users = 0
+        self.lock = threading.Lock()
+
+    def is_alive(self):
+        if self.ssh is None:
+            return False
+
+        transport = self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        if self.ssh is not None:
+            self.ssh.close()
+            self.ssh = None
+
+
+class SSHPool(object):
+    """
+        Keeps SSH connections open between polling cycles so that
+        every poll only has to open a new channel instead of doing the
+        full TCP + SSH handshake + authentication again.
+
+        Connections are keyed by (ip, port, username), kept alive with
+        SSH keepalive packets, reconnected lazily when they die and
+        closed after being idle for @max_idle seconds. A connection
+        returned by get() is in use, and never closed as idle, until it
+        is given back with release().
+    """
+    def __init__(self, keepalive=30, max_idle=300):
+        self.keepalive = keepalive
+        self.max_idle = max_idle
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(client):
+        return (client['ip'], client['port'], client['username'])
+
+    def _connection(self, client, users=0):
+        key = self._key(client)
+        with self._lock:
+            if key not in self._connections:
+                self._connections[key] = _Connection()
+            self._connections[key].users += users
+            return self._connections[key]
+
+    def get(self, client):
+        """
+            Returns a connected paramiko.SSHClient for @client,
+            connecting if there isn't a live connection already!
+            Call release() once the connection isn't used anymore.
+        """
+        # checked out before connecting so it isn't evicted meanwhile
+        connection = self._connection(client, users=1)
+        try:
+            with connection.lock:
+                if not connection.is_alive():
+                    connection.close()
+
+                    ssh = new_ssh_client()
+                    ssh.connect(client['ip'], port=client['port'],
+                                username=client['username'], password=client['password'])
+                    if self.keepalive:
+                        ssh.get_transport().set_keepalive(self.keepalive)
+
+                    connection.ssh = ssh
+                    print('***** CONNECTED TO', client['ip'])
+
+                connection.last_used = time.time()
+                return connection.ssh
+        except Exception:
+            self.release(client)
+            raise
+
+    def release(self, client):
+        """
+            Give the connection for @client, returned by get(), back
+            to the pool. It is idle from now on!
+        """
+        with self._lock:
+            connection = self._connections.get(self._key(client))
+            if connection is not None:
+                connection.users = max(0, connection.users - 1)
+                connection.last_used = time.time()
+
+    def discard(self, client):
+        """
+            Close the connection for @client, e.g. after an error.
+            The next get() will reconnect!
+        """
+        connection = self._connection(client)
+        with connection.lock:
+            connection.close()
+
+    def evict_idle(self, now=None):
+        """
+            Close connections which haven't been used for more than
+            max_idle seconds and aren't in use!
+
+            @return - int - number of closed connections
+        """
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            idle = [key for key, connection in self._connections.items()
+                    if not connection.users and now - connection.last_used > self.max_idle]
+            connections = [self._connections.pop(key) for key in idle]
+
+        for connection in connections:
+            with connection.lock:
+                connection.close()
+
+        return len(connections)
+
+    def close(self):
+        """
+            Close all pooled connections!
+        """
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections = {}
+
+        for connection in connections:
+            with connection.lock:
+                connection.close()
@@ -0,0 +1,261 @@
+import sqlalchemy as sql
+
+import orm
+import rollup
+
+
+# number of points returned by history() when no step is given
+_DEFAULT_POINTS = 300
+
+# number of rows fetched from the DB at a time by the generators below
+_YIELD_PER = 1000
+
+# legacy tables and value columns of each metric
+_LEGACY_COLUMNS = {
+    'cpu': orm.CpuUsage.__table__.c.usage,
+    'memory': orm.MemUsage.__table__.c.usage,
+    'uptime': orm.Uptime.__table__.c.uptime,
+}
+
+
+def legacy_samples():
+    """
+        Returns a SELECT joining CpuUsage, MemUsage and Uptime rows
+        written together into samples shaped like orm.Sample, see
+        samples() and migrate.backfill_samples()!
+    """
+    cpu = orm.CpuUsage.__table__
+    mem = orm.MemUsage.__table__
+    uptime = orm.Uptime.__table__
+
+    return orm.select(
+        cpu.c.system_id,
+        cpu.c.collected_at,
+        cpu.c.usage.label('cpu'),
+        mem.c.usage.label('memory'),
+        uptime.c.uptime.label('uptime'),
+    ).select_from(
+        cpu.outerjoin(mem, sql.and_(mem.c.system_id == cpu.c.system_id,
+                                    mem.c.collected_at == cpu.c.collected_at))
+        .outerjoin(uptime, sql.and_(uptime.c.system_id == cpu.c.system_id,
+                                    uptime.c.collected_at == cpu.c.collected_at))
+    )
+
+
+def samples(db, system_id, start=None, end=None, layout='legacy'):
+    """
+        Returns the samples of a system ordered by collected_at, the same
+        way no matter which storage layout they were written with!
+
+        @db - DB session
+        @system_id - int - orm.System.id
+        @start - datetime - only samples collected at or after that
+        @end - datetime - only samples collected before that
+        @layout - string - 'legacy' or 'wide', see writer.MetricsWriter
+        @return - generator of dicts with collected_at, cpu, memory and uptime
+    """
+    if layout == 'wide':
+        table = orm.Sample.__table__
+        query = orm.select(table.c.system_id, table.c.collected_at,
+                           table.c.cpu, table.c.memory, table.c.uptime)
+        columns = table.c
+    else:
+        query = legacy_samples()
+        columns = orm.CpuUsage.__table__.c
+
+    query = query.where(columns.system_id == system_id)
+    if start is not None:
+        query = query.where(columns.collected_at >= start)
+    if end is not None:
+        query = query.where(columns.collected_at < end)
+
+    query = query.order_by(columns.collected_at).execution_options(
+        stream_results=True, max_row_buffer=_YIELD_PER)
+    for row in db.execute(query):
+        yield {
+            'collected_at': row.collected_at,
+            'cpu': row.cpu,
+            'memory': row.memory,
+            'uptime': row.uptime,
+        }
+
+
+def pick_resolution(start, end, step=None):
+    """
+        Returns the coarsest rollup resolution, in seconds, which still
+        has at least one point every @step seconds between @start and @end,
+        or None if only the raw samples are fine enough!
+    """
+    if step is None:
+        step = (end - start).total_seconds() / _DEFAULT_POINTS
+
+    resolution = None
+    for seconds in rollup.RESOLUTIONS:
+        if seconds <= step:
+            resolution = seconds
+
+    return resolution
+
+
+def history(db, system_id, metric, start, end, step=None, layout='legacy'): # pylint: disable=too-many-arguments
+    """
+        Returns the values of @metric for a system between @start and @end,
+        read from the coarsest rollup which satisfies @step instead of
+        scanning every raw sample. Rollups include only the samples which
+        were stored before the last but one rollup.update_rollups()!
+
+        @db - DB session
+        @system_id - int - orm.System.id
+        @metric - string - e.g. 'cpu', 'memory' or 'uptime'
+        @start - datetime - beginning of the range, inclusive
+        @end - datetime - end of the range, exclusive
+        @step - int - desired seconds between points, defaults to a
+                      step which returns about 300 points
+        @layout - string - where to read raw samples from, see samples()
+        @return - generator of dicts with bucket, min, max, avg and count
+    """
+    resolution = pick_resolution(start, end, step)
+
+    if resolution is None:
+        for sample in samples(db, system_id, start, end, layout):
+            value = sample.get(metric)
+            if value is not None:
+                yield {
+                    'bucket': sample['collected_at'],
+                    'min': value,
+                    'max': value,
+                    'avg': value,
+                    'count': 1,
+                }
+        return
+
+    table = orm.Rollup.__table__
+    query = orm.select(table.c.bucket, table.c.min, table.c.max, table.c.sum, table.c.count).where(
+        table.c.resolution == resolution
+    ).where(
+        table.c.system_id == system_id
+    ).where(
+        table.c.metric == metric
+    ).where(
+        table.c.bucket >= rollup.bucket_start(start, resolution)
+    ).where(
+        table.c.bucket < end
+    ).order_by(table.c.bucket)
+
+    for row in db.execute(query):
+        yield {
+            'bucket': row.bucket,
+            'min': row.min,
+            'max': row.max,
+            'avg': row.sum / row.count,
+            'count': row.count,
+        }
+
+
+def _metric_column(metric, layout):
+    """
+        Returns the column which stores @metric in @layout!
+    """
+    if layout == 'wide':
+        if metric in orm.SAMPLE_METRICS:
+            return orm.Sample.__table__.c[metric]
+    elif metric in _LEGACY_COLUMNS:
+        return _LEGACY_COLUMNS[metric]
+
+    raise ValueError('Unknown metric %s for the %s layout' % (metric, layout))
+
+
+def latest(db, metric, layout='legacy'):
+    """
+        Returns the most recent value of @metric for every system!
+
+        @db - DB session
+        @metric - string - e.g. 'cpu', 'memory' or 'uptime'
+        @layout - string - 'legacy' or 'wide', see writer.MetricsWriter
+        @return - generator of dicts with system_id, name, collected_at and value
+    """
+    column = _metric_column(metric, layout)
+    table = column.table
+    system = orm.System.__table__
+
+    # served by the (system_id, collected_at) index
+    newest = orm.select(
+        table.c.system_id,
+        sql.func.max(table.c.collected_at).label('collected_at'),
+    ).group_by(table.c.system_id).alias()
+
+    query = orm.select(
+        table.c.system_id, system.c.name, table.c.collected_at, column.label('value')
+    ).select_from(
+        table.join(newest, sql.and_(newest.c.system_id == table.c.system_id,
+                                    newest.c.collected_at == table.c.collected_at))
+        .join(system, system.c.id == table.c.system_id)
+    ).order_by(system.c.name).execution_options(stream_results=True,
+                                                max_row_buffer=_YIELD_PER)
+
+    for row in db.execute(query):
+        yield {
+            'system_id': row.system_id,
+            'name': row.name,
+            'collected_at': row.collected_at,
+            'value': row.value,
+        }
+
+
+def top_systems(db, metric, start, end, limit=10, layout='legacy'): # pylint: disable=too-many-arguments
+    """
+        Returns the @limit systems with the highest average @metric
+        between @start and @end, highest first!
+
+        @return - generator of dicts with system_id, name, avg and max
+    """
+    column = _metric_column(metric, layout)
+    table = column.table
+    system = orm.System.__table__
+
+    average = sql.func.avg(column).label('avg')
+    query = orm.select(
+        table.c.system_id, system.c.name, average, sql.func.max(column).label('max')
+    ).select_from(
+        table.join(system, system.c.id == table.c.system_id)
+    ).where(
+        table.c.collected_at >= start
+    ).where(
+        table.c.collected_at < end
+    ).group_by(table.c.system_id, system.c.name).order_by(average.desc()).limit(limit)
+
+    for row in db.execute(query):
+        yield {
+            'system_id': row.system_id,
+            'name': row.name,
+            'avg': row.avg,
+            'max': row.max,
+        }
+
+
+def events(db, system_id=None, event_id=None, start=None, end=None): # pylint: disable=too-many-arguments
+    """
+        Returns the Windows Security Events matching all of the given
+        conditions ordered by TimeCreated, fetched from the DB in batches!
+
+        @db - DB session
+        @system_id - int - orm.System.id
+        @event_id - int or list of ints - EventID
+        @start - datetime - only events created at or after that
+        @end - datetime - only events created before that
+        @return - iterator of orm.WinEventLog
+    """
+    query = db.query(orm.WinEventLog)
+
+    if system_id is not None:
+        query = query.filter(orm.WinEventLog.system_id == system_id)
+    if isinstance(event_id, int):
+        query = query.filter(orm.WinEventLog.EventID == event_id)
+    elif event_id is not None:
+        query = query.filter(orm.WinEventLog.EventID.in_(event_id))
+    if start is not None:
+        query = query.filter(orm.WinEventLog.TimeCreated >= start)
+    if end is not None:
+        query = query.filter(orm.WinEventLog.TimeCreated < end)
+
+    return iter(query.order_by(orm.WinEventLog.TimeCreated).yield_per(_YIELD_PER))
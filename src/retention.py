@@ -0,0 +1,182 @@
+import re
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy as sql
+
+import orm
+
+
+# tables which can have a retention policy, see config.parse_storage()
+TABLES = dict((model.__tablename__, model.__table__) for model in [
+    orm.CpuUsage, orm.MemUsage, orm.Uptime, orm.Sample, orm.WinEventLog,
+])
+
+# upper bound of a range partition, as returned by pg_get_expr(relpartbound)
+_PARTITION_BOUND = re.compile(r"\bTO \('(\d{4}-\d\d-\d\d(?: \d\d:\d\d:\d\d)?)[^']*'\)")
+
+
+def partition_upper_bound(expression):
+    """
+        Returns the exclusive upper bound of a PostgreSQL range partition
+        from its bound @expression, e.g.
+        "FOR VALUES FROM ('2017-07-01 00:00:00') TO ('2017-08-01 00:00:00')",
+        or None if it isn't bounded by a timestamp!
+    """
+    match = _PARTITION_BOUND.search(expression or '')
+    if match is None:
+        return None
+
+    value = match.group(1)
+    if len(value) == 10:
+        return datetime.strptime(value, '%Y-%m-%d')
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+def drop_partitions(db, table, before):
+    """
+        Drop the partitions of @table which contain only rows collected
+        before @before, if @table is range partitioned on collected_at
+        in PostgreSQL. Dropping a partition is much cheaper than deleting
+        its rows but needs an exclusive lock on the parent table. It is
+        given up if the lock isn't acquired within a second, instead of
+        queueing the collector's inserts behind it.
+
+        @return - list - names of the dropped partitions
+    """
+    if db.get_bind().dialect.name != 'postgresql':
+        return []
+
+    partitions = db.execute(sql.text("""
+        SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+        FROM pg_inherits
+        JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+        JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+        WHERE parent.relname = :table
+          AND pg_get_partkeydef(parent.oid) = 'RANGE (collected_at)'
+    """), {'table': table.name}).fetchall()
+    db.commit()
+
+    quote = db.get_bind().dialect.identifier_preparer.quote
+    dropped = []
+    for name, expression in partitions:
+        upper_bound = partition_upper_bound(expression)
+        if upper_bound is None or upper_bound > before:
+            continue
+
+        try:
+            db.execute(sql.text("SET LOCAL lock_timeout = '1s'"))
+            db.execute(sql.text('DROP TABLE %s' % quote(name)))
+            db.commit()
+        except sql.exc.OperationalError:
+            db.rollback()
+            break
+
+        dropped.append(name)
+
+    return dropped
+
+
+def purge_table(db, table, before, chunk_size=5000, deadline=None):
+    """
+        Delete the rows of @table collected before @before, at most
+        @chunk_size rows per transaction, so that locks are held only
+        briefly and the collector's inserts can proceed between chunks.
+
+        @db - DB session
+        @table - sql.Table - one of TABLES
+        @before - datetime - rows collected before this are deleted
+        @chunk_size - int - max number of rows deleted per transaction
+        @deadline - float - time.time() after which to stop, None for no limit
+        @return - (int, bool) - number of deleted rows and if all were deleted
+    """
+    deleted = 0
+    while deadline is None or time.time() < deadline:
+        # ids are looked up first b/c MySQL doesn't allow LIMIT in IN (...) subqueries
+        ids = [row[0] for row in db.execute(
+            orm.select(table.c.id).where(table.c.collected_at < before).limit(chunk_size)
+        )]
+        if not ids:
+            db.commit()
+            return deleted, True
+
+        try:
+            db.execute(table.delete().where(table.c.id.in_(ids)))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        deleted += len(ids)
+
+    return deleted, False
+
+
+class Retention(object):
+    """
+        Removes the rows older than the number of days configured for
+        each table, in the background of the daemon's polling loop.
+
+        Each call to purge() works for at most @max_time seconds. While
+        expired rows remain should_purge() keeps returning True, afterwards
+        it returns True again @interval seconds later.
+    """
+    def __init__(self, db, retention, chunk_size=5000, interval=3600, max_time=5): # pylint: disable=too-many-arguments
+        """
+            @db - DB session
+            @retention - dict - {table name: days}
+            @chunk_size - int - max number of rows deleted per transaction
+            @interval - int - seconds between purges once all expired rows are gone
+            @max_time - float - seconds a single purge() may take, None for no limit
+        """
+        self.db = db
+        self.retention = retention
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.max_time = max_time
+
+        self._purged_at = None
+        self._pending = True
+
+    def should_purge(self, now=None):
+        """
+            Returns True if there may be expired rows to purge!
+        """
+        if not self.retention:
+            return False
+
+        if now is None:
+            now = time.time()
+
+        return self._pending or self._purged_at is None or \
+            now - self._purged_at >= self.interval
+
+    def purge(self, now=None):
+        """
+            Drop or delete expired rows until done or out of time!
+
+            @now - datetime - rows older than their retention before this are purged
+            @return - dict - {table name: number of deleted rows}
+        """
+        if now is None:
+            now = datetime.now()
+
+        deadline = None
+        if self.max_time is not None:
+            deadline = time.time() + self.max_time
+
+        deleted = {}
+        self._pending = False
+        for name, days in sorted(self.retention.items()):
+            table = TABLES[name]
+            before = now - timedelta(days=days)
+
+            drop_partitions(self.db, table, before)
+            deleted[name], done = purge_table(self.db, table, before,
+                                              self.chunk_size, deadline)
+            if not done:
+                self._pending = True
+                break
+
+        self._purged_at = time.time()
+        return deleted
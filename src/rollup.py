@@ -0,0 +1,200 @@
+from datetime import timedelta
+
+import sqlalchemy as sql
+
+import orm
+
+
+# bucket sizes in seconds, from the finest to the coarsest
+RESOLUTIONS = [60, 3600, 86400]
+
+# raw tables for each storage layout: (table, {metric: column name})
+_SOURCES = {
+    'legacy': [
+        (orm.CpuUsage.__table__, {'cpu': 'usage'}),
+        (orm.MemUsage.__table__, {'memory': 'usage'}),
+        (orm.Uptime.__table__, {'uptime': 'uptime'}),
+    ],
+    'wide': [
+        (orm.Sample.__table__, dict((metric, metric) for metric in orm.SAMPLE_METRICS)),
+    ],
+}
+
+
+# suffix of the RollupWatermark source which holds the highest id of
+# a raw table at the previous update, see update_rollups()
+_HORIZON = ':horizon'
+
+
+def bucket_start(collected_at, resolution):
+    """
+        Returns the start of the bucket of @resolution seconds
+        which @collected_at falls into!
+    """
+    seconds = collected_at.hour * 3600 + collected_at.minute * 60 + collected_at.second
+    return collected_at - timedelta(seconds=seconds % resolution,
+                                    microseconds=collected_at.microsecond)
+
+
+def _aggregate(rows, metrics):
+    """
+        Returns {(resolution, system_id, metric, bucket): [min, max, sum, count]}
+        for the raw @rows!
+    """
+    buckets = {}
+    for row in rows:
+        for metric, column in metrics.items():
+            value = row[column]
+            if value is None:
+                continue
+
+            for resolution in RESOLUTIONS:
+                key = (resolution, row['system_id'], metric,
+                       bucket_start(row['collected_at'], resolution))
+                aggregate = buckets.get(key)
+                if aggregate is None:
+                    buckets[key] = [value, value, value, 1]
+                else:
+                    aggregate[0] = min(aggregate[0], value)
+                    aggregate[1] = max(aggregate[1], value)
+                    aggregate[2] += value
+                    aggregate[3] += 1
+
+    return buckets
+
+
+def _merge(db, buckets):
+    """
+        Add the aggregated @buckets to the stored ones, updating
+        the rows which exist and inserting the rest!
+    """
+    table = orm.Rollup.__table__
+
+    updates = []
+    for resolution in RESOLUTIONS:
+        keys = [key for key in buckets if key[0] == resolution]
+        if not keys:
+            continue
+
+        query = orm.select(table.c.id, table.c.system_id, table.c.metric, table.c.bucket,
+                           table.c.min, table.c.max, table.c.sum, table.c.count).where(
+                               table.c.resolution == resolution
+                           ).where(
+                               table.c.system_id.in_(set(key[1] for key in keys))
+                           ).where(
+                               table.c.bucket.between(min(key[3] for key in keys),
+                                                      max(key[3] for key in keys))
+                           )
+
+        for row in db.execute(query):
+            aggregate = buckets.pop((resolution, row.system_id, row.metric, row.bucket), None)
+            if aggregate is None:
+                continue
+
+            updates.append({
+                '_id': row.id,
+                '_min': min(row.min, aggregate[0]),
+                '_max': max(row.max, aggregate[1]),
+                '_sum': row.sum + aggregate[2],
+                '_count': row.count + aggregate[3],
+            })
+
+    if updates:
+        db.execute(table.update().where(table.c.id == sql.bindparam('_id')).values(
+            min=sql.bindparam('_min'), max=sql.bindparam('_max'),
+            sum=sql.bindparam('_sum'), count=sql.bindparam('_count')
+        ), updates)
+
+    if buckets:
+        db.execute(table.insert(), [{
+            'resolution': key[0],
+            'system_id': key[1],
+            'metric': key[2],
+            'bucket': key[3],
+            'min': aggregate[0],
+            'max': aggregate[1],
+            'sum': aggregate[2],
+            'count': aggregate[3],
+        } for key, aggregate in buckets.items()])
+
+
+def _watermark(db, source):
+    """
+        Returns the highest id of @source already in the rollups!
+    """
+    watermark = db.query(orm.RollupWatermark).filter_by(source=source).first()
+    if watermark is None:
+        return 0
+    return watermark.last_id
+
+
+def _set_watermark(db, source, last_id):
+    """
+        Record that the rows of @source up to @last_id are in the rollups!
+    """
+    table = orm.RollupWatermark.__table__
+    result = db.execute(table.update().where(table.c.source == source).values(last_id=last_id))
+    if not result.rowcount:
+        db.execute(table.insert().values(source=source, last_id=last_id))
+
+
+def update_rollups(db, layout='legacy', chunk_size=10000):
+    """
+        Add the raw samples stored since the last call to the rollups!
+
+        Only rows with an id above the watermark of their table are read,
+        @chunk_size at a time. Each chunk is merged into the rollups and
+        moves the watermark forward in the same transaction so an
+        interrupted update neither loses nor counts samples twice.
+
+        Ids are assigned on INSERT but rows become visible on COMMIT, so a
+        row can appear after rows with higher ids. To not skip it, rows are
+        read only up to the highest id which was visible at the previous
+        call and the rest are added by the next call.
+
+        @db - DB session
+        @layout - string - which raw tables to read, see writer.MetricsWriter
+        @chunk_size - int - max number of raw rows read per transaction
+        @return - int - number of raw rows added to the rollups
+    """
+    processed = 0
+    for table, metrics in _SOURCES[layout]:
+        columns = [table.c.id, table.c.system_id, table.c.collected_at]
+        columns.extend(table.c[column] for column in set(metrics.values()))
+
+        horizon = _watermark(db, table.name + _HORIZON)
+        newest = db.execute(orm.select(sql.func.max(table.c.id))).scalar() or 0
+
+        while True:
+            last_id = _watermark(db, table.name)
+            rows = orm.mappings(db.execute(
+                orm.select(*columns).where(
+                    table.c.id > last_id
+                ).where(
+                    table.c.id <= horizon
+                ).order_by(table.c.id).limit(chunk_size)
+            ))
+            if not rows:
+                break
+
+            try:
+                buckets = _aggregate(rows, metrics)
+                if buckets:
+                    _merge(db, buckets)
+                _set_watermark(db, table.name, rows[-1]['id'])
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+
+            processed += len(rows)
+
+        if newest > horizon:
+            try:
+                _set_watermark(db, table.name + _HORIZON, newest)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+
+    return processed
@@ -0,0 +1,141 @@
+import heapq
+import random
+
+
+def client_key(client):
+    """
+        Returns the key which identifies a client in the scheduler!
+    """
+    return (client['ip'], client['port'])
+
+
+class _Entry(object):
+    """
+        Scheduling state of a single client!
+    """
+    def __init__(self, client, interval, due):
+        self.client = client
+        self.interval = interval
+        self.due = due
+        self.in_flight = False
+        self.skipped = 0
+
+
+class Scheduler(object):
+    """
+        Decides when each client should be polled next.
+
+        Every client is polled each `interval` seconds, taken from the
+        client configuration or @default_interval. The first poll is delayed
+        by a random amount of up to @jitter seconds so that clients with the
+        same interval don't all hit the network and the DB at once.
+
+        A client is never polled again while its previous poll is still
+        running. When a poll overruns, the ticks which were missed meanwhile
+        are coalesced and the client is scheduled for the next tick after
+        the poll has finished.
+    """
+    def __init__(self, default_interval=60, jitter=0):
+        self.default_interval = default_interval
+        self.jitter = jitter
+        self._entries = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _push(self, key, entry):
+        heapq.heappush(self._heap, (entry.due, key))
+
+    def add(self, client, now):
+        """
+            Start polling @client!
+        """
+        interval = client.get('interval') or self.default_interval
+        entry = _Entry(client, interval, now + random.uniform(0, self.jitter))
+
+        key = client_key(client)
+        self._entries[key] = entry
+        self._push(key, entry)
+
+    def remove(self, client):
+        """
+            Stop polling @client. A poll which is already running
+            is allowed to finish but the client isn't scheduled again!
+        """
+        self._entries.pop(client_key(client), None)
+
+    def update(self, client):
+        """
+            Replace the configuration of @client, e.g. after the config file
+            was reloaded, keeping its schedule. A new interval takes effect
+            after the next poll!
+        """
+        entry = self._entries.get(client_key(client))
+        if entry is None:
+            return
+
+        entry.client = client
+        entry.interval = client.get('interval') or self.default_interval
+
+    def clients(self):
+        """
+            Returns the list of clients being polled!
+        """
+        return [entry.client for entry in self._entries.values()]
+
+    def due(self, now):
+        """
+            Returns the list of clients which need to be polled now and
+            marks them as in flight until done() is called for them!
+        """
+        clients = []
+        while self._heap and self._heap[0][0] <= now:
+            due, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+
+            # stale heap item for a removed or rescheduled client
+            if entry is None or entry.in_flight or entry.due != due:
+                continue
+
+            entry.in_flight = True
+            clients.append(entry.client)
+
+        return clients
+
+    def done(self, client, now):
+        """
+            Mark the poll of @client as finished and schedule the next one!
+
+            @return - int - how many ticks were skipped b/c the poll overran
+        """
+        key = client_key(client)
+        entry = self._entries.get(key)
+        if entry is None:
+            return 0
+
+        entry.in_flight = False
+        entry.due += entry.interval
+
+        skipped = 0
+        if entry.due <= now:
+            skipped = int((now - entry.due) // entry.interval) + 1
+            entry.due += skipped * entry.interval
+        entry.skipped += skipped
+
+        self._push(key, entry)
+        return skipped
+
+    def next_due(self):
+        """
+            Returns the time of the next scheduled poll or None!
+        """
+        while self._heap:
+            due, key = self._heap[0]
+            entry = self._entries.get(key)
+            if entry is not None and not entry.in_flight and entry.due == due:
+                return due
+
+            heapq.heappop(self._heap)
+
+        return None
@@ -2,141 +2,988 @@
 
 from __future__ import print_function
 
+import os
 import sys
-import json
+import time
+import argparse
+import socket
+import hashlib
+import stat
+import threading
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
 import paramiko
 
 import orm
+import pool
+import drain
+import agentstream
 import alerts
+import alertengine
 import config
+import writer
+import scheduler
+import wire
+import rollup
+import instrument
+import retention
+import sharding
+import spool
 
 
+AGENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'agent.py')
 
-def _agent_scp(ssh, destination):
+# private directory for the agent, relative to the home directory of the SSH user
+AGENT_DIRECTORY = '.metrics-collector'
+
+_AGENT_DIGEST = None
+
+# (ip, port, destination) of agents uploaded by this process
+_UPLOADED = set()
+_UPLOADED_LOCK = threading.Lock()
+
+
+def _agent_digest():
+    """
+        Returns the SHA1 hex digest of agent.py!
+    """
+    global _AGENT_DIGEST # pylint: disable=global-statement
+    if _AGENT_DIGEST is None:
+        with open(AGENT_PATH, 'rb') as agent_file:
+            _AGENT_DIGEST = hashlib.sha1(agent_file.read()).hexdigest()
+
+    return _AGENT_DIGEST
+
+
+def _agent_version():
+    """
+        Returns a short content hash of agent.py. It is part of the
+        remote file name so that a changed agent is always uploaded again!
+    """
+    return _agent_digest()[:12]
+
+
+def _agent_destination(client):
+    """
+        Returns the versioned path of agent.py on the client. It is
+        relative to the home directory which is the working directory of
+        both SFTP and commands on Linux and Windows OpenSSH servers!
+    """
+    if client['platform'] not in ['Linux', 'Windows']:
+        raise RuntimeError('Unknown platform "%s" for %s' % (client['platform'], client['ip']))
+
+    return '%s/agent-%s.py' % (AGENT_DIRECTORY, _agent_version())
+
+
+def _ensure_agent_directory(sftp, client):
+    """
+        Create AGENT_DIRECTORY, accessible only by the SSH user, or check
+        that nobody else can write to the existing one, so that no other
+        user can plant an agent which the collector would execute!
+    """
+    try:
+        sftp.mkdir(AGENT_DIRECTORY, 0o700)
+        # mkdir is subject to the umask
+        sftp.chmod(AGENT_DIRECTORY, 0o700)
+        return
+    except IOError:
+        pass
+
+    if client['platform'] != 'Linux':
+        # Windows servers don't report ACLs, the profile directory is private
+        return
+
+    directory = sftp.lstat(AGENT_DIRECTORY)
+    if not stat.S_ISDIR(directory.st_mode) or directory.st_uid != sftp.stat('.').st_uid or \
+            stat.S_IMODE(directory.st_mode) & 0o022:
+        raise RuntimeError('~/%s on %s is not a private directory of %s' % (
+            AGENT_DIRECTORY, client['ip'], client['username']))
+
+
+def _is_current_agent(sftp, destination):
+    """
+        Returns True if @destination on the client is a complete copy of
+        agent.py! Its name contains the hash of agent.py and only the SSH
+        user can write to its directory, so it isn't read back.
+    """
+    try:
+        return sftp.stat(destination).st_size == os.path.getsize(AGENT_PATH)
+    except IOError:
+        return False
+
+
+def _ensure_agent(ssh, client, destination):
     """
-        Secure copy the agent.py script to the client.
+        Upload agent.py to the client unless this process has already
+        done so or an up to date copy is found on the client!
 
         @ssh - paramiko.SSHClient object
-        @destination - string - destination file name
+        @client - dict - configuration of client
+        @destination - string - versioned destination file name
         @return - None
     """
+    key = (client['ip'], client['port'], destination)
+    with _UPLOADED_LOCK:
+        if key in _UPLOADED:
+            return
+
     sftp = ssh.open_sftp()
-    sftp.put('agent.py', destination)
-    sftp.close()
+    try:
+        _ensure_agent_directory(sftp, client)
+        if not _is_current_agent(sftp, destination):
+            sftp.put(AGENT_PATH, destination)
+    finally:
+        sftp.close()
+
+    with _UPLOADED_LOCK:
+        _UPLOADED.add(key)
+
+
+def _forget_agent(client, destination):
+    """
+        Forget that agent.py was uploaded to @client, e.g. b/c it was
+        deleted, and check again on the next poll!
+    """
+    with _UPLOADED_LOCK:
+        _UPLOADED.discard((client['ip'], client['port'], destination))
 
 
-def collect_metrics(ssh, client, last_event_record_id):
+def collect_metrics(ssh, client, last_event_record_id, agent_args='', event_drain=None):
     """
         SSH to the client and collect the metrics.
 
         @ssh - paramiko.SSHClient object
         @client - dict - configuration of client
         @last_event_record_id - int - EventRecordID for filtering
+        @agent_args - string - additional command line arguments for the agent
+        @event_drain - drain.EventDrain - collect the event backlog in several rounds
         @return - dict - metrics and windows security event log
     """
 
-    ssh.connect(client['ip'], port=client['port'],
-                username=client['username'], password=client['password'])
+    with instrument.REGISTRY.timed('connect', client['ip']):
+        ssh.connect(client['ip'], port=client['port'],
+                    username=client['username'], password=client['password'])
 
     print('***** CONNECTED TO', client['ip'])
 
-    if client['platform'] == 'Linux':
-        destination = '/tmp/agent.py'
-    elif client['platform'] == 'Windows':
-        destination = 'C:\\agent.py'
-    else:
-        raise RuntimeError('Unknown platform "%s" for %s' % (client['platform'], client['ip']))
+    try:
+        return _run_agent(ssh, client, last_event_record_id, agent_args, event_drain)
+    finally:
+        ssh.close()
+
+
+def _run_agent(ssh, client, last_event_record_id, agent_args='', event_drain=None):
+    """
+        Upload and execute the agent over an already connected
+        SSH session and return its response.
 
+        @ssh - paramiko.SSHClient object, connected to the client
+        @client - dict - configuration of client
+        @last_event_record_id - int - EventRecordID for filtering
+        @agent_args - string - additional command line arguments for the agent
+        @event_drain - drain.EventDrain - collect the event backlog in several rounds
+        @return - dict - metrics and windows security event log
+    """
+    destination = _agent_destination(client)
+
+    # copy the agent script to the client system if it isn't there yet
+    with instrument.REGISTRY.timed('upload', client['ip']):
+        _ensure_agent(ssh, client, destination)
+
+    if event_drain is None:
+        return _exec_agent(ssh, client, destination, agent_args, last_event_record_id)
 
-    # copy the agent script to the client system
-    _agent_scp(ssh, destination)
+    # the last --batch-size argument wins over the one in @agent_args
+    started_at = time.time()
+    requested = event_drain.batch_size(client)
+    metrics = _exec_agent(ssh, client, destination,
+                          '%s --batch-size %d' % (agent_args, requested),
+                          last_event_record_id)
+    if 'security_event_logs' not in metrics:
+        return metrics
 
+    # keep asking for the events after the highest EventRecordID received
+    events = metrics['security_event_logs']
+    received = len(events)
+    event_drain.observe(client, requested, received, time.time() - started_at)
+
+    while event_drain.should_continue(requested, received, len(events),
+                                      time.time() - started_at):
+        round_started_at = time.time()
+        requested = event_drain.batch_size(client, len(events))
+        response = _exec_agent(ssh, client, destination,
+                               '%s --events-only --batch-size %d' % (agent_args, requested),
+                               _max_event_record_id(metrics, last_event_record_id))
+
+        received = len(response['security_event_logs'])
+        events.extend(response['security_event_logs'])
+        event_drain.observe(client, requested, received, time.time() - round_started_at)
+
+    return metrics
+
+
+def _exec_agent(ssh, client, destination, agent_args, last_event_record_id):
+    """
+        Execute the uploaded agent once and return its response!
+    """
     # don't encrypt on the client b/c we're running through ssh
     # which is already encryted. The requirement says the client should
     # encrypt the response but that is not necessary! See the design doc.
-    _in, _out, _err = ssh.exec_command("python %s %d" % (destination, last_event_record_id))
+    with instrument.REGISTRY.timed('exec', client['ip']):
+        _in, _out, _err = ssh.exec_command(
+            "python %s %s %d" % (destination, agent_args, last_event_record_id))
+
+    # the response is decoded while it arrives, stderr is buffered meanwhile
+    _out = instrument.CountingReader(_out)
+    decode_error = None
+    try:
+        with instrument.REGISTRY.timed('response', client['ip']):
+            metrics = wire.decode(_out)
+    except ValueError as err:
+        metrics = None
+        decode_error = err
+    instrument.REGISTRY.observe('collector_payload_bytes', _out.size, client['ip'],
+                                buckets=instrument.BYTES_BUCKETS)
 
     # check for errors on the client
     errors = _err.read().strip().decode('utf8')
     if errors:
+        _forget_agent(client, destination)
         raise RuntimeError('Execution on %s failed with:\n%s' % (client['ip'], errors))
 
-    response = _out.read().strip().decode('utf8')
+    if metrics is None:
+        raise RuntimeError('Invalid response from %s: %s' % (client['ip'], decode_error))
+
+    return metrics
 
-    ssh.close()
 
-    return json.loads(response)
+def _collect_worker(client, last_event_record_id, ssh_pool=None, agent_args='', event_drain=None):
+    """
+        Collect metrics from a single client inside a worker thread.
 
+        Without @ssh_pool every call gets its own paramiko.SSHClient which
+        is closed afterwards. With @ssh_pool the connection is reused and only
+        a new channel is opened. If a pooled connection turns out to be dead
+        it is discarded and the poll is retried once over a new connection!
+    """
+    if ssh_pool is None:
+        return collect_metrics(pool.new_ssh_client(), client, last_event_record_id,
+                               agent_args, event_drain)
 
+    try:
+        return _run_pooled_agent(client, last_event_record_id, ssh_pool, agent_args, event_drain)
+    except (paramiko.SSHException, EOFError, socket.error):
+        ssh_pool.discard(client)
+
+    return _run_pooled_agent(client, last_event_record_id, ssh_pool, agent_args, event_drain)
+
+
+def _run_pooled_agent(client, last_event_record_id, ssh_pool, agent_args, event_drain):
+    """
+        Run the agent over the pooled connection of @client which is
+        kept from being evicted as idle meanwhile!
+    """
+    with instrument.REGISTRY.timed('connect', client['ip']):
+        ssh = ssh_pool.get(client)
+    try:
+        return _run_agent(ssh, client, last_event_record_id, agent_args, event_drain)
+    finally:
+        ssh_pool.release(client)
+
+
+def _open_stream(ssh, client, last_event_record_id, interval, agent_args=''):
+    """
+        Start the agent in streaming mode over an already connected
+        SSH session.
+
+        @ssh - paramiko.SSHClient object, connected to the client
+        @client - dict - configuration of client
+        @last_event_record_id - int - EventRecordID for filtering
+        @interval - int - seconds between samples
+        @agent_args - string - additional command line arguments for the agent
+        @return - agentstream.AgentStream object
+    """
+    destination = _agent_destination(client)
+    _ensure_agent(ssh, client, destination)
+
+    channel = ssh.get_transport().open_session()
+    channel.exec_command("python %s --stream %d %s %d" % (
+        destination, interval, agent_args, last_event_record_id))
+
+    return agentstream.AgentStream(channel, client['ip'])
+
+
+def _stream_worker(client, last_event_record_id, ssh_pool, streams, interval, agent_args=''): # pylint: disable=too-many-arguments
+    """
+        Read the samples which a resident agent has written since the last
+        poll, starting the agent first if it isn't running. A broken stream is
+        closed and started again on the next poll!
+
+        @streams - dict - scheduler.client_key() -> (paramiko.SSHClient,
+                   agentstream.AgentStream)
+        @return - list of metrics dicts
+    """
+    key = scheduler.client_key(client)
+
+    # this also keeps the pooled connection from being evicted as idle
+    ssh = ssh_pool.get(client)
+    try:
+        ssh_used, agent_stream = streams.get(key, (None, None))
+        if ssh_used is not ssh:
+            # the connection was re-established, the old agent is gone with it
+            if agent_stream is not None:
+                agent_stream.close()
+
+            agent_stream = _open_stream(ssh, client, last_event_record_id, interval, agent_args)
+            streams[key] = (ssh, agent_stream)
+
+        try:
+            with instrument.REGISTRY.timed('response', client['ip']):
+                return agent_stream.read_samples()
+        except RuntimeError:
+            _forget_agent(client, _agent_destination(client))
+            del streams[key]
+            agent_stream.close()
+            raise
+        except Exception:
+            del streams[key]
+            agent_stream.close()
+            raise
+    finally:
+        ssh_pool.release(client)
+
+
+def collect_all(clients, last_event_record_ids, concurrency=1, ssh_pool=None, agent_args='', # pylint: disable=too-many-arguments
+                event_drain=None):
+    """
+        Collect metrics from all clients using up to @concurrency
+        parallel SSH sessions. Results are yielded as soon as each client
+        has finished so the caller can write them from a single thread.
+        Errors of a single client are reported and the others are still
+        collected!
+
+        @clients - list - client configuration dicts
+        @last_event_record_ids - dict - client IP -> EventRecordID for filtering
+        @concurrency - int - maximum number of clients polled at the same time
+        @ssh_pool - pool.SSHPool - reuse SSH connections from this pool
+        @agent_args - string - additional command line arguments for the agent
+        @event_drain - drain.EventDrain - collect the event backlog in several rounds
+        @return - generator of (client, metrics) tuples
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {}
+        for client in clients:
+            future = executor.submit(_collect_worker, client,
+                                     last_event_record_ids.get(client['ip'], 0),
+                                     ssh_pool, agent_args, event_drain)
+            futures[future] = client
+
+        for future in as_completed(futures):
+            client = futures[future]
+            try:
+                metrics = future.result()
+            except Exception as err: # pylint: disable=broad-except
+                print('***** POLLING %s FAILED: %s' % (client['ip'], err), file=sys.stderr)
+                continue
+
+            yield client, metrics
+
+
+def save_event_logs(db, system_id, metrics, now):
+    """
+        Save the Windows Security Event logs, if any, to the DB!
+
+        @db - DB session
+        @system_id - int - orm.System.id
+        @metrics - dict - as returned by the agent
+        @now - datetime - when the metrics were collected
+    """
+    if 'security_event_logs' in metrics:
+        writer.save_event_logs(db, system_id, metrics['security_event_logs'], now)
+
+
+def _collected_at(metrics):
+    """
+        Returns when @metrics were collected. Streaming agents send the time
+        of each sample, which is used unless it is in the future b/c the
+        clocks differ. Polls and older agents are stamped with the current
+        time!
+    """
+    now = datetime.now()
+    timestamp = metrics.pop('collected_at', None)
+    if timestamp is None:
+        return now
+
+    try:
+        return min(now, datetime.fromtimestamp(timestamp))
+    except (TypeError, ValueError, OverflowError, OSError):
+        return now
+
+
+def _load_systems(db, clients):
+    """
+        Returns the orm.System ids and the last stored EventRecordIDs
+        of all clients, both keyed by client IP. Unknown systems are
+        created and the ids are kept in memory for the whole run!
+    """
+    systems = orm.ensure_systems(db, [client['ip'] for client in clients])
+
+    windows = [client['ip'] for client in clients if client['platform'] == 'Windows']
+    stored = writer.last_event_record_ids(db, [systems[ip] for ip in windows])
+    last_event_record_ids = dict((ip, stored[systems[ip]]) for ip in windows)
+
+    return systems, last_event_record_ids
+
+
+def _max_event_record_id(metrics, default):
+    """
+        Returns the highest EventRecordID in @metrics or @default!
+    """
+    for event_log in metrics.get('security_event_logs', []):
+        default = max(default, event_log['EventRecordID'])
+    return default
+
+
+def _agent_args(collector_cfg):
+    """
+        Returns the agent command line arguments for @collector_cfg!
+    """
+    args = [
+        '--cpu-samples %d' % collector_cfg['cpu_samples'],
+        '--batch-size %d' % collector_cfg['batch_size'],
+    ]
+    if collector_cfg['nonblocking_cpu']:
+        args.append('--nonblocking')
+    if collector_cfg['ordered_events']:
+        args.append('--ordered-events')
+    if collector_cfg['compress']:
+        args.append('--format zjson')
+
+    return ' '.join(args)
+
+
+def _event_drain(collector_cfg):
+    """
+        Returns the drain.EventDrain object for @collector_cfg
+        or None if draining is disabled!
+    """
+    if not collector_cfg['drain_time']:
+        return None
+
+    return drain.EventDrain(collector_cfg['batch_size'], collector_cfg['drain_time'],
+                            collector_cfg['drain_events'])
+
+
+def _open_spool(db, storage_cfg):
+    """
+        Returns the spool.Spool and the started spool.SpoolFlusher
+        for @storage_cfg or (None, None) if spooling is disabled!
+    """
+    if not storage_cfg['spool']:
+        return None, None
+
+    spooler = spool.Spool(storage_cfg['spool'], storage_cfg['spool_segment_size'] * 1024 * 1024,
+                          storage_cfg['spool_max_size'] * 1024 * 1024, storage_cfg['spool_fsync'])
+    flusher = spool.SpoolFlusher(spooler, db, storage_cfg['flush_size'], storage_cfg['flush_age'],
+                                 storage_cfg['layout'])
+    flusher.start()
+    return spooler, flusher
+
+
+def _store(db, metrics_writer, spooler, client, system_id, metrics, now): # pylint: disable=too-many-arguments
+    """
+        Append the sample of @client to @spooler or, without a spool,
+        buffer its basic metrics and save its event logs to the DB!
+    """
+    if spooler is not None:
+        with instrument.REGISTRY.timed('spool', client['ip']):
+            spooler.append(system_id, metrics, now)
+        return
+
+    metrics_writer.add(system_id, metrics, now)
+    with instrument.REGISTRY.timed('db_events', client['ip']):
+        save_event_logs(db, system_id, metrics, now)
+
+
+def _flush(metrics_writer):
+    """
+        Flush @metrics_writer if needed. Errors are reported and the
+        buffered metrics are retried flush_age seconds later!
+    """
+    if not metrics_writer.should_flush():
+        return
+
+    try:
+        with instrument.REGISTRY.timed('db_flush'):
+            metrics_writer.flush()
+    except Exception as err: # pylint: disable=broad-except
+        print('***** WRITING METRICS FAILED: %s' % err, file=sys.stderr)
+
+
+def _write_self_metrics(db, collector_cfg, written_at=None):
+    """
+        Write the timings of the collector to the configured Prometheus
+        text file and self_metric table, at most every _SELF_METRICS_INTERVAL
+        seconds since @written_at. Errors are reported and ignored!
+
+        @return - float - time of the last write
+    """
+    now = time.time()
+    if written_at is not None and now - written_at < _SELF_METRICS_INTERVAL:
+        return written_at
+
+    try:
+        if collector_cfg['metrics_file']:
+            instrument.REGISTRY.write_textfile(collector_cfg['metrics_file'])
+        if collector_cfg['self_metrics']:
+            instrument.REGISTRY.persist(db, datetime.now())
+    except Exception as err: # pylint: disable=broad-except
+        print('***** WRITING SELF METRICS FAILED: %s' % err, file=sys.stderr)
+
+    return now
+
+
+def _update_rollups(db, storage_cfg, updated_at=None):
+    """
+        Add the newly stored samples to the rollups if they are enabled
+        and the last update, at @updated_at, was long enough ago. Errors are
+        reported and the samples are rolled up on the next call!
+
+        @return - float - time of the last update
+    """
+    now = time.time()
+    if not storage_cfg['rollup_interval']:
+        return now
+
+    if updated_at is not None and now - updated_at < storage_cfg['rollup_interval']:
+        return updated_at
+
+    try:
+        rollup.update_rollups(db, storage_cfg['layout'])
+    except Exception as err: # pylint: disable=broad-except
+        print('***** UPDATING ROLLUPS FAILED: %s' % err, file=sys.stderr)
+
+    return now
+
+
+def _purge(purger):
+    """
+        Purge expired rows if needed. Errors are reported
+        and the purge is retried on the next call!
+    """
+    if not purger.should_purge():
+        return
+
+    try:
+        purger.purge()
+    except Exception as err: # pylint: disable=broad-except
+        print('***** PURGING EXPIRED ROWS FAILED: %s' % err, file=sys.stderr)
+
+
+def _store_all(db, results, systems, metrics_writer, spooler):
+    """
+        Store the (client, metrics) tuples of @results as they arrive!
+        Only the basic metrics are kept for checking the alerts, so the
+        events of a client can be freed as soon as they are stored.
+
+        @systems - dict - client IP -> orm.System.id
+        @return - list - (client, basic metrics) tuples
+    """
+    samples = []
+    for client, metrics in results:
+        _store(db, metrics_writer, spooler, client, systems[client['ip']], metrics,
+               datetime.now())
+        if metrics_writer.should_flush():
+            with instrument.REGISTRY.timed('db_flush'):
+                metrics_writer.flush()
+        samples.append((client, dict((metric, metrics[metric]) for metric in orm.SAMPLE_METRICS
+                                     if metric in metrics)))
+
+    return samples
+
+
+def run_once(db, clients, smtp_cfg, collector_cfg, storage_cfg):
+    """
+        Poll every client once and exit!
+    """
+    systems, last_event_record_ids = _load_systems(db, clients)
+    ssh_pool = pool.SSHPool(collector_cfg['keepalive'], collector_cfg['max_idle'])
+    dispatcher = alerts.AlertDispatcher(smtp_cfg)
+    dispatcher.start()
+    metrics_writer = writer.MetricsWriter(db, storage_cfg['flush_size'], storage_cfg['flush_age'],
+                                         storage_cfg['layout'])
+    spooler, flusher = _open_spool(db, storage_cfg)
+
+    try:
+        # SSH sessions run in parallel, the DB is written only from this thread
+        samples = _store_all(db, collect_all(clients, last_event_record_ids,
+                                             collector_cfg['concurrency'], ssh_pool,
+                                             _agent_args(collector_cfg),
+                                             _event_drain(collector_cfg)),
+                             systems, metrics_writer, spooler)
+
+        # check the alerts of all clients at once
+        with instrument.REGISTRY.timed('alerts'):
+            evaluator = alertengine.FleetEvaluator(clients)
+            alerts.notify(smtp_cfg, evaluator.evaluate(samples), dispatcher)
+    finally:
+        ssh_pool.close()
+        with instrument.REGISTRY.timed('db_flush'):
+            metrics_writer.flush()
+        if flusher is not None:
+            # what can't be written now is written by the next run
+            flusher.stop()
+        # wait until all alerts are sent
+        dispatcher.stop()
+
+    _update_rollups(db, storage_cfg)
+    # expired rows are purged only after they have been rolled up
+    _purge(retention.Retention(db, storage_cfg['retention'], max_time=None))
+    _write_self_metrics(db, collector_cfg)
+
+
+# seconds between writes of the collector's own metrics
+_SELF_METRICS_INTERVAL = 15
+
+
+# client settings which need a new SSH connection and agent when changed
+_CONNECTION_SETTINGS = ['username', 'password', 'platform', 'interval']
+
+
+def _reload_clients(db, config_path, clients, schedule, systems, last_event_record_ids, # pylint: disable=too-many-arguments
+                    sharded=False):
+    """
+        Read the clients from the changed config file and apply the
+        differences to the running daemon. Hosts which didn't change
+        aren't touched. An invalid config is reported and ignored!
+        When @sharded new clients are scheduled by _rebalance() instead.
+
+        @return - (list, list) - the new clients and the old clients whose
+                  connections and agents should be closed
+    """
+    try:
+        _, new_clients = config.load_config(config_path)
+    except RuntimeError as err:
+        print('***** RELOADING %s FAILED: %s' % (config_path, err), file=sys.stderr)
+        return clients, []
+
+    added, removed, updated = config.diff_clients(clients, new_clients, scheduler.client_key)
+
+    if added:
+        _add_systems(db, added, systems, last_event_record_ids)
+
+    retired = _reschedule(schedule, [] if sharded else added, removed, updated)
+
+    print('***** RELOADED %s: %d ADDED, %d REMOVED, %d UPDATED' % (
+        config_path, len(added), len(removed), len(updated)))
+
+    return new_clients, retired
+
+
+def _add_systems(db, clients, systems, last_event_record_ids):
+    """
+        Add the systems of the new @clients to @systems and their last
+        stored EventRecordIDs to @last_event_record_ids, keeping the ones
+        which are tracked already!
+    """
+    new_systems, new_last_ids = _load_systems(db, clients)
+    systems.update(new_systems)
+    for ip, last_id in new_last_ids.items():
+        last_event_record_ids.setdefault(ip, last_id)
+
+
+def _reschedule(schedule, added, removed, updated):
+    """
+        Apply the differences returned by config.diff_clients() to @schedule!
+
+        @return - list - the old clients whose connections and agents
+                  should be closed
+    """
+    now = time.time()
+    for client in added:
+        schedule.add(client, now)
+    for client in removed:
+        schedule.remove(client)
+
+    retired = list(removed)
+    for old, new in updated:
+        schedule.update(new)
+        if any(old[setting] != new[setting] for setting in _CONNECTION_SETTINGS):
+            retired.append(old)
+
+    return retired
+
+
+def _rebalance(db, shard, clients, schedule, busy, retired, systems, # pylint: disable=too-many-arguments
+               last_event_record_ids):
+    """
+        Renew the host leases of this worker and poll exactly the clients
+        it owns. Errors are reported and the leases are renewed on the
+        next call, meanwhile clients are polled until their leases expire!
+
+        Clients which are owned again while their previous poll is still
+        running are scheduled by the first call after that poll is done.
+
+        @shard - sharding.Shard
+        @busy - list - clients being polled
+        @retired - list - clients whose connections and agents should be closed
+        @return - list - @retired without the clients which are owned again,
+                  plus the clients which were given up
+    """
+    try:
+        owned = shard.assign(clients, [client['ip'] for client in busy])
+    except Exception as err: # pylint: disable=broad-except
+        print('***** RENEWING HOST LEASES FAILED: %s' % err, file=sys.stderr)
+        return retired
+
+    owned_by_key = dict((scheduler.client_key(client), client) for client in owned)
+    # a busy client would be polled twice if it was scheduled again
+    pending = set(scheduler.client_key(client) for client in schedule.clients())
+    pending.update(scheduler.client_key(client) for client in busy)
+    acquired = [client for client in owned if scheduler.client_key(client) not in pending]
+    released = [client for client in schedule.clients()
+                if scheduler.client_key(client) not in owned_by_key]
+
+    for client in released:
+        schedule.remove(client)
+
+    if acquired:
+        # the previous owner may have stored newer events meanwhile
+        _reload_event_record_ids(db, acquired, systems, last_event_record_ids)
+
+        for client in acquired:
+            schedule.add(client, time.time())
+
+    if acquired or released:
+        print('***** WORKER %s: %d ACQUIRED, %d RELEASED, %d CLIENTS' % (
+            shard.worker, len(acquired), len(released), len(schedule)))
+
+    # changed clients are still retired by the reload
+    return [client for client in retired
+            if owned_by_key.get(scheduler.client_key(client)) != client] + released
+
+
+def _reload_event_record_ids(db, clients, systems, last_event_record_ids):
+    """
+        Read the last stored EventRecordID of the Windows @clients
+        from the DB into @last_event_record_ids!
+    """
+    windows = [client['ip'] for client in clients if client['platform'] == 'Windows']
+    stored = writer.last_event_record_ids(db, [systems[ip] for ip in windows])
+    for ip in windows:
+        last_event_record_ids[ip] = stored[systems[ip]]
+
+
+def _close_client(client, streams, ssh_pool):
+    """
+        Stop the resident agent of @client and close its SSH connection!
+    """
+    _, agent_stream = streams.pop(scheduler.client_key(client), (None, None))
+    if agent_stream is not None:
+        agent_stream.close()
+    ssh_pool.discard(client)
+
+
+def run_daemon(db, clients, smtp_cfg, collector_cfg, storage_cfg, config_path=None, # pylint: disable=too-many-locals,too-many-arguments,too-many-statements,too-many-branches
+               worker=None):
+    """
+        Poll every client on its own interval until interrupted!
+
+        The DB session, SSH connections and the uploaded agents are kept
+        between polls. Polls run on a thread pool while the results are
+        written to the DB from this thread only. Errors of a single client
+        are reported and don't stop the polling of the others.
+
+        In streaming mode the agent is started once per client and keeps
+        sending samples, each poll only reads what has arrived meanwhile.
+
+        Basic metrics are buffered and written in bulk, at the latest
+        `flush_age` seconds after they were collected. With a `spool`
+        directory samples are appended to a local spool.Spool instead and
+        written to the DB from a background thread, so a slow or unavailable
+        DB doesn't stop the polling.
+
+        When @config_path is given the clients are reloaded whenever
+        the file changes, without restarting the daemon.
+
+        With a @worker name only the share of the clients leased by this
+        worker is polled, see sharding.Shard. Rollups and purges are done
+        by the worker holding the sharding.LEADER lease.
+    """
+    systems, last_event_record_ids = _load_systems(db, clients)
+    ssh_pool = pool.SSHPool(collector_cfg['keepalive'], collector_cfg['max_idle'])
+    executor = ThreadPoolExecutor(max_workers=collector_cfg['concurrency'])
+    # alerts of each interval are sent as one digest per recipient
+    dispatcher = alerts.AlertDispatcher(smtp_cfg, collector_cfg['interval'])
+    dispatcher.start()
+    # keeps the state of the alert rules between polls
+    alert_engine = alertengine.AlertEngine()
+    agent_args = _agent_args(collector_cfg)
+    event_drain = _event_drain(collector_cfg)
+    metrics_writer = writer.MetricsWriter(db, storage_cfg['flush_size'], storage_cfg['flush_age'],
+                                         storage_cfg['layout'])
+    # with a spool samples are written to the DB by a background thread
+    spooler, flusher = _open_spool(db, storage_cfg)
+
+    schedule = scheduler.Scheduler(collector_cfg['interval'], collector_cfg['jitter'])
+    shard = None
+    if worker is not None:
+        # clients are scheduled once their leases are acquired
+        shard = sharding.Shard(db, worker, collector_cfg['lease_time'])
+    else:
+        for client in clients:
+            schedule.add(client, time.time())
+    # leases are renewed three times per lease_time, None means now
+    rebalanced_at = None
+
+    # resident agents, only used in streaming mode
+    streams = {}
+    rolled_up_at = time.time()
+    self_metrics_at = time.time()
+    purger = retention.Retention(db, storage_cfg['retention'])
+
+    watcher = None
+    if config_path is not None:
+        watcher = config.ConfigWatcher(config_path)
+    # clients removed or changed by a reload which are still being polled
+    retired = []
+
+    futures = {}
+    try:
+        while True:
+            if watcher is not None and watcher.changed():
+                clients, changed = _reload_clients(db, config_path, clients, schedule,
+                                                   systems, last_event_record_ids,
+                                                   shard is not None)
+                retired.extend(changed)
+                rebalanced_at = None
+
+            if shard is not None and (rebalanced_at is None or
+                                      time.time() - rebalanced_at >= shard.lease_time / 3.0):
+                retired = _rebalance(db, shard, clients, schedule, futures.values(), retired,
+                                     systems, last_event_record_ids)
+                rebalanced_at = time.time()
+
+            if retired:
+                in_flight = set(scheduler.client_key(client) for client in futures.values())
+                for client in retired:
+                    if scheduler.client_key(client) not in in_flight:
+                        _close_client(client, streams, ssh_pool)
+                        alert_engine.forget(client)
+                retired = [client for client in retired
+                           if scheduler.client_key(client) in in_flight]
+
+            for client in schedule.due(time.time()):
+                if shard is not None and not shard.holds(client['ip']):
+                    # the lease couldn't be renewed, another worker may take over
+                    schedule.remove(client)
+                    continue
+
+                last_event_record_id = last_event_record_ids.get(client['ip'], 0)
+                if collector_cfg['stream']:
+                    future = executor.submit(_stream_worker, client, last_event_record_id,
+                                             ssh_pool, streams,
+                                             client['interval'] or collector_cfg['interval'],
+                                             agent_args)
+                else:
+                    future = executor.submit(_collect_worker, client, last_event_record_id,
+                                             ssh_pool, agent_args, event_drain)
+                futures[future] = client
+
+            timeout = collector_cfg['interval']
+            next_due = schedule.next_due()
+            if next_due is not None:
+                timeout = max(0, next_due - time.time())
+            if len(metrics_writer):
+                timeout = min(timeout, metrics_writer.flush_age)
+            if shard is not None:
+                timeout = max(0, min(timeout, rebalanced_at + shard.lease_time / 3.0 - time.time()))
+
+            if not futures:
+                time.sleep(timeout)
+                _flush(metrics_writer)
+                if shard is None or shard.holds(sharding.LEADER):
+                    rolled_up_at = _update_rollups(db, storage_cfg, rolled_up_at)
+                    _purge(purger)
+                self_metrics_at = _write_self_metrics(db, collector_cfg, self_metrics_at)
+                continue
+
+            finished, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in finished:
+                client = futures.pop(future)
+                try:
+                    samples = future.result()
+                    if not collector_cfg['stream']:
+                        samples = [samples]
+
+                    for metrics in samples:
+                        now = _collected_at(metrics)
+                        _store(db, metrics_writer, spooler, client, systems[client['ip']],
+                               metrics, now)
+                        last_event_record_ids[client['ip']] = _max_event_record_id(
+                            metrics, last_event_record_ids.get(client['ip'], 0))
+
+                        alerts.check_for_alerts(smtp_cfg, client, metrics, dispatcher,
+                                                alert_engine)
+                except Exception as err: # pylint: disable=broad-except
+                    db.rollback()
+                    print('***** POLLING %s FAILED: %s' % (client['ip'], err), file=sys.stderr)
+
+                skipped = schedule.done(client, time.time())
+                if skipped:
+                    print('***** POLLING %s OVERRAN, SKIPPED %d TICKS' % (client['ip'], skipped),
+                          file=sys.stderr)
+
+            _flush(metrics_writer)
+            if shard is None or shard.holds(sharding.LEADER):
+                rolled_up_at = _update_rollups(db, storage_cfg, rolled_up_at)
+                _purge(purger)
+            self_metrics_at = _write_self_metrics(db, collector_cfg, self_metrics_at)
+            ssh_pool.evict_idle()
+    finally:
+        executor.shutdown(wait=False)
+        metrics_writer.flush()
+        if flusher is not None:
+            flusher.stop()
+        for _, agent_stream in streams.values():
+            agent_stream.close()
+        ssh_pool.close()
+        dispatcher.stop()
+        if shard is not None:
+            try:
+                # polls still running keep their leases until they expire
+                shard.leave([client['ip'] for client in futures.values()])
+            except Exception as err: # pylint: disable=broad-except
+                print('***** RELEASING HOST LEASES FAILED: %s' % err, file=sys.stderr)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print('USAGE: server.py path/to/config.xml')
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description='Collect metrics from remote systems')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and poll every client on its interval')
+    parser.add_argument('--worker', metavar='NAME',
+                        help='poll only a share of the clients, together with the other '
+                             'workers using the same DB. Needs --daemon')
+    parser.add_argument('config', help='path/to/config.xml')
+    args = parser.parse_args()
+    if args.worker is not None and not args.daemon:
+        parser.error('--worker needs --daemon')
 
     # parse the XML configuration
-    config_xml = config.parse_config(sys.argv[1])
-    clients = config.parse_clients(config_xml)
+    config_xml, clients = config.load_config(args.config)
     smtp_cfg = config.parse_smtp(config_xml)
+    collector_cfg = config.parse_collector(config_xml)
+    storage_cfg = config.parse_storage(config_xml)
 
     # connect to the DB
-    db = orm.connect(config.parse_db(config_xml))
-
-
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-    for client in clients:
-        system = db.query(orm.System).filter_by(name=client['ip']).first()
-        if not system:
-            system = orm.System(name=client['ip'])
-            db.add(system)
-            db.commit()
-
-        last_event_record_id = 0
-        if client['platform'] == 'Windows':
-            last_event = db.query(orm.WinEventLog).filter_by(
-                system_id=system.id
-            ).order_by(
-                orm.WinEventLog.EventRecordID.desc()
-            ).first()
-
-            if last_event:
-                last_event_record_id = last_event.EventRecordID
-
-
-        metrics = collect_metrics(ssh, client, last_event_record_id)
-        now = datetime.now()
-
-        # save metrics to DB
-        db.add(orm.CpuUsage(system_id=system.id, usage=metrics['cpu'], collected_at=now))
-        db.add(orm.MemUsage(system_id=system.id, usage=metrics['memory'], collected_at=now))
-        db.add(orm.Uptime(system_id=system.id, uptime=metrics['uptime'], collected_at=now))
-        db.commit()
-
-        # check for alerts
-        alerts.check_for_alerts(smtp_cfg, client, metrics)
-
-        # chech for event logs
-        if 'security_event_logs' in metrics:
-            for event_log in metrics['security_event_logs']:
-                event_log['TimeCreated'] = datetime.strptime(
-                    event_log['TimeCreated'],
-                    '%Y-%m-%dT%H:%M:%S.%f'
-                )
-
-                event = db.query(orm.WinEventLog).filter_by(
-                    system_id=system.id,
-                    EventRecordID=event_log['EventRecordID'],
-                    TimeCreated=event_log['TimeCreated']
-                ).first()
-
-                if not event:
-                    event = orm.WinEventLog(**event_log)
-                    event.system_id = system.id
-                    event.collected_at = now
-                    db.add(event)
-            db.commit()
+    db = orm.connect(config.parse_db(config_xml), storage_cfg['value_indexes'])
+
+    if args.daemon:
+        try:
+            run_daemon(db, clients, smtp_cfg, collector_cfg, storage_cfg, args.config,
+                       args.worker)
+        except KeyboardInterrupt:
+            pass
+    else:
+        run_once(db, clients, smtp_cfg, collector_cfg, storage_cfg)
@@ -0,0 +1,200 @@
+import time
+import hashlib
+from datetime import datetime, timedelta
+
+import sqlalchemy as sql
+
+import orm
+
+
+# lease of the worker which runs the fleet wide rollups and purges
+LEADER = '@leader'
+
+# max number of bound parameters in a single IN (...) clause
+_CHUNK = 500
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def rendezvous_owner(host, workers):
+    """
+        Returns the worker among @workers which owns @host by rendezvous,
+        a.k.a. highest random weight, hashing. When a worker joins or leaves
+        only the hosts it gains or loses change their owner!
+    """
+    return max(workers, key=lambda worker: hashlib.sha1(
+        ('%s\n%s' % (worker, host)).encode('utf8')).digest())
+
+
+def _utc(timestamp):
+    """
+        Returns the UTC datetime of the time.time() value @timestamp!
+    """
+    return _EPOCH + timedelta(seconds=timestamp)
+
+
+def _chunks(values):
+    values = sorted(values)
+    for i in range(0, len(values), _CHUNK):
+        yield values[i:i + _CHUNK]
+
+
+class Shard(object):
+    """
+        The share of the clients polled by one of several collector
+        workers which use the same DB.
+
+        Every worker records a heartbeat in orm.CollectorWorker. Workers seen
+        within the last @lease_time seconds are alive and each client is
+        owned by one of them, chosen by rendezvous_owner(). So a stable
+        subset of the clients stays with each worker and only the clients
+        of a worker which joins or dies move.
+
+        A client is polled only while its worker holds an unexpired
+        orm.HostLease for it. A lease is taken over only after the previous
+        worker released it or stopped renewing it for @lease_time seconds,
+        so the same client is never polled by two workers at once. Leases of
+        clients which are being polled are renewed, not released, until the
+        poll is done. A worker which can't renew its leases, e.g. b/c the
+        DB is unavailable, stops polling when they expire locally.
+
+        The clocks of the workers must be in sync, e.g. with NTP, to well
+        below @lease_time.
+    """
+    def __init__(self, db, worker, lease_time=30):
+        """
+            @db - DB session
+            @worker - string - unique name of this worker
+            @lease_time - int - seconds before the leases of a dead worker expire
+        """
+        self.db = db
+        self.worker = worker
+        self.lease_time = lease_time
+
+        # host -> time.time() when the lease of this worker expires
+        self._leases = {}
+
+    def _heartbeat(self, now):
+        table = orm.CollectorWorker.__table__
+        result = self.db.execute(table.update().where(
+            table.c.name == self.worker).values(heartbeat_at=now))
+        if not result.rowcount:
+            self.db.execute(table.insert().values(name=self.worker, heartbeat_at=now))
+
+    def _live_workers(self, now):
+        table = orm.CollectorWorker.__table__
+        workers = set(row[0] for row in self.db.execute(
+            orm.select(table.c.name).where(
+                table.c.heartbeat_at >= now - timedelta(seconds=self.lease_time))))
+        workers.add(self.worker)
+        return workers
+
+    def _release(self, hosts):
+        table = orm.HostLease.__table__
+        for chunk in _chunks(hosts):
+            self.db.execute(table.delete().where(
+                table.c.worker == self.worker).where(table.c.host.in_(chunk)))
+
+    def _renew(self, hosts, now_at, expires_at):
+        """
+            Renew our own leases of @hosts and take over the expired ones!
+
+            @return - (set, set) - the @hosts which have a lease and
+                      those of them which are leased by this worker
+        """
+        table = orm.HostLease.__table__
+        existing = set()
+        held = set()
+        for chunk in _chunks(hosts):
+            self.db.execute(table.update().where(table.c.host.in_(chunk)).where(
+                sql.or_(table.c.worker == self.worker, table.c.expires_at < now_at)
+            ).values(worker=self.worker, expires_at=expires_at))
+
+            for host, worker in self.db.execute(
+                    orm.select(table.c.host, table.c.worker).where(table.c.host.in_(chunk))):
+                existing.add(host)
+                if worker == self.worker:
+                    held.add(host)
+
+        return existing, held
+
+    def assign(self, clients, busy=(), now=None):
+        """
+            Record a heartbeat, release the leases of the clients which are
+            now owned by another worker and acquire or renew the leases of
+            the clients owned by this one!
+
+            @clients - list - as returned by config.parse_clients()
+            @busy - collection of the IPs of the clients being polled,
+                    their leases are renewed even if they aren't owned anymore
+            @now - float - time.time() by default
+            @return - list - the clients this worker should poll
+        """
+        if now is None:
+            now = time.time()
+        now_at = _utc(now)
+        expires_at = _utc(now + self.lease_time)
+
+        table = orm.HostLease.__table__
+        try:
+            self._heartbeat(now_at)
+            workers = self._live_workers(now_at)
+
+            wanted = set(client['ip'] for client in clients
+                         if rendezvous_owner(client['ip'], workers) == self.worker)
+            if rendezvous_owner(LEADER, workers) == self.worker:
+                wanted.add(LEADER)
+
+            mine = set(row[0] for row in self.db.execute(
+                orm.select(table.c.host).where(table.c.worker == self.worker)))
+            keep = wanted | (mine & set(busy))
+            self._release(mine - keep)
+
+            existing, held = self._renew(keep, now_at, expires_at)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+        # hosts which no worker has leased yet, concurrent inserts fail for all but one
+        for host in sorted(keep - existing):
+            try:
+                self.db.execute(table.insert().values(host=host, worker=self.worker,
+                                                      expires_at=expires_at))
+                self.db.commit()
+                held.add(host)
+            except sql.exc.IntegrityError:
+                self.db.rollback()
+
+        self._leases = dict((host, now + self.lease_time) for host in held)
+        # busy clients owned by another worker meanwhile aren't polled again
+        return [client for client in clients
+                if client['ip'] in held and client['ip'] in wanted]
+
+    def holds(self, host, now=None):
+        """
+            Returns True if this worker may poll @host, or run the fleet
+            wide maintenance for LEADER, until @now at least!
+        """
+        if now is None:
+            now = time.time()
+        return self._leases.get(host, 0) > now
+
+    def leave(self, busy=()):
+        """
+            Release all leases, except those of @busy hosts which expire
+            on their own, so other workers can take over immediately!
+        """
+        leases = orm.HostLease.__table__
+        workers = orm.CollectorWorker.__table__
+        try:
+            mine = set(row[0] for row in self.db.execute(
+                orm.select(leases.c.host).where(leases.c.worker == self.worker)))
+            self._release(mine - set(busy))
+            self.db.execute(workers.delete().where(workers.c.name == self.worker))
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+        self._leases = {}
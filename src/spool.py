@@ -0,0 +1,373 @@
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import zlib
+import threading
+
+import sqlalchemy as sql
+
+import writer
+import instrument
+
+
+# when the data written to the spool is forced to disk
+FSYNC_POLICIES = ['always', 'interval', 'never']
+
+_SEGMENT_SUFFIX = '.seg'
+_CHECKPOINT = 'checkpoint'
+
+
+def encode_record(system_id, metrics, collected_at):
+    """
+        Returns one spool line: the CRC32 of the JSON document
+        in hex followed by the document itself!
+    """
+    payload = json.dumps([system_id, collected_at.strftime('%Y-%m-%dT%H:%M:%S.%f'), metrics],
+                         separators=(',', ':')).encode('utf8')
+    return b'%08x %s\n' % (zlib.crc32(payload) & 0xffffffff, payload)
+
+
+def decode_record(line):
+    """
+        Returns (system_id, metrics, collected_at) from a spool @line
+        or None if it is corrupted!
+    """
+    try:
+        checksum, payload = line.rstrip(b'\n').split(b' ', 1)
+        if int(checksum, 16) != zlib.crc32(payload) & 0xffffffff:
+            return None
+        system_id, collected_at, metrics = json.loads(payload.decode('utf8'))
+        return system_id, metrics, writer.parse_time_created(collected_at)
+    except (ValueError, TypeError):
+        return None
+
+
+# the settings, counters and open segment are plain attributes
+# b/c append() runs for every sample and reads most of them
+class Spool(object): # pylint: disable=too-many-instance-attributes
+    """
+        Append-only local log of the collected samples, so that
+        collecting doesn't depend on the DB being fast or available.
+
+        Samples are appended to numbered segment files in @directory.
+        A new segment is started when the current one reaches
+        @segment_size bytes and on every start. With @fsync 'always' each
+        sample is forced to disk before append() returns, with 'interval'
+        at most every @fsync_interval seconds and with 'never' only when
+        the OS decides to.
+
+        read() returns the samples after the checkpoint, which commit()
+        moves forward once they are in the DB, deleting the segments which
+        were read completely. The checkpoint is a file too so the spool is
+        replayed after a restart. A sample may be written to the DB twice if
+        the collector dies between writing it and the checkpoint.
+
+        When the segments take more than @max_size bytes the oldest ones
+        are deleted, even if they haven't been written to the DB, so the
+        disk never fills up while the DB is unavailable.
+    """
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, # pylint: disable=too-many-arguments
+                 max_size=1024 * 1024 * 1024, fsync='interval', fsync_interval=1):
+        if fsync not in FSYNC_POLICIES:
+            raise RuntimeError('Invalid spool fsync policy %s' % fsync)
+
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+
+        # number of samples deleted b/c of max_size and of corrupted lines
+        self.dropped = 0
+        self.corrupted = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        # segment number -> [bytes, records], records are counted once here
+        # and then in append() so that dropping a segment doesn't read it
+        self._segments = dict((number, [os.path.getsize(self._path(number)),
+                                        self._count_records(number)])
+                              for number in self._segment_numbers())
+        self._position = self._read_checkpoint()
+        self._segment = None
+        self._file = None
+        self._synced_at = time.time()
+        self._open_segment(max(list(self._segments) + [self._position[0]]) + 1)
+
+    def _path(self, number):
+        return os.path.join(self.directory, '%020d%s' % (number, _SEGMENT_SUFFIX))
+
+    def _segment_numbers(self):
+        return sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(_SEGMENT_SUFFIX))
+
+    def _count_records(self, number):
+        try:
+            with open(self._path(number), 'rb') as segment:
+                return sum(1 for _ in segment)
+        except (IOError, OSError):
+            return 0
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, _CHECKPOINT)) as checkpoint:
+                position = json.load(checkpoint)
+            return position['segment'], position['offset']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return 0, 0
+
+    def _sync(self, fileobj):
+        fileobj.flush()
+        if self.fsync != 'never':
+            os.fsync(fileobj.fileno())
+        self._synced_at = time.time()
+
+    def _open_segment(self, number):
+        if self._file is not None:
+            self._sync(self._file)
+            self._file.close()
+
+        self._segment = number
+        self._file = open(self._path(number), 'ab')
+        self._segments[number] = [self._file.tell(), 0]
+
+    def _size(self):
+        return sum(size for size, _ in self._segments.values())
+
+    def _enforce_max_size(self):
+        while self._size() > self.max_size and len(self._segments) > 1:
+            number = min(self._segments)
+            path = self._path(number)
+            try:
+                os.remove(path)
+            except (IOError, OSError):
+                pass
+            self.dropped += self._segments.pop(number)[1]
+            print('***** SPOOL IS FULL, DROPPED %s' % path, file=sys.stderr)
+
+    def append(self, system_id, metrics, collected_at):
+        """
+            Write one sample to the spool!
+
+            @system_id - int - orm.System.id
+            @metrics - dict - as returned by the agent
+            @collected_at - datetime - when the metrics were collected
+        """
+        line = encode_record(system_id, metrics, collected_at)
+        with self._lock:
+            self._file.write(line)
+            segment = self._segments[self._segment]
+            segment[0] += len(line)
+            segment[1] += 1
+
+            if self.fsync == 'always' or (self.fsync == 'interval' and
+                                          time.time() - self._synced_at >= self.fsync_interval):
+                self._sync(self._file)
+            else:
+                # so that read() sees it
+                self._file.flush()
+
+            if segment[0] >= self.segment_size:
+                self._open_segment(self._segment + 1)
+                self._enforce_max_size()
+
+    @property
+    def position(self):
+        """
+            The (segment, offset) of the checkpoint!
+        """
+        return self._position
+
+    def size(self):
+        """
+            Returns the number of bytes in the spool!
+        """
+        with self._lock:
+            return self._size()
+
+    def read(self, max_records=1000):
+        """
+            Returns up to @max_records samples after the checkpoint!
+
+            @return - (list of (system_id, metrics, collected_at) tuples,
+                       position to pass to commit() once they are stored)
+        """
+        with self._lock:
+            numbers = sorted(self._segments)
+            current = self._segment
+            # only what is completely written is read from the current segment
+            current_size = self._segments[current][0]
+
+        records = []
+        segment, offset = self._position
+        for number in numbers:
+            if number < segment:
+                continue
+            if number > segment:
+                segment, offset = number, 0
+
+            try:
+                with open(self._path(number), 'rb') as segment_file:
+                    segment_file.seek(offset)
+                    while len(records) < max_records:
+                        if number == current and offset >= current_size:
+                            break
+
+                        line = segment_file.readline()
+                        if not line:
+                            break
+
+                        offset += len(line)
+                        if not line.endswith(b'\n'):
+                            # the last line of a segment which was being written at a crash
+                            self.corrupted += 1
+                            break
+
+                        record = decode_record(line)
+                        if record is None:
+                            self.corrupted += 1
+                        else:
+                            records.append(record)
+            except (IOError, OSError):
+                # deleted by _enforce_max_size() meanwhile
+                continue
+
+            if len(records) >= max_records:
+                break
+
+        return records, (segment, offset)
+
+    def commit(self, position):
+        """
+            Move the checkpoint to @position, as returned by read(),
+            and delete the segments before it!
+        """
+        temp_path = os.path.join(self.directory, '%s.tmp' % _CHECKPOINT)
+        with open(temp_path, 'w') as checkpoint:
+            json.dump({'segment': position[0], 'offset': position[1]}, checkpoint)
+            checkpoint.flush()
+            if self.fsync != 'never':
+                os.fsync(checkpoint.fileno())
+        os.replace(temp_path, os.path.join(self.directory, _CHECKPOINT))
+
+        self._position = position
+        with self._lock:
+            for number in [number for number in self._segments if number < position[0]]:
+                try:
+                    os.remove(self._path(number))
+                except (IOError, OSError):
+                    pass
+                del self._segments[number]
+
+    def close(self):
+        with self._lock:
+            self._sync(self._file)
+            self._file.close()
+
+
+# the settings of writer.MetricsWriter plus the state of the thread
+class SpoolFlusher(object): # pylint: disable=too-many-instance-attributes
+    """
+        Background thread which writes the samples in a Spool to the DB
+        in bulk, every @flush_age seconds and at most @flush_size samples
+        per transaction. If the DB fails the samples stay in the spool and
+        are retried @retry_delay seconds later. At start the samples left
+        in the spool by the previous run are written first.
+    """
+    def __init__(self, spool, db, flush_size=500, flush_age=10, layout='legacy', # pylint: disable=too-many-arguments
+                 retry_delay=5):
+        """
+            @spool - Spool
+            @db - DB session, a new session bound to the same DB is used
+                  b/c sessions must not be shared between threads
+        """
+        self.spool = spool
+        self.db = sql.orm.Session(bind=db.get_bind())
+        self.flush_size = flush_size
+        self.flush_age = flush_age
+        self.layout = layout
+        self.retry_delay = retry_delay
+
+        # number of samples written to the DB
+        self.written = 0
+
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._stopping = False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='spool-flusher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write(self, records):
+        """
+            Store @records, events first so that the basic metrics,
+            which aren't deduplicated, are written only once!
+        """
+        metrics_writer = writer.MetricsWriter(self.db, layout=self.layout)
+        try:
+            for system_id, metrics, collected_at in records:
+                if 'security_event_logs' in metrics:
+                    writer.save_event_logs(self.db, system_id, metrics['security_event_logs'],
+                                           collected_at)
+                metrics_writer.add(system_id, metrics, collected_at)
+            metrics_writer.flush()
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def flush(self):
+        """
+            Write everything in the spool to the DB!
+
+            @return - int - number of written samples
+        """
+        written = 0
+        while True:
+            records, position = self.spool.read(self.flush_size)
+            if records:
+                with instrument.REGISTRY.timed('db_flush'):
+                    self._write(records)
+                written += len(records)
+                self.written += len(records)
+            if position != self.spool.position:
+                self.spool.commit(position)
+            if len(records) < self.flush_size:
+                return written
+
+    def _run(self):
+        # what the previous run left in the spool is written right away
+        delay = 0
+        while True:
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+            # read before flushing so that a stop() during it gets a last flush
+            stopping = self._stopping
+
+            try:
+                self.flush()
+                delay = self.flush_age
+            except Exception as err: # pylint: disable=broad-except
+                print('***** FLUSHING SPOOL FAILED: %s' % err, file=sys.stderr)
+                delay = self.retry_delay
+
+            if stopping:
+                return
+
+    def stop(self):
+        """
+            Write what is left in the spool and stop the thread. What can't
+            be written is left in the spool for the next start!
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.spool.close()
+        self.db.close()
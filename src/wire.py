@@ -0,0 +1,73 @@
+import json
+import zlib
+import base64
+import binascii
+
+# first line of compressed agent responses, see agent.encode_response()
+HEADER = b'MC1 zlib'
+
+# bytes read from the channel at a time
+_CHUNK_SIZE = 65536
+
+
+def _read_compressed(stream):
+    """
+        Base64 decode and decompress the rest of @stream chunk by chunk
+        as it arrives from the channel!
+
+        @return - bytes - the decompressed JSON document
+    """
+    decompressor = zlib.decompressobj()
+    parts = []
+    pending = b''
+
+    while True:
+        chunk = stream.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+
+        pending += b''.join(chunk.split())
+        # base64 can only be decoded in groups of 4 characters
+        usable = len(pending) - len(pending) % 4
+        parts.append(decompressor.decompress(base64.b64decode(pending[:usable])))
+        pending = pending[usable:]
+
+    if pending:
+        raise ValueError('Truncated compressed response')
+
+    parts.append(decompressor.flush())
+    if not decompressor.eof:
+        raise ValueError('Truncated compressed response')
+
+    return b''.join(parts)
+
+
+def decode(stream):
+    """
+        Read and decode an agent response in any of the formats
+        supported by agent.encode_response()!
+
+        @stream - file-like object, e.g. the stdout of exec_command()
+        @return - dict
+    """
+    first_line = stream.readline()
+    # paramiko returns lines as str unless the file is opened in binary mode
+    if not isinstance(first_line, bytes):
+        first_line = first_line.encode('utf8')
+
+    if first_line.strip() != HEADER:
+        return json.loads((first_line + stream.read()).strip().decode('utf8'))
+
+    try:
+        document = _read_compressed(stream)
+    except (binascii.Error, zlib.error) as err:
+        raise ValueError('Invalid compressed response: %s' % err)
+
+    metrics = json.loads(document.decode('utf8'))
+
+    # EventData is stored as JSON string
+    for event_log in metrics.get('security_event_logs', []):
+        if not isinstance(event_log['EventData'], str):
+            event_log['EventData'] = json.dumps(event_log['EventData'])
+
+    return metrics
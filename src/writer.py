@@ -0,0 +1,321 @@
+from __future__ import print_function
+
+import sys
+import time
+import weakref
+from datetime import datetime
+
+import sqlalchemy as sql
+from sqlalchemy.dialects import postgresql
+
+import orm
+
+
+# failed flushes after which MetricsWriter drops the buffered samples
+_MAX_FLUSH_ATTEMPTS = 3
+
+# engine -> True if win_event_log has its unique constraint, checked once per engine
+_EVENT_CONSTRAINTS = weakref.WeakKeyDictionary()
+
+
+def parse_time_created(value):
+    """
+        Convert the TimeCreated string sent by the agent, e.g.
+        '2017-07-01T14:26:05.774505', to datetime. Slicing is several
+        times faster than strptime() which is used only as a fallback!
+    """
+    if isinstance(value, datetime):
+        return value
+
+    if len(value) == 26 and value[10] == 'T':
+        return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                        int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                        int(value[20:26]))
+
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+
+
+def _insert_ignore(db, table):
+    """
+        Returns an INSERT statement for @table which silently skips
+        rows violating a unique constraint, if the dialect supports it!
+    """
+    dialect = db.get_bind().dialect.name
+
+    if dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    if dialect == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+
+    return table.insert()
+
+
+def _has_event_constraint(db):
+    """
+        Returns True if duplicate events are rejected by the DB. Databases
+        created by older versions lack the constraint until migrate.py
+        was run, which is reported once!
+    """
+    bind = db.get_bind()
+    if bind not in _EVENT_CONSTRAINTS:
+        _EVENT_CONSTRAINTS[bind] = orm.has_event_constraint(bind)
+        if not _EVENT_CONSTRAINTS[bind]:
+            print('***** win_event_log HAS NO UNIQUE CONSTRAINT, RUN migrate.py AND RESTART',
+                  file=sys.stderr)
+
+    return _EVENT_CONSTRAINTS[bind]
+
+
+def _existing_events(db, system_id, event_record_ids):
+    """
+        Returns the set of (EventRecordID, TimeCreated) already stored
+        for @system_id among @event_record_ids, with one query per chunk!
+    """
+    table = orm.WinEventLog.__table__
+    event_record_ids = list(event_record_ids)
+
+    existing = set()
+    for i in range(0, len(event_record_ids), orm.LOOKUP_CHUNK):
+        query = orm.select(table.c.EventRecordID, table.c.TimeCreated).where(
+            table.c.system_id == system_id
+        ).where(
+            table.c.EventRecordID.in_(event_record_ids[i:i + orm.LOOKUP_CHUNK])
+        )
+        existing.update((row[0], row[1]) for row in db.execute(query))
+
+    return existing
+
+
+def _max_stored_event_record_id(db, system_id):
+    """
+        Returns the highest EventRecordID in WinEventLog for @system_id or 0!
+    """
+    table = orm.WinEventLog.__table__
+    return db.execute(
+        orm.select(sql.func.max(table.c.EventRecordID)).where(table.c.system_id == system_id)
+    ).scalar() or 0
+
+
+def last_event_record_ids(db, system_ids):
+    """
+        Returns the last stored EventRecordID of each of @system_ids,
+        read from EventWatermark. Systems which have events but no watermark
+        yet, e.g. stored by an older version, get one from WinEventLog!
+
+        @return - dict - {system_id: EventRecordID or 0}
+    """
+    table = orm.EventWatermark.__table__
+    system_ids = list(system_ids)
+
+    last_ids = {}
+    for i in range(0, len(system_ids), orm.LOOKUP_CHUNK):
+        last_ids.update(db.execute(
+            orm.select(table.c.system_id, table.c.last_event_record_id).where(
+                table.c.system_id.in_(system_ids[i:i + orm.LOOKUP_CHUNK])
+            )
+        ).fetchall())
+
+    for system_id in system_ids:
+        if system_id in last_ids:
+            continue
+
+        last_ids[system_id] = _max_stored_event_record_id(db, system_id)
+        if last_ids[system_id]:
+            _set_event_watermark(db, system_id, last_ids[system_id])
+            db.commit()
+
+    return last_ids
+
+
+def _set_event_watermark(db, system_id, event_record_id):
+    """
+        Move the EventWatermark of @system_id up to @event_record_id
+        without committing!
+    """
+    table = orm.EventWatermark.__table__
+    current = db.execute(
+        orm.select(table.c.last_event_record_id).where(table.c.system_id == system_id)
+    ).scalar()
+
+    if current is None:
+        db.execute(table.insert().values(system_id=system_id,
+                                         last_event_record_id=event_record_id))
+    elif current < event_record_id:
+        db.execute(table.update().where(table.c.system_id == system_id).values(
+            last_event_record_id=event_record_id))
+
+
+def save_event_logs(db, system_id, event_logs, collected_at):
+    """
+        Store a batch of Windows Security Event logs, skipping events
+        which are already in the DB, in a single transaction together
+        with the new EventWatermark of the system.
+
+        Duplicates are found with one IN (...) lookup instead of a query per
+        event. The unique constraint on WinEventLog together with a dialect
+        specific INSERT ... ON CONFLICT DO NOTHING protects against the rest,
+        e.g. concurrent writers. Without the constraint only the lookup does.
+
+        @db - DB session
+        @system_id - int - orm.System.id
+        @event_logs - list of event dicts as returned by the agent
+        @collected_at - datetime - when the events were collected
+        @return - int - number of events which weren't stored already
+    """
+    if not event_logs:
+        return 0
+
+    rows = {}
+    for event_log in event_logs:
+        row = dict(event_log)
+        row['TimeCreated'] = parse_time_created(row['TimeCreated'])
+        row['system_id'] = system_id
+        row['collected_at'] = collected_at
+        rows[(row['EventRecordID'], row['TimeCreated'])] = row
+
+    for key in _existing_events(db, system_id, set(key[0] for key in rows)):
+        rows.pop(key, None)
+
+    if rows:
+        try:
+            table = orm.WinEventLog.__table__
+            insert = _insert_ignore(db, table) if _has_event_constraint(db) else table.insert()
+            db.execute(insert, list(rows.values()))
+            _set_event_watermark(db, system_id, max(key[0] for key in rows))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+    return len(rows)
+
+
+class MetricsWriter(object): # pylint: disable=too-many-instance-attributes
+    """
+        Buffers the basic metrics of many clients and writes them
+        with one multi-row INSERT per table in a single transaction,
+        bypassing the ORM unit of work.
+
+        Buffered rows are written when there are at least @flush_size
+        of them or the oldest one is more than @flush_age seconds old.
+        After a failed write they are retried @flush_age seconds later.
+        If writing them fails _MAX_FLUSH_ATTEMPTS times in a row they
+        are dropped, so a DB outage doesn't exhaust the memory.
+
+        With the 'wide' @layout each sample is a single orm.Sample row
+        instead of one row in each of CpuUsage, MemUsage and Uptime.
+    """
+    def __init__(self, db, flush_size=500, flush_age=10, layout='legacy'):
+        """
+            @db - DB session as returned by orm.connect()
+            @flush_size - int - number of samples which triggers a flush
+            @flush_age - int - seconds after which samples are flushed
+            @layout - string - 'legacy' or 'wide'
+        """
+        self.db = db
+        self.flush_size = flush_size
+        self.flush_age = flush_age
+        self.layout = layout
+
+        # buffered rows of each table
+        self._rows = dict((table, []) for table in [orm.CpuUsage.__table__,
+                                                    orm.MemUsage.__table__,
+                                                    orm.Uptime.__table__,
+                                                    orm.Sample.__table__])
+        self._oldest = None
+        self._failures = 0
+        # time before which a failed flush isn't retried
+        self._retry_at = None
+
+    def __len__(self):
+        return len(self._rows[orm.CpuUsage.__table__]) + len(self._rows[orm.Sample.__table__])
+
+    def add(self, system_id, metrics, collected_at):
+        """
+            Buffer the basic metrics of one sample!
+
+            @system_id - int - orm.System.id
+            @metrics - dict - as returned by the agent
+            @collected_at - datetime - when the metrics were collected
+        """
+        if self._oldest is None:
+            self._oldest = time.time()
+
+        if self.layout == 'wide':
+            sample = {'system_id': system_id, 'collected_at': collected_at}
+            for metric in orm.SAMPLE_METRICS:
+                sample[metric] = metrics.get(metric)
+            self._rows[orm.Sample.__table__].append(sample)
+            return
+
+        self._rows[orm.CpuUsage.__table__].append({
+            'system_id': system_id,
+            'usage': metrics['cpu'],
+            'collected_at': collected_at,
+        })
+        self._rows[orm.MemUsage.__table__].append({
+            'system_id': system_id,
+            'usage': metrics['memory'],
+            'collected_at': collected_at,
+        })
+        self._rows[orm.Uptime.__table__].append({
+            'system_id': system_id,
+            'uptime': metrics['uptime'],
+            'collected_at': collected_at,
+        })
+
+    def should_flush(self, now=None):
+        """
+            Returns True if the buffer is full or too old,
+            unless the previous flush failed less than flush_age ago!
+        """
+        if self._oldest is None:
+            return False
+
+        if now is None:
+            now = time.time()
+
+        if self._retry_at is not None and now < self._retry_at:
+            return False
+
+        return len(self) >= self.flush_size or now - self._oldest >= self.flush_age
+
+    def _clear(self):
+        for rows in self._rows.values():
+            del rows[:]
+        self._oldest = None
+        self._failures = 0
+        self._retry_at = None
+
+    def flush(self):
+        """
+            Write all buffered samples in one transaction!
+            If writing fails the samples are kept for the next flush,
+            unless it failed _MAX_FLUSH_ATTEMPTS times already.
+
+            @return - int - number of written samples
+        """
+        if not len(self): # pylint: disable=len-as-condition
+            return 0
+
+        try:
+            for table, rows in self._rows.items():
+                if rows:
+                    self.db.execute(table.insert(), rows)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            self._failures += 1
+            self._retry_at = time.time() + self.flush_age
+            if self._failures >= _MAX_FLUSH_ATTEMPTS:
+                print('***** DROPPED %d SAMPLES AFTER %d FAILED WRITES' % (
+                    len(self), self._failures), file=sys.stderr)
+                self._clear()
+            raise
+
+        count = len(self)
+        self._clear()
+
+        return count
@@ -1,20 +1,16 @@
+import io
+import os
+import collections
 import json
 import platform
+import tempfile
+import time
 import unittest
+import unittest.mock
 
 import agent
 
-class BasicMetricsTestCase(unittest.TestCase):
-    def test_basic_metrics_returns_dict(self):
-        metrics = agent.basic_metrics()
-        self.assertTrue(metrics['uptime'] > 0)
-        self.assertTrue(metrics['cpu'] >= 0)
-        self.assertTrue(metrics['memory'] > 0)
-        self.assertEqual(platform.system(), metrics['system'])
-
-class ParseEventXMLTestCase(unittest.TestCase):
-    def test_parse_valid(self):
-        xml = """<Event xmlns='http://schemas.microsoft.com/win/2004/08/events/event'>
+EVENT_XML = """<Event xmlns='http://schemas.microsoft.com/win/2004/08/events/event'>
     <System>
         <Provider Name='Microsoft-Windows-Security-Auditing' Guid='{54849625-5478-4994-A5BA-3E3B0328C30D}'/>
         <EventID>4672</EventID>
@@ -43,7 +39,57 @@ temEnvironmentPrivilege\r\n\t\t\tSeImpersonatePrivilege\r\n\t\t\tSeDelegateSessi
     </EventData>
 </Event>"""
 
-        event = agent.parse_event_xml(xml)
+
+class BasicMetricsTestCase(unittest.TestCase):
+    def test_basic_metrics_returns_dict(self):
+        metrics = agent.basic_metrics()
+        self.assertTrue(metrics['uptime'] > 0)
+        self.assertTrue(metrics['cpu'] >= 0)
+        self.assertTrue(metrics['memory'] > 0)
+        self.assertEqual(platform.system(), metrics['system'])
+
+class CpuPercentTestCase(unittest.TestCase):
+    def test_cpu_percent_between(self):
+        self.assertEqual(25.0, agent.cpu_percent_between((10, 100), (20, 140)))
+
+    def test_cpu_percent_between_after_reboot(self):
+        self.assertIsNone(agent.cpu_percent_between((10, 100), (1, 5)))
+        self.assertIsNone(agent.cpu_percent_between((10, 100), (10, 100)))
+
+    def test_guest_time_is_counted_once(self):
+        times = collections.namedtuple('scputimes', [
+            'user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal', 'guest',
+            'guest_nice'])
+        # guest and guest_nice are included in user and nice
+        with unittest.mock.patch('psutil.cpu_times',
+                                 return_value=times(50, 10, 20, 100, 20, 0, 0, 0, 40, 10)):
+            self.assertEqual((80, 200), agent.cpu_snapshot())
+
+    def test_nonblocking_cpu_percent_uses_previous_run(self):
+        _, path = tempfile.mkstemp(prefix='agent-cpu-times.json-')
+        os.remove(path)
+
+        # no baseline on the first run
+        self.assertIsNone(agent.nonblocking_cpu_percent(path))
+
+        with unittest.mock.patch('agent.cpu_snapshot', return_value=(1e12, 4e12)):
+            self.assertEqual(25.0, agent.nonblocking_cpu_percent(path))
+        os.remove(path)
+
+    def test_cpu_baseline_is_kept_next_to_the_agent(self):
+        self.assertEqual(os.path.dirname(os.path.abspath(agent.__file__)),
+                         os.path.dirname(agent.CPU_BASELINE_PATH))
+
+    def test_basic_metrics_uses_given_cpu(self):
+        with unittest.mock.patch('psutil.cpu_percent') as cpu_percent:
+            metrics = agent.basic_metrics(12.5)
+        cpu_percent.assert_not_called()
+        self.assertEqual(12.5, metrics['cpu'])
+
+
+class ParseEventXMLTestCase(unittest.TestCase):
+    def test_parse_valid(self):
+        event = agent.parse_event_xml(EVENT_XML)
         for key in ['EventID', 'Version', 'Level', 'Task', 'Opcode', 'Keywords', 'TimeCreated',
                     'EventRecordID', 'Correlation', 'ProcessID', 'EventData']:
             self.assertIn(key, event)
@@ -53,6 +99,80 @@ temEnvironmentPrivilege\r\n\t\t\tSeImpersonatePrivilege\r\n\t\t\tSeDelegateSessi
         self.assertIsNot({}, event_data)
 
 
+class ParseEventXMLBatchTestCase(unittest.TestCase):
+    def test_same_as_parse_event_xml(self):
+        xmls = [EVENT_XML.replace('47822', str(i)) for i in range(47822, 47832)]
+
+        events = list(agent.parse_event_xml_batch(xmls))
+        self.assertEqual(10, len(events))
+        for xml, event in zip(xmls, events):
+            self.assertEqual(agent.parse_event_xml(xml), event)
+
+    def test_values(self):
+        event = next(agent.parse_event_xml_batch([EVENT_XML]))
+        self.assertEqual(4672, event['EventID'])
+        self.assertEqual(47822, event['EventRecordID'])
+        self.assertEqual(708, event['ProcessID'])
+        self.assertEqual('0x8020000000000000', event['Keywords'])
+        self.assertEqual('EC2AMAZ-BBN7IEM', event['Computer'])
+        self.assertIsNone(event['Security'])
+        self.assertEqual('2017-07-01T14:26:05.774505', event['TimeCreated'])
+        self.assertEqual('{9675755E-F26F-0000-8275-75966FF2D201}', event['Correlation'])
+
+        event_data = json.loads(event['EventData'])
+        self.assertEqual('SYSTEM', event_data['SubjectUserName'])
+        self.assertIsInstance(event_data['PrivilegeList'], list)
+
+    def test_correlation_without_activity_id(self):
+        xml = EVENT_XML.replace(
+            "<Correlation ActivityID='{9675755E-F26F-0000-8275-75966FF2D201}'/>", '<Correlation/>')
+        event = next(agent.parse_event_xml_batch([xml]))
+        self.assertIsNone(event['Correlation'])
+
+
+def _event_xml(event_record_id):
+    return EVENT_XML.replace('47822', str(event_record_id))
+
+
+class SelectLowestEventsTestCase(unittest.TestCase):
+    def test_selects_lowest_sorted(self):
+        xmls = [_event_xml(i) for i in [7, 3, 9, 1, 5, 8, 2]]
+
+        events = agent.select_lowest_events(xmls, 3)
+        self.assertEqual([1, 2, 3], [evt['EventRecordID'] for evt in events])
+        self.assertEqual(agent.parse_event_xml(_event_xml(1)), events[0])
+
+    def test_fewer_events_than_batch_size(self):
+        events = agent.select_lowest_events([_event_xml(2), _event_xml(1)], 1000)
+        self.assertEqual([1, 2], [evt['EventRecordID'] for evt in events])
+
+    def test_duplicates_are_returned_once(self):
+        xmls = [_event_xml(i) for i in [4, 1, 4, 2, 1]]
+
+        events = agent.select_lowest_events(xmls, 3)
+        self.assertEqual([1, 2, 4], [evt['EventRecordID'] for evt in events])
+
+    def test_zero_batch_size(self):
+        self.assertEqual([], agent.select_lowest_events([_event_xml(1)], 0))
+
+    def test_ordered_stops_reading(self):
+        def _xmls():
+            for i in range(1, 4):
+                yield _event_xml(i)
+            raise AssertionError('read past the batch')
+
+        events = agent.select_lowest_events(_xmls(), 2, ordered=True)
+        self.assertEqual([1, 2], [evt['EventRecordID'] for evt in events])
+
+    def test_only_selected_events_are_parsed(self):
+        xmls = [_event_xml(i) for i in range(100, 0, -1)]
+
+        with unittest.mock.patch('agent._parse_event_element',
+                                 wraps=agent._parse_event_element) as parse: # pylint: disable=protected-access
+            agent.select_lowest_events(xmls, 5)
+        self.assertEqual(5, parse.call_count)
+
+
 class WindowsEventLogsTestCase(unittest.TestCase):
     def test_returns_no_more_than_1000(self):
         if platform.system() != 'Windows':
@@ -81,3 +201,62 @@ class MainTestCase(unittest.TestCase):
 
         if platform.system() == 'Windows':
             self.assertTrue(len(metrics['security_event_logs']) <= 1000)
+
+    def test_events_only(self):
+        metrics = json.loads(agent.main(['', '--events-only', '--batch-size', 10, 12345]))
+
+        self.assertNotIn('cpu', metrics)
+        self.assertEqual(platform.system(), metrics['system'])
+        if platform.system() == 'Windows':
+            self.assertTrue(len(metrics['security_event_logs']) <= 10)
+
+
+class StreamTestCase(unittest.TestCase):
+    def test_writes_one_json_document_per_line(self):
+        out = io.StringIO()
+        agent.stream(0, 0, out, count=2)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(2, len(lines))
+        for line in lines:
+            metrics = json.loads(line)
+            self.assertEqual(platform.system(), metrics['system'])
+            self.assertTrue(time.time() - 60 < metrics['collected_at'] <= time.time())
+
+    def test_reports_cpu_min_and_max(self):
+        out = io.StringIO()
+        agent.stream(1, 0, out, count=2, cpu_samples=2)
+
+        metrics = json.loads(out.getvalue().splitlines()[1])
+        self.assertTrue(metrics['cpu_min'] <= metrics['cpu_max'])
+
+    def test_stops_when_reader_goes_away(self):
+        out = unittest.mock.Mock()
+        out.write.side_effect = BrokenPipeError()
+
+        # returns instead of looping forever
+        agent.stream(0, 0, out)
+        self.assertEqual(1, out.write.call_count)
+
+
+class ParseArgsTestCase(unittest.TestCase):
+    def test_defaults(self):
+        args = agent._parse_args(['agent.py']) # pylint: disable=protected-access
+        self.assertEqual(0, args.last_event_record_id)
+        self.assertIsNone(args.stream)
+
+    def test_stream(self):
+        args = agent._parse_args(['agent.py', '--stream', '30', 12345]) # pylint: disable=protected-access
+        self.assertEqual(12345, args.last_event_record_id)
+        self.assertEqual(30, args.stream)
+
+    def test_batch_size(self):
+        args = agent._parse_args(['agent.py', 12345]) # pylint: disable=protected-access
+        self.assertEqual(1000, args.batch_size)
+        self.assertFalse(args.events_only)
+
+        # the last --batch-size wins, the server relies on that
+        args = agent._parse_args(['agent.py', '--batch-size', '10', '--events-only', # pylint: disable=protected-access
+                                  '--batch-size', '50', 12345])
+        self.assertEqual(50, args.batch_size)
+        self.assertTrue(args.events_only)
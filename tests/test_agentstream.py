@@ -0,0 +1,42 @@
+import unittest
+import unittest.mock
+
+import agentstream
+
+def _channel(chunks, exited=False, stderr=b''):
+    channel = unittest.mock.Mock()
+    channel.closed = False
+    channel.recv_ready.side_effect = lambda: bool(chunks)
+    channel.recv.side_effect = lambda size: chunks.pop(0)
+    channel.recv_stderr_ready.return_value = bool(stderr)
+    channel.recv_stderr.return_value = stderr
+    channel.exit_status_ready.return_value = exited
+    return channel
+
+
+class AgentStreamTestCase(unittest.TestCase):
+    def test_reads_complete_lines(self):
+        chunks = [b'{"cpu": 1}\n{"cpu"', b': 2}\n{"cpu": ']
+        agent_stream = agentstream.AgentStream(_channel(chunks), 'localhost')
+
+        self.assertEqual([{'cpu': 1}, {'cpu': 2}], agent_stream.read_samples())
+
+        # the incomplete sample is returned once the rest of it arrives
+        chunks.append(b'3}\n')
+        self.assertEqual([{'cpu': 3}], agent_stream.read_samples())
+
+    def test_nothing_received_yet(self):
+        agent_stream = agentstream.AgentStream(_channel([]), 'localhost')
+        self.assertEqual([], agent_stream.read_samples())
+
+    def test_exited_agent_raises(self):
+        agent_stream = agentstream.AgentStream(_channel([], exited=True), 'localhost')
+        with self.assertRaisesRegex(EOFError, 'Agent stream on localhost has exited'):
+            agent_stream.read_samples()
+
+    def test_errors_are_raised(self):
+        channel = _channel([], stderr=b'ImportError: No module named psutil\n')
+        agent_stream = agentstream.AgentStream(channel, 'localhost')
+        with self.assertRaisesRegex(RuntimeError,
+                                    'Execution on localhost failed with:\nImportError'):
+            agent_stream.read_samples()
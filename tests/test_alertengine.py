@@ -0,0 +1,106 @@
+import unittest
+import unittest.mock
+
+import alertengine
+
+
+def _client(**rule):
+    cpu = {'limit': 50, 'samples': 1, 'for': 0, 'resolve': 50, 'repeat': 0}
+    cpu.update(rule)
+    return {'ip': '10.0.0.1', 'alert_rules': {'cpu': cpu}}
+
+
+class AlertEngineTestCase(unittest.TestCase):
+    def _run(self, client, values, step=60):
+        engine = alertengine.AlertEngine()
+        return [engine.evaluate(client, {'cpu': value}, now=i * step)
+                for i, value in enumerate(values)]
+
+    def test_notifies_once_while_firing(self):
+        self.assertEqual([[], [('cpu', 60)], [], [], []],
+                         self._run(_client(), [10, 60, 70, 80, 60]))
+
+    def test_average_over_samples(self):
+        # a single spike doesn't fire
+        self.assertEqual([[]] * 5, self._run(_client(samples=3), [10, 100, 10, 10, 10]))
+
+        result = self._run(_client(samples=3), [10, 100, 60, 60])
+        self.assertEqual([[], [], [('cpu', 170 / 3.0)], []], result)
+
+    def test_for_duration(self):
+        client = _client(**{'for': 120})
+        self.assertEqual([[], [], [('cpu', 80)], [], []],
+                         self._run(client, [60, 70, 80, 90, 95]))
+
+        # dropping below the limit restarts the timer
+        self.assertEqual([[], [], [], [], [], [('cpu', 95)]],
+                         self._run(client, [60, 70, 10, 80, 90, 95]))
+
+    def test_hysteresis(self):
+        client = _client(resolve=30)
+        # 40 is under the limit but doesn't resolve so 60 isn't notified again
+        self.assertEqual([[('cpu', 60)], [], [], [], [('cpu', 60)]],
+                         self._run(client, [60, 40, 60, 20, 60]))
+
+    def test_repeat(self):
+        client = _client(repeat=120)
+        self.assertEqual([[('cpu', 60)], [], [('cpu', 60)], [], [('cpu', 60)]],
+                         self._run(client, [60] * 5))
+
+    def test_series_are_per_client(self):
+        engine = alertengine.AlertEngine()
+        other = dict(_client(), ip='10.0.0.2')
+
+        self.assertEqual([('cpu', 60)], engine.evaluate(_client(), {'cpu': 60}, now=0))
+        self.assertEqual([('cpu', 60)], engine.evaluate(other, {'cpu': 60}, now=0))
+
+        engine.forget(other)
+        self.assertEqual([('cpu', 60)], engine.evaluate(other, {'cpu': 60}, now=60))
+        self.assertEqual([], engine.evaluate(_client(), {'cpu': 60}, now=60))
+
+    def test_missing_metric_is_ignored(self):
+        engine = alertengine.AlertEngine()
+        self.assertEqual([], engine.evaluate(_client(), {'memory': 90}))
+
+
+def _fleet_client(ip, **limits):
+    return {'ip': ip, 'alerts': limits}
+
+
+class FleetEvaluatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clients = [
+            _fleet_client('10.0.0.1', cpu=50, memory=80),
+            _fleet_client('10.0.0.2', uptime=1000),
+            _fleet_client('10.0.0.3'),
+        ]
+        self.samples = [
+            (self.clients[0], {'cpu': 60, 'memory': 80, 'uptime': 5000}),
+            (self.clients[1], {'cpu': 99, 'memory': 99, 'uptime': 5000}),
+            (self.clients[2], {'cpu': 99, 'memory': 99, 'uptime': 5000}),
+            (self.clients[0], {'cpu': 10, 'memory': 90, 'uptime': 5000}),
+            # missing metrics never alert
+            (self.clients[0], {'memory': 10, 'uptime': 5000}),
+            # unknown clients are ignored
+            (_fleet_client('10.0.0.4', cpu=1), {'cpu': 99}),
+        ]
+        self.expected = [
+            (self.clients[0], self.samples[0][1], 'cpu'),
+            (self.clients[1], self.samples[1][1], 'uptime'),
+            (self.clients[0], self.samples[3][1], 'memory'),
+        ]
+
+    def test_pure_python(self):
+        with unittest.mock.patch('alertengine.numpy', None):
+            evaluator = alertengine.FleetEvaluator(self.clients)
+        self.assertEqual(self.expected, evaluator.evaluate(self.samples))
+
+    @unittest.skipIf(alertengine.numpy is None, 'NumPy is not installed')
+    def test_numpy(self):
+        evaluator = alertengine.FleetEvaluator(self.clients)
+        self.assertEqual(self.expected, evaluator.evaluate(self.samples))
+
+    def test_no_alerts(self):
+        evaluator = alertengine.FleetEvaluator([_fleet_client('10.0.0.1')])
+        self.assertEqual([], evaluator.evaluate([(_fleet_client('10.0.0.1'), {'cpu': 99})]))
+        self.assertEqual([], alertengine.FleetEvaluator([]).evaluate([]))
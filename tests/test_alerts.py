@@ -1,7 +1,10 @@
 import unittest
 import unittest.mock
+import time
+import smtplib
 
 import alerts
+import alertengine
 
 class AlertsTestCase(unittest.TestCase):
 
@@ -82,3 +85,139 @@ limits!""")
 
         with self.assertRaises(ConnectionRefusedError):
             alerts.check_for_alerts(smtp, client, metrics)
+
+
+SMTP_CFG = {
+    'from': 'testing@example.com',
+    'host': 'smtp.example.com',
+    'port': 587,
+    'username': 'tester',
+    'password': 's3cr3t',
+    'starttls': True,
+}
+
+
+class AlertDispatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = unittest.mock.patch('smtplib.SMTP')
+        self.smtp_class = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.smtp = self.smtp_class.return_value
+
+    def _sent(self):
+        return [(call[0][0]['To'], call[0][0]['Subject'], call[0][0].get_content())
+                for call in self.smtp.send_message.call_args_list]
+
+    def test_sends_digest_per_recipient_over_one_session(self):
+        dispatcher = alerts.AlertDispatcher(SMTP_CFG)
+        dispatcher.start()
+        dispatcher.submit('a@example.com', 'cpu too high', 'cpu is 90')
+        dispatcher.submit('b@example.com', 'memory too high', 'memory is 95')
+        dispatcher.submit('a@example.com', 'memory too high', 'memory is 80')
+        dispatcher.flush()
+        dispatcher.submit('a@example.com', 'uptime too high', 'uptime is 100')
+        dispatcher.stop()
+
+        sent = sorted(self._sent())
+        self.assertEqual(3, len(sent))
+        self.assertEqual(('a@example.com', 'Monitoring warning: 2 alerts'), sent[0][:2])
+        self.assertIn('cpu is 90', sent[0][2])
+        self.assertIn('memory is 80', sent[0][2])
+        self.assertEqual(('a@example.com', 'uptime too high'), sent[1][:2])
+        self.assertEqual(('b@example.com', 'memory too high'), sent[2][:2])
+
+        # logged in only once
+        self.smtp_class.assert_called_once_with('smtp.example.com', 587)
+        self.smtp.starttls.assert_called_once_with()
+        self.smtp.login.assert_called_once_with('tester', 's3cr3t')
+        self.smtp.quit.assert_called_once_with()
+
+    def test_cycle_delivers_without_flush(self):
+        dispatcher = alerts.AlertDispatcher(SMTP_CFG, cycle=0.1)
+        dispatcher.start()
+        dispatcher.submit('a@example.com', 'cpu too high', 'cpu is 90')
+
+        for _ in range(50):
+            if dispatcher.sent:
+                break
+            time.sleep(0.1)
+
+        self.assertEqual(1, dispatcher.sent)
+        dispatcher.stop()
+
+    def test_retries_and_reconnects(self):
+        self.smtp.send_message.side_effect = [smtplib.SMTPServerDisconnected('gone'), None]
+
+        dispatcher = alerts.AlertDispatcher(SMTP_CFG, retry_delay=0)
+        dispatcher.start()
+        dispatcher.submit('a@example.com', 'cpu too high', 'cpu is 90')
+        dispatcher.stop()
+
+        self.assertEqual(1, dispatcher.sent)
+        self.assertEqual(2, self.smtp_class.call_count)
+
+    def test_gives_up_after_retries(self):
+        self.smtp_class.side_effect = ConnectionRefusedError()
+
+        dispatcher = alerts.AlertDispatcher(SMTP_CFG, retries=2, retry_delay=0)
+        dispatcher.start()
+        dispatcher.submit('a@example.com', 'cpu too high', 'cpu is 90')
+        with unittest.mock.patch('sys.stderr'):
+            dispatcher.stop()
+
+        self.assertEqual(0, dispatcher.sent)
+        self.assertEqual(3, self.smtp_class.call_count)
+
+    def test_full_queue_drops_alerts(self):
+        dispatcher = alerts.AlertDispatcher(SMTP_CFG, queue_size=2)
+        self.assertTrue(dispatcher.submit('a@example.com', 'one', 'one'))
+        self.assertTrue(dispatcher.submit('a@example.com', 'two', 'two'))
+        self.assertFalse(dispatcher.submit('a@example.com', 'three', 'three'))
+        self.assertEqual(1, dispatcher.dropped)
+
+        dispatcher.start()
+        dispatcher.stop()
+        self.assertEqual([('a@example.com', 'Monitoring warning: 2 alerts')],
+                         [sent[:2] for sent in self._sent()])
+
+    def test_check_for_alerts_uses_dispatcher(self):
+        client = {
+            'ip': 'localhost',
+            'mail': 'atodorov@example.com',
+            'alerts': {
+                'cpu': 30,
+            }
+        }
+        dispatcher = unittest.mock.Mock()
+
+        alerts.check_for_alerts(SMTP_CFG, client, {'cpu': 50}, dispatcher)
+        dispatcher.submit.assert_called_once_with(
+            'atodorov@example.com',
+            'Monitoring warning for localhost: cpu too high',
+            """cpu usage of 50 is greater than configured limit of 30!
+
+Check-out what's going on with the system or increase the
+limits!""")
+        self.smtp_class.assert_not_called()
+
+
+class AlertEngineIntegrationTestCase(unittest.TestCase):
+    @unittest.mock.patch('alerts._send_alert')
+    def test_engine_decides_and_reports_average(self, _send_alert): # pylint: disable=no-self-use
+        client = {
+            'ip': 'localhost',
+            'alerts': {'cpu': 30},
+            'alert_rules': {
+                'cpu': {'limit': 30, 'samples': 2, 'for': 0, 'resolve': 30, 'repeat': 0},
+            },
+        }
+        engine = alertengine.AlertEngine()
+
+        alerts.check_for_alerts({}, client, {'cpu': 50, 'memory': 75}, engine=engine)
+        _send_alert.assert_not_called()
+
+        alerts.check_for_alerts({}, client, {'cpu': 20, 'memory': 75}, engine=engine)
+        _send_alert.assert_called_once_with({}, client, {'cpu': 35, 'memory': 75}, 'cpu')
+
+        alerts.check_for_alerts({}, client, {'cpu': 50, 'memory': 75}, engine=engine)
+        self.assertEqual(1, _send_alert.call_count)
@@ -1,3 +1,4 @@
+import os
 import tempfile
 import unittest
 import xml.etree.ElementTree as ET
@@ -77,6 +78,125 @@ class ParseDBTestCase(unittest.TestCase):
         self.assertEqual('sqlite:////tmp/example.db', connection)
 
 
+class ParseStorageTestCase(unittest.TestCase):
+    def test_defaults(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <database connection="sqlite:////tmp/example.db" />
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        storage = config.parse_storage(xml_root)
+        self.assertEqual(500, storage['flush_size'])
+        self.assertEqual(10, storage['flush_age'])
+        self.assertEqual('legacy', storage['layout'])
+        self.assertEqual(60, storage['rollup_interval'])
+        self.assertEqual({}, storage['retention'])
+        self.assertFalse(storage['value_indexes'])
+        self.assertIsNone(storage['spool'])
+        self.assertEqual('interval', storage['spool_fsync'])
+        self.assertEqual(16, storage['spool_segment_size'])
+        self.assertEqual(1024, storage['spool_max_size'])
+
+    def test_invalid_flush_size(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <database connection="sqlite:////tmp/example.db" flush_size="0" />
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        with self.assertRaisesRegex(RuntimeError, 'Invalid <database> attribute flush_size'):
+            config.parse_storage(xml_root)
+
+    def test_invalid_layout(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <database connection="sqlite:////tmp/example.db" layout="narrow" />
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        with self.assertRaisesRegex(RuntimeError, 'Invalid <database> attribute layout'):
+            config.parse_storage(xml_root)
+
+    def test_invalid_rollup_interval(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <database connection="sqlite:////tmp/example.db" rollup_interval="-1" />
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        with self.assertRaisesRegex(RuntimeError, 'Invalid <database> attribute rollup_interval'):
+            config.parse_storage(xml_root)
+
+    def test_invalid_retention_table(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <database connection="sqlite:////tmp/example.db">
+        <retention table="system" days="30" />
+    </database>
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        with self.assertRaisesRegex(RuntimeError, 'Invalid <retention> attribute table'):
+            config.parse_storage(xml_root)
+
+    def test_invalid_retention_days(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <database connection="sqlite:////tmp/example.db">
+        <retention table="win_event_log" days="0" />
+    </database>
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        with self.assertRaisesRegex(RuntimeError,
+                                    'Invalid <retention> attribute days for win_event_log'):
+            config.parse_storage(xml_root)
+
+    def test_valid(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <database connection="sqlite:////tmp/example.db" flush_size="1000" flush_age="30"
+              layout="wide" rollup_interval="0" value_indexes="yes"
+              spool="/var/spool/collector" spool_fsync="always" spool_segment_size="4"
+              spool_max_size="256">
+        <retention table="win_event_log" days="30" />
+        <retention table="sample" days="365" />
+    </database>
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        storage = config.parse_storage(xml_root)
+        self.assertEqual(1000, storage['flush_size'])
+        self.assertEqual(30, storage['flush_age'])
+        self.assertEqual('wide', storage['layout'])
+        self.assertEqual(0, storage['rollup_interval'])
+        self.assertEqual({'win_event_log': 30, 'sample': 365}, storage['retention'])
+        self.assertTrue(storage['value_indexes'])
+        self.assertEqual('/var/spool/collector', storage['spool'])
+        self.assertEqual('always', storage['spool_fsync'])
+        self.assertEqual(4, storage['spool_segment_size'])
+        self.assertEqual(256, storage['spool_max_size'])
+
+    def test_invalid_spool_fsync(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <database connection="sqlite:////tmp/example.db" spool="/tmp/spool" spool_fsync="sometimes" />
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        with self.assertRaisesRegex(RuntimeError, 'Invalid <database> attribute spool_fsync'):
+            config.parse_storage(xml_root)
+
+
 class ParseSMTPTestCase(unittest.TestCase):
     def test_missing_smtp_tag(self):
         xml = """<?xml version="1.0" encoding="UTF-8"?>
@@ -207,6 +327,59 @@ class ParseClientsTestCase(unittest.TestCase):
         self.assertEqual('example', clients[0]['password'])
         self.assertEqual('atodorov@example.com', clients[0]['mail'])
         self.assertEqual({}, clients[0]['alerts'])
+        # interval defaults to the <collector> setting
+        self.assertIsNone(clients[0]['interval'])
+
+    def test_client_interval(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <client
+        ip='localhost'
+        username='atodorov'
+        password='example'
+        mail='atodorov@example.com'
+        platform='Linux'
+        interval='15' />
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        clients = config.parse_clients(xml_root)
+        self.assertEqual(15, clients[0]['interval'])
+
+    def test_invalid_client_interval(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <client
+        ip='localhost'
+        username='atodorov'
+        password='example'
+        mail='atodorov@example.com'
+        platform='Linux'
+        interval='0' />
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        with self.assertRaisesRegex(RuntimeError, 'Invalid attribute interval for .*<client.*'):
+            config.parse_clients(xml_root)
+
+    def test_invalid_client_port(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <client
+        ip='localhost'
+        port='22x'
+        username='atodorov'
+        password='example'
+        mail='atodorov@example.com'
+        platform='Linux' />
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        with self.assertRaisesRegex(RuntimeError, 'Invalid attribute port for .*<client.*'):
+            config.parse_clients(xml_root)
 
     def test_valid_with_alerts(self):
         xml = """<?xml version="1.0" encoding="UTF-8"?>
@@ -239,6 +412,47 @@ class ParseClientsTestCase(unittest.TestCase):
         self.assertEqual('Linux', clients[0]['platform'])
         self.assertEqual('Windows', clients[1]['platform'])
         self.assertEqual({'memory': 80, 'cpu': 50}, clients[0]['alerts'])
+        # a sample over the limit notifies once
+        self.assertEqual({'limit': 50, 'samples': 1, 'for': 0, 'resolve': 50, 'repeat': 0},
+                         clients[0]['alert_rules']['cpu'])
+
+    def test_alert_rule_attributes(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <client
+        ip='localhost'
+        username='atodorov'
+        password='example'
+        mail='atodorov@example.com'
+        platform='Linux'>
+            <alert type="cpu" limit="90%" samples="5" for="300" resolve="70%" repeat="3600" />
+    </client>
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        clients = config.parse_clients(xml_root)
+        self.assertEqual({'cpu': 90}, clients[0]['alerts'])
+        self.assertEqual({'limit': 90, 'samples': 5, 'for': 300, 'resolve': 70, 'repeat': 3600},
+                         clients[0]['alert_rules']['cpu'])
+
+    def test_resolve_over_limit(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <client
+        ip='localhost'
+        username='atodorov'
+        password='example'
+        mail='atodorov@example.com'
+        platform='Linux'>
+            <alert type="cpu" limit="90%" resolve="95%" />
+    </client>
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        with self.assertRaisesRegex(RuntimeError, 'Invalid alert attributes for .*<alert.*'):
+            config.parse_clients(xml_root)
 
     def test_invalid_alert_attributes(self):
         xml = """<?xml version="1.0" encoding="UTF-8"?>
@@ -259,3 +473,181 @@ class ParseClientsTestCase(unittest.TestCase):
             RuntimeError,
             'Invalid type or limit attributes for .*<alert.*'):
             config.parse_clients(xml_root)
+
+    def test_invalid_alert_limit(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <client
+        ip='localhost'
+        username='atodorov'
+        password='example'
+        mail='atodorov@example.com'
+        platform='Linux'>
+            <alert type="memory" limit="high" />
+    </client>
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        with self.assertRaisesRegex(
+            RuntimeError,
+            'Invalid type or limit attributes for .*<alert.*'):
+            config.parse_clients(xml_root)
+
+
+class ParseCollectorTestCase(unittest.TestCase):
+    def test_missing_collector_tag_uses_defaults(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config></config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        collector = config.parse_collector(xml_root)
+        # sequential polling is the default
+        self.assertEqual(1, collector['concurrency'])
+        self.assertEqual(60, collector['interval'])
+        self.assertEqual(0, collector['jitter'])
+        self.assertIsNone(collector['metrics_file'])
+        self.assertFalse(collector['self_metrics'])
+        self.assertEqual(30, collector['lease_time'])
+
+    def test_invalid_concurrency(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <collector concurrency='many' />
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        with self.assertRaisesRegex(RuntimeError, 'Invalid <collector> attribute concurrency'):
+            config.parse_collector(xml_root)
+
+    def test_zero_concurrency(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <collector concurrency='0' />
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        with self.assertRaisesRegex(RuntimeError, 'concurrency must be at least 1'):
+            config.parse_collector(xml_root)
+
+    def test_zero_lease_time(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <collector lease_time='0' />
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        with self.assertRaisesRegex(RuntimeError, 'lease_time must be at least 1'):
+            config.parse_collector(xml_root)
+
+    def test_zero_drain_events(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <collector drain_events='0' />
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        with self.assertRaisesRegex(RuntimeError, 'drain_events must be at least 1'):
+            config.parse_collector(xml_root)
+
+    def test_negative_durations(self):
+        for attrib in ['keepalive', 'max_idle', 'jitter', 'drain_time']:
+            xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <collector %s='-1' />
+</config>
+""" % attrib
+            filename = _create_xml(xml)
+            xml_root = config.parse_config(filename)
+            with self.assertRaisesRegex(RuntimeError, '%s must not be negative' % attrib):
+                config.parse_collector(xml_root)
+
+    def test_valid_collector(self):
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <collector concurrency='20' interval='30' jitter='5'
+               metrics_file='/var/lib/node_exporter/collector.prom' self_metrics='yes' />
+</config>
+"""
+        filename = _create_xml(xml)
+        xml_root = config.parse_config(filename)
+        collector = config.parse_collector(xml_root)
+        self.assertEqual(20, collector['concurrency'])
+        self.assertEqual(30, collector['interval'])
+        self.assertEqual(5, collector['jitter'])
+        self.assertEqual('/var/lib/node_exporter/collector.prom', collector['metrics_file'])
+        self.assertTrue(collector['self_metrics'])
+
+
+CLIENTS_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+    <database connection="sqlite:////tmp/example.db" />
+    <client ip='10.0.0.1' username='u' password='p' mail='a@example.com' platform='Linux'>
+        <alert type="cpu" limit="50%" />
+    </client>
+    <collector concurrency='4' />
+    <client ip='10.0.0.2' username='u' password='p' mail='a@example.com' platform='Windows' />
+</config>
+"""
+
+
+class LoadConfigTestCase(unittest.TestCase):
+    def test_same_as_parse_config(self):
+        filename = _create_xml(CLIENTS_XML)
+        root, clients = config.load_config(filename)
+
+        self.assertEqual(config.parse_clients(config.parse_config(filename)), clients)
+        # the other sections are kept, the clients are not
+        self.assertEqual([], root.findall('client'))
+        self.assertEqual('sqlite:////tmp/example.db', config.parse_db(root))
+        self.assertEqual(4, config.parse_collector(root)['concurrency'])
+
+    def test_errors(self):
+        with self.assertRaisesRegex(RuntimeError, "File .* not found!"):
+            config.load_config('/tmp/non-existing.xml')
+
+        filename = _create_xml('<config> </conf>')
+        with self.assertRaisesRegex(RuntimeError, "Invalid XML for .*"):
+            config.load_config(filename)
+
+        filename = _create_xml("<config><client ip='10.0.0.1' /></config>")
+        with self.assertRaisesRegex(RuntimeError, 'Missing attribute username for .*<client.*'):
+            config.load_config(filename)
+
+
+class ConfigWatcherTestCase(unittest.TestCase):
+    def test_changes_are_reported_once(self):
+        filename = _create_xml(CLIENTS_XML)
+        watcher = config.ConfigWatcher(filename)
+        self.assertFalse(watcher.changed())
+
+        # replaced with a new file, e.g. by an atomic rename
+        os.rename(_create_xml(CLIENTS_XML), filename)
+        self.assertTrue(watcher.changed())
+        self.assertFalse(watcher.changed())
+
+        with open(filename, 'a') as config_file:
+            config_file.write('\n<!-- changed -->')
+        self.assertTrue(watcher.changed())
+
+        os.remove(filename)
+        self.assertFalse(watcher.changed())
+
+
+class DiffClientsTestCase(unittest.TestCase):
+    def test_diff(self):
+        def key(client):
+            return client['ip']
+
+        old = [{'ip': '10.0.0.1', 'password': 'p'}, {'ip': '10.0.0.2'}, {'ip': '10.0.0.3'}]
+        new = [{'ip': '10.0.0.1', 'password': 'q'}, {'ip': '10.0.0.3'}, {'ip': '10.0.0.4'}]
+
+        added, removed, updated = config.diff_clients(old, new, key)
+        self.assertEqual([{'ip': '10.0.0.4'}], added)
+        self.assertEqual([{'ip': '10.0.0.2'}], removed)
+        self.assertEqual([(old[0], new[0])], updated)
@@ -0,0 +1,68 @@
+import unittest
+
+import drain
+
+CLIENT = {'ip': '10.0.0.1'}
+
+class EventDrainTestCase(unittest.TestCase):
+    def test_initial_batch_size(self):
+        event_drain = drain.EventDrain(batch_size=500)
+        self.assertEqual(500, event_drain.batch_size(CLIENT))
+
+    def test_batch_size_grows_with_throughput(self):
+        event_drain = drain.EventDrain(batch_size=1000, round_time=5)
+
+        # 1000 events/s, the target is 5000 events per round
+        event_drain.observe(CLIENT, 1000, 1000, 1.0)
+        self.assertEqual(3000, event_drain.batch_size(CLIENT))
+        event_drain.observe(CLIENT, 3000, 3000, 3.0)
+        self.assertEqual(4000, event_drain.batch_size(CLIENT))
+
+        # other clients aren't affected
+        self.assertEqual(1000, event_drain.batch_size({'ip': '10.0.0.2'}))
+
+    def test_batch_size_shrinks_on_slow_clients(self):
+        event_drain = drain.EventDrain(batch_size=1000, round_time=5)
+
+        event_drain.observe(CLIENT, 1000, 1000, 50.0)
+        self.assertEqual(550, event_drain.batch_size(CLIENT))
+
+    def test_batch_size_limits(self):
+        event_drain = drain.EventDrain(batch_size=1000, max_events=100000, round_time=5)
+
+        for _ in range(20):
+            event_drain.observe(CLIENT, 1000, 1000, 0)
+        self.assertTrue(19000 < event_drain.batch_size(CLIENT) <= 20000)
+
+        for _ in range(20):
+            event_drain.observe(CLIENT, 1000, 1000, 1000.0)
+        self.assertEqual(100, event_drain.batch_size(CLIENT))
+
+    def test_batch_size_is_capped_by_max_events(self):
+        event_drain = drain.EventDrain(batch_size=1000, max_events=5000, round_time=5)
+
+        for _ in range(20):
+            event_drain.observe(CLIENT, 1000, 1000, 0)
+        self.assertEqual(5000, event_drain.batch_size(CLIENT))
+        self.assertEqual(1500, event_drain.batch_size(CLIENT, 3500))
+        self.assertEqual(0, event_drain.batch_size(CLIENT, 5000))
+
+    def test_incomplete_batch_is_ignored(self):
+        event_drain = drain.EventDrain(batch_size=1000)
+        event_drain.observe(CLIENT, 1000, 10, 0.01)
+        self.assertEqual(1000, event_drain.batch_size(CLIENT))
+
+    def test_should_continue(self):
+        event_drain = drain.EventDrain(max_time=30, max_events=5000)
+
+        self.assertTrue(event_drain.should_continue(1000, 1000, 2000, 10))
+        # backlog drained
+        self.assertFalse(event_drain.should_continue(1000, 999, 1999, 10))
+        # out of time
+        self.assertFalse(event_drain.should_continue(1000, 1000, 2000, 30))
+        # out of events
+        self.assertFalse(event_drain.should_continue(1000, 1000, 5000, 10))
+
+    def test_disabled(self):
+        event_drain = drain.EventDrain(max_time=0)
+        self.assertFalse(event_drain.should_continue(1000, 1000, 1000, 0))
@@ -0,0 +1,97 @@
+import os
+import io
+import tempfile
+import unittest
+import unittest.mock
+from datetime import datetime
+
+import orm
+import instrument
+
+
+class RegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = instrument.Registry()
+
+    def test_render(self):
+        for value in [0.003, 0.2, 100]:
+            self.registry.observe('collector_phase_seconds', value, '10.0.0.1', 'exec')
+        self.registry.observe('collector_payload_bytes', 2000, '10.0.0.1',
+                              buckets=instrument.BYTES_BUCKETS)
+
+        lines = self.registry.render().splitlines()
+        self.assertIn('# TYPE collector_phase_seconds histogram', lines)
+        self.assertIn('collector_phase_seconds_bucket{phase="exec",le="0.005"} 1', lines)
+        self.assertIn('collector_phase_seconds_bucket{phase="exec",le="0.25"} 2', lines)
+        self.assertIn('collector_phase_seconds_bucket{phase="exec",le="+Inf"} 3', lines)
+        self.assertIn('collector_phase_seconds_sum{phase="exec"} 100.203', lines)
+        self.assertIn('collector_phase_seconds_count{phase="exec"} 3', lines)
+        self.assertIn('collector_payload_bytes_bucket{le="1024"} 0', lines)
+        self.assertIn('collector_payload_bytes_bucket{le="4096"} 1', lines)
+        self.assertIn('collector_payload_bytes_count 1', lines)
+
+    def test_histograms_are_not_per_host(self):
+        for host in ['10.0.0.1', '10.0.0.2']:
+            self.registry.observe('collector_phase_seconds', 1, host, 'exec')
+
+        lines = self.registry.render().splitlines()
+        self.assertIn('collector_phase_seconds_count{phase="exec"} 2', lines)
+        self.assertFalse([line for line in lines if 'host=' in line])
+
+    def test_timed_records_errors_too(self):
+        with unittest.mock.patch('time.time', side_effect=[10, 12.5]):
+            with self.assertRaises(RuntimeError):
+                with self.registry.timed('connect', '10.0.0.1'):
+                    raise RuntimeError('Connection refused')
+
+        self.assertIn('collector_phase_seconds_sum{phase="connect"} 2.5',
+                      self.registry.render().splitlines())
+
+    def test_write_textfile(self):
+        self.registry.observe('collector_phase_seconds', 1, phase='db_flush')
+        path = os.path.join(tempfile.mkdtemp(), 'collector.prom')
+
+        self.registry.write_textfile(path)
+        with open(path) as textfile:
+            self.assertEqual(self.registry.render(), textfile.read())
+        self.assertEqual(['collector.prom'], os.listdir(os.path.dirname(path)))
+
+    def test_persist_stores_increments(self):
+        db = orm.connect('sqlite://')
+        self.registry.observe('collector_phase_seconds', 1, '10.0.0.1', 'exec')
+        self.registry.observe('collector_phase_seconds', 2, '10.0.0.1', 'exec')
+        self.assertEqual(1, self.registry.persist(db, datetime(2017, 7, 1)))
+
+        # nothing new
+        self.assertEqual(0, self.registry.persist(db, datetime(2017, 7, 1, 0, 1)))
+
+        self.registry.observe('collector_phase_seconds', 4, '10.0.0.1', 'exec')
+        with unittest.mock.patch.object(db, 'execute', side_effect=RuntimeError('DB is down')):
+            with self.assertRaises(RuntimeError):
+                self.registry.persist(db, datetime(2017, 7, 1, 0, 2))
+        self.registry.observe('collector_phase_seconds', 8, '10.0.0.1', 'exec')
+        self.assertEqual(1, self.registry.persist(db, datetime(2017, 7, 1, 0, 3)))
+
+        rows = db.query(orm.SelfMetric).order_by(orm.SelfMetric.collected_at).all()
+        self.assertEqual([(2, 3), (2, 12)], [(row.count, row.sum) for row in rows])
+        self.assertEqual(('10.0.0.1', 'exec'), (rows[0].host, rows[0].phase))
+
+    def test_persist_is_per_host(self):
+        db = orm.connect('sqlite://')
+        self.registry.observe('collector_phase_seconds', 1, '10.0.0.1', 'exec')
+        self.registry.observe('collector_phase_seconds', 2, '10.0.0.2', 'exec')
+        self.registry.observe('collector_phase_seconds', 4, '10.0.0.2', 'exec')
+        self.assertEqual(2, self.registry.persist(db, datetime(2017, 7, 1)))
+
+        rows = db.query(orm.SelfMetric).order_by(orm.SelfMetric.host).all()
+        self.assertEqual([('10.0.0.1', 1, 1), ('10.0.0.2', 2, 6)],
+                         [(row.host, row.count, row.sum) for row in rows])
+
+
+class CountingReaderTestCase(unittest.TestCase):
+    def test_counts_bytes(self):
+        reader = instrument.CountingReader(io.BytesIO(b'MC1 zlib\nabcdef'))
+        self.assertEqual(b'MC1 zlib\n', reader.readline())
+        self.assertEqual(b'abc', reader.read(3))
+        self.assertEqual(b'def', reader.read())
+        self.assertEqual(15, reader.size)
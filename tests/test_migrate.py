@@ -0,0 +1,110 @@
+import unittest
+import unittest.mock
+from datetime import datetime
+
+import sqlalchemy as sql
+
+import orm
+import query
+import writer
+import migrate
+
+
+class BackfillSamplesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = orm.connect('sqlite://')
+        self.system = orm.System(name='localhost')
+        self.db.add(self.system)
+        self.db.commit()
+
+    def _write(self, layout, seconds):
+        metrics_writer = writer.MetricsWriter(self.db, layout=layout)
+        for i in seconds:
+            metrics_writer.add(self.system.id, {'cpu': i, 'memory': 50, 'uptime': 100 + i},
+                               datetime(2017, 7, 1, 14, 26, i))
+        metrics_writer.flush()
+
+    def test_copies_legacy_samples_in_chunks(self):
+        self._write('legacy', range(5))
+
+        self.assertEqual(5, migrate.backfill_samples(self.db, chunk_size=2))
+        self.assertEqual(5, self.db.query(orm.Sample).count())
+        self.assertEqual(list(query.samples(self.db, self.system.id)),
+                         list(query.samples(self.db, self.system.id, layout='wide')))
+
+    def test_skips_existing_samples(self):
+        self._write('legacy', range(5))
+        self._write('wide', [3, 4, 5])
+
+        self.assertEqual(3, migrate.backfill_samples(self.db, chunk_size=2))
+        self.assertEqual(6, self.db.query(orm.Sample).count())
+
+        # running it again is a no-op
+        self.assertEqual(0, migrate.backfill_samples(self.db))
+        self.assertEqual(6, self.db.query(orm.Sample).count())
+
+
+def _event(event_record_id, time_created=datetime(2017, 7, 1, 14, 26, 5)):
+    return {'EventID': 4672, 'EventRecordID': event_record_id, 'TimeCreated': time_created}
+
+
+def _copy_table(table, metadata):
+    # tometadata() was renamed in SQLAlchemy 1.4 and removed in 2.0
+    copy = getattr(table, 'to_metadata', None) or table.tometadata
+    return copy(metadata)
+
+
+class AddEventConstraintTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = orm.connect('sqlite://')
+        self.system = orm.System(name='localhost')
+        self.db.add(self.system)
+        self.db.commit()
+
+        # win_event_log as created by versions without the constraint
+        bind = self.db.get_bind()
+        orm.WinEventLog.__table__.drop(bind)
+        metadata = sql.MetaData()
+        _copy_table(orm.System.__table__, metadata)
+        self.table = _copy_table(orm.WinEventLog.__table__, metadata)
+        self.table.constraints = set(constraint for constraint in self.table.constraints
+                                     if not isinstance(constraint, sql.UniqueConstraint))
+        self.table.create(bind)
+        writer._EVENT_CONSTRAINTS.clear() # pylint: disable=protected-access
+
+    def _insert(self, *events):
+        self.db.execute(self.table.insert(), [
+            dict(event, system_id=self.system.id, collected_at=datetime(2017, 7, 1))
+            for event in events])
+        self.db.commit()
+
+    def test_writer_warns_without_constraint(self):
+        self.assertFalse(orm.has_event_constraint(self.db.get_bind()))
+
+        events = [dict(_event(1), TimeCreated='2017-07-01T14:26:05.000000')]
+        with unittest.mock.patch('sys.stderr') as stderr:
+            self.assertEqual(1, writer.save_event_logs(self.db, self.system.id, events,
+                                                       datetime(2017, 7, 1)))
+        self.assertIn('RUN migrate.py', str(stderr.write.call_args_list))
+
+    def test_duplicates_are_deleted(self):
+        self._insert(_event(1), _event(1), _event(1), _event(2), _event(2),
+                     _event(2, datetime(2017, 7, 2)), _event(3, None), _event(3, None))
+
+        self.assertEqual(3, migrate.add_event_constraint(self.db, chunk_size=1))
+        self.assertTrue(orm.has_event_constraint(self.db.get_bind()))
+
+        rows = self.db.execute(orm.select(self.table.c.id, self.table.c.EventRecordID).order_by(
+            self.table.c.id)).fetchall()
+        # the first copies are kept
+        self.assertEqual([(1, 1), (4, 2), (6, 2), (7, 3), (8, 3)], [tuple(row) for row in rows])
+
+        with self.assertRaises(sql.exc.IntegrityError):
+            self._insert(_event(1))
+        self.db.rollback()
+
+        # running it again is a no-op
+        self.assertEqual(0, migrate.add_event_constraint(self.db))
+
+    def test_new_database_has_the_constraint(self):
+        self.assertTrue(orm.has_event_constraint(orm.connect('sqlite://').get_bind()))
@@ -1,4 +1,9 @@
+import os
+import tempfile
 import unittest
+import unittest.mock
+
+import sqlalchemy as sql
 
 import orm
 
@@ -12,3 +17,75 @@ class ConnectTestCase(unittest.TestCase):
     def test_valid_connection_doesnt_raise(self):
         # note creates in-memory DB
         orm.connect('sqlite://')
+
+    def test_value_indexes_are_optional(self):
+        def indexes(db):
+            return set(index['name'] for index in
+                       sql.inspect(db.get_bind()).get_indexes('cpu_usage'))
+
+        db = orm.connect('sqlite://')
+        self.assertIn('ix_cpu_usage_system_id_collected_at', indexes(db))
+        self.assertNotIn('ix_cpu_usage_usage', indexes(db))
+
+        db = orm.connect('sqlite://', value_indexes=True)
+        self.assertIn('ix_cpu_usage_usage', indexes(db))
+
+    def test_query_indexes_are_added_to_existing_tables(self):
+        path = os.path.join(tempfile.mkdtemp(), 'metrics.db')
+        db = orm.connect('sqlite:///%s' % path)
+        for index in orm.QUERY_INDEXES:
+            index.drop(db.get_bind())
+        db.close()
+
+        db = orm.connect('sqlite:///%s' % path)
+        inspector = sql.inspect(db.get_bind())
+        for index in orm.QUERY_INDEXES:
+            self.assertIn(index.name, [existing['name'] for existing in
+                                       inspector.get_indexes(index.table.name)])
+
+
+class EnsureSystemsTestCase(unittest.TestCase):
+    def test_creates_missing_systems(self):
+        db = orm.connect('sqlite://')
+        db.add(orm.System(name='10.0.0.1'))
+        db.commit()
+
+        ids = orm.ensure_systems(db, ['10.0.0.1', '10.0.0.2', '10.0.0.2'])
+        self.assertEqual(['10.0.0.1', '10.0.0.2'], sorted(ids))
+        self.assertEqual(2, db.query(orm.System).count())
+        self.assertEqual(ids['10.0.0.2'], db.query(orm.System).filter_by(name='10.0.0.2').one().id)
+
+        self.assertEqual(ids, orm.ensure_systems(db, ['10.0.0.1', '10.0.0.2']))
+        self.assertEqual({}, orm.ensure_systems(db, []))
+
+    def test_looks_up_in_chunks(self):
+        db = orm.connect('sqlite://')
+        names = ['10.0.%d.%d' % (i // 256, i % 256) for i in range(1200)]
+
+        with unittest.mock.patch.object(db, 'execute', wraps=db.execute) as execute:
+            ids = orm.ensure_systems(db, names)
+
+        self.assertEqual(sorted(names), sorted(ids))
+        self.assertEqual(len(names), len(set(ids.values())))
+        # 3 lookups before and after the multi-row INSERT
+        self.assertEqual(7, execute.call_count)
+
+
+class SelectTestCase(unittest.TestCase):
+    def test_select(self):
+        db = orm.connect('sqlite://')
+        db.add(orm.System(name='10.0.0.1'))
+        db.commit()
+
+        table = orm.System.__table__
+        self.assertEqual([('10.0.0.1', 1)],
+                         [tuple(row) for row in db.execute(orm.select(table.c.name, table.c.id))])
+        self.assertEqual([{'name': '10.0.0.1', 'id': 1}],
+                         orm.mappings(db.execute(orm.select(table.c.name, table.c.id))))
+
+    def test_columns_are_passed_as_list_before_1_4(self):
+        table = orm.System.__table__
+        with unittest.mock.patch('orm._LIST_SELECT', True), \
+                unittest.mock.patch('sqlalchemy.select') as select:
+            orm.select(table.c.name, table.c.id)
+        select.assert_called_once_with([table.c.name, table.c.id])
@@ -0,0 +1,114 @@
+import threading
+import unittest
+import unittest.mock
+
+import pool
+
+CLIENT = {
+    'ip': '10.0.0.1',
+    'port': 22,
+    'username': 'atodorov',
+    'password': 'example',
+}
+
+def _fake_ssh_client():
+    ssh = unittest.mock.Mock()
+    ssh.get_transport.return_value.is_active.return_value = True
+    return ssh
+
+
+@unittest.mock.patch('pool.new_ssh_client', side_effect=_fake_ssh_client)
+class SSHPoolTestCase(unittest.TestCase):
+    def test_connection_is_reused(self, new_ssh_client):
+        ssh_pool = pool.SSHPool(keepalive=15)
+
+        ssh = ssh_pool.get(CLIENT)
+        self.assertIs(ssh, ssh_pool.get(CLIENT))
+        self.assertEqual(1, new_ssh_client.call_count)
+        ssh.connect.assert_called_once_with('10.0.0.1', port=22,
+                                            username='atodorov', password='example')
+        ssh.get_transport.return_value.set_keepalive.assert_called_once_with(15)
+
+    def test_connections_are_keyed_by_ip_port_and_username(self, new_ssh_client):
+        ssh_pool = pool.SSHPool()
+
+        ssh_pool.get(CLIENT)
+        ssh_pool.get(dict(CLIENT, port=2222))
+        ssh_pool.get(dict(CLIENT, username='root'))
+        self.assertEqual(3, new_ssh_client.call_count)
+
+    def test_dead_connection_is_reconnected(self, new_ssh_client):
+        ssh_pool = pool.SSHPool()
+
+        ssh = ssh_pool.get(CLIENT)
+        ssh.get_transport.return_value.is_active.return_value = False
+
+        self.assertIsNot(ssh, ssh_pool.get(CLIENT))
+        ssh.close.assert_called_once_with()
+        self.assertEqual(2, new_ssh_client.call_count)
+
+    def test_discard_forces_reconnect(self, new_ssh_client):
+        ssh_pool = pool.SSHPool()
+
+        ssh = ssh_pool.get(CLIENT)
+        ssh_pool.discard(CLIENT)
+        ssh.close.assert_called_once_with()
+
+        ssh_pool.get(CLIENT)
+        self.assertEqual(2, new_ssh_client.call_count)
+
+    def test_evict_idle(self, new_ssh_client): # pylint: disable=unused-argument
+        ssh_pool = pool.SSHPool(max_idle=60)
+
+        with unittest.mock.patch('time.time', return_value=1000):
+            ssh = ssh_pool.get(CLIENT)
+            ssh_pool.release(CLIENT)
+
+        self.assertEqual(0, ssh_pool.evict_idle(now=1030))
+        self.assertEqual(1, ssh_pool.evict_idle(now=1100))
+        ssh.close.assert_called_once_with()
+
+    def test_connection_being_made_is_not_evicted(self, new_ssh_client): # pylint: disable=unused-argument
+        ssh_pool = pool.SSHPool(max_idle=60)
+        evicting = threading.Thread(target=ssh_pool.evict_idle)
+
+        def evict_while_connecting(*args, **kwargs): # pylint: disable=unused-argument
+            evicting.start()
+            evicting.join(0.1)
+
+        with unittest.mock.patch('pool.new_ssh_client') as slow_ssh_client:
+            slow_ssh_client.return_value.connect.side_effect = evict_while_connecting
+            ssh = ssh_pool.get(CLIENT)
+
+        evicting.join()
+        self.assertFalse(ssh.close.called)
+
+    def test_connection_in_use_is_not_evicted(self, new_ssh_client): # pylint: disable=unused-argument
+        ssh_pool = pool.SSHPool(max_idle=60)
+
+        with unittest.mock.patch('time.time', return_value=1000):
+            ssh = ssh_pool.get(CLIENT)
+            # a second poll of the same client over the same connection
+            ssh_pool.get(CLIENT)
+            ssh_pool.release(CLIENT)
+
+        # a poll which takes longer than max_idle
+        self.assertEqual(0, ssh_pool.evict_idle(now=1100))
+        self.assertFalse(ssh.close.called)
+
+        with unittest.mock.patch('time.time', return_value=1100):
+            ssh_pool.release(CLIENT)
+        self.assertEqual(0, ssh_pool.evict_idle(now=1130))
+        self.assertEqual(1, ssh_pool.evict_idle(now=1200))
+        ssh.close.assert_called_once_with()
+
+    def test_failed_connect_is_released(self, new_ssh_client):
+        ssh_pool = pool.SSHPool(max_idle=60)
+        new_ssh_client.side_effect = None
+        new_ssh_client.return_value.connect.side_effect = EOFError()
+
+        with unittest.mock.patch('time.time', return_value=1000):
+            with self.assertRaises(EOFError):
+                ssh_pool.get(CLIENT)
+
+        self.assertEqual(1, ssh_pool.evict_idle(now=1100))
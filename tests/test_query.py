@@ -0,0 +1,150 @@
+import unittest
+from datetime import datetime
+
+import orm
+import query
+import rollup
+import writer
+
+
+class SamplesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = orm.connect('sqlite://')
+        self.system = orm.System(name='localhost')
+        self.other = orm.System(name='remote')
+        self.db.add_all([self.system, self.other])
+        self.db.commit()
+
+    def _write(self, layout):
+        metrics_writer = writer.MetricsWriter(self.db, layout=layout)
+        for i in range(3):
+            metrics_writer.add(self.system.id, {'cpu': i, 'memory': 50 + i, 'uptime': 100 + i},
+                               datetime(2017, 7, 1, 14, 26, i))
+        metrics_writer.add(self.other.id, {'cpu': 99, 'memory': 99, 'uptime': 99},
+                           datetime(2017, 7, 1, 14, 26, 1))
+        metrics_writer.flush()
+
+    def test_same_results_for_both_layouts(self):
+        for layout in ['legacy', 'wide']:
+            self._write(layout)
+
+        legacy = list(query.samples(self.db, self.system.id))
+        wide = list(query.samples(self.db, self.system.id, layout='wide'))
+
+        self.assertEqual(3, len(legacy))
+        self.assertEqual(legacy, wide)
+        self.assertEqual({
+            'collected_at': datetime(2017, 7, 1, 14, 26, 2),
+            'cpu': 2,
+            'memory': 52,
+            'uptime': 102,
+        }, legacy[-1])
+
+    def test_time_range(self):
+        self._write('legacy')
+
+        result = list(query.samples(self.db, self.system.id,
+                                    start=datetime(2017, 7, 1, 14, 26, 1),
+                                    end=datetime(2017, 7, 1, 14, 26, 2)))
+        self.assertEqual(1, len(result))
+        self.assertEqual(1, result[0]['cpu'])
+
+
+class HistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = orm.connect('sqlite://')
+        self.system = orm.System(name='localhost')
+        self.db.add(self.system)
+        self.db.commit()
+
+        metrics_writer = writer.MetricsWriter(self.db)
+        for minute in range(0, 120, 30):
+            for value in [10, 20]:
+                metrics_writer.add(self.system.id, {'cpu': value, 'memory': 50, 'uptime': 100},
+                                   datetime(2017, 7, 1, minute // 60, minute % 60, value))
+        metrics_writer.flush()
+        # the first update only records what is stored
+        rollup.update_rollups(self.db)
+        rollup.update_rollups(self.db)
+
+    def test_pick_resolution(self):
+        start = datetime(2017, 7, 1)
+        self.assertIsNone(query.pick_resolution(start, datetime(2017, 7, 1, 1), step=30))
+        self.assertEqual(60, query.pick_resolution(start, datetime(2017, 7, 1, 1), step=600))
+        self.assertEqual(3600, query.pick_resolution(start, datetime(2017, 7, 2), step=3600))
+        self.assertEqual(86400, query.pick_resolution(start, datetime(2017, 8, 1), step=86400 * 7))
+        # about 300 points by default
+        self.assertEqual(3600, query.pick_resolution(start, datetime(2017, 8, 1)))
+
+    def test_reads_rollups(self):
+        result = list(query.history(self.db, self.system.id, 'cpu',
+                                    datetime(2017, 7, 1), datetime(2017, 7, 2), step=3600))
+        self.assertEqual(2, len(result))
+        self.assertEqual({
+            'bucket': datetime(2017, 7, 1, 1),
+            'min': 10,
+            'max': 20,
+            'avg': 15,
+            'count': 4,
+        }, result[1])
+
+    def test_falls_back_to_raw_samples(self):
+        result = list(query.history(self.db, self.system.id, 'cpu',
+                                    datetime(2017, 7, 1), datetime(2017, 7, 1, 0, 1), step=1))
+        self.assertEqual([10, 20], [point['avg'] for point in result])
+        self.assertEqual([1, 1], [point['count'] for point in result])
+
+
+class ReadQueriesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = orm.connect('sqlite://')
+        self.systems = [orm.System(name='alpha'), orm.System(name='beta'), orm.System(name='gamma')]
+        self.db.add_all(self.systems)
+        self.db.commit()
+
+        for layout in ['legacy', 'wide']:
+            metrics_writer = writer.MetricsWriter(self.db, layout=layout)
+            for i, system in enumerate(self.systems):
+                for minute in range(3):
+                    metrics_writer.add(system.id, {'cpu': (i + 1) * 10 + minute, 'memory': 50,
+                                                   'uptime': minute},
+                                       datetime(2017, 7, 1, 14, minute))
+            metrics_writer.flush()
+
+    def test_latest(self):
+        for layout in ['legacy', 'wide']:
+            result = list(query.latest(self.db, 'cpu', layout))
+            self.assertEqual(['alpha', 'beta', 'gamma'], [row['name'] for row in result])
+            self.assertEqual([12, 22, 32], [row['value'] for row in result])
+            self.assertEqual(datetime(2017, 7, 1, 14, 2), result[0]['collected_at'])
+
+    def test_top_systems(self):
+        result = list(query.top_systems(self.db, 'cpu', datetime(2017, 7, 1),
+                                        datetime(2017, 7, 1, 14, 2), limit=2))
+        self.assertEqual(['gamma', 'beta'], [row['name'] for row in result])
+        self.assertEqual(30.5, result[0]['avg'])
+        self.assertEqual(31, result[0]['max'])
+
+    def test_unknown_metric(self):
+        with self.assertRaisesRegex(ValueError, 'Unknown metric cpu_max for the legacy layout'):
+            list(query.latest(self.db, 'cpu_max'))
+        self.assertEqual(3, len(list(query.latest(self.db, 'cpu_max', 'wide'))))
+
+    def test_events(self):
+        system_id = self.systems[0].id
+        self.db.add_all([
+            orm.WinEventLog(system_id=system_id, EventID=event_id, EventRecordID=i,
+                            TimeCreated=datetime(2017, 7, 1, 14, i),
+                            collected_at=datetime(2017, 7, 1, 15))
+            for i, event_id in enumerate([4624, 4672, 4624, 4625])
+        ])
+        self.db.commit()
+
+        self.assertEqual([0, 2], [event.EventRecordID for event in
+                                  query.events(self.db, system_id, event_id=4624)])
+        self.assertEqual([1, 3], [event.EventRecordID for event in
+                                  query.events(self.db, event_id=[4672, 4625])])
+        self.assertEqual([1, 2], [event.EventRecordID for event in
+                                  query.events(self.db, start=datetime(2017, 7, 1, 14, 1),
+                                               end=datetime(2017, 7, 1, 14, 3))])
+        self.assertEqual([], list(query.events(self.db, self.systems[1].id)))
@@ -0,0 +1,82 @@
+import unittest
+import unittest.mock
+from datetime import datetime
+
+import orm
+import config
+import writer
+import retention
+
+
+class PartitionUpperBoundTestCase(unittest.TestCase):
+    def test_timestamp_bound(self):
+        self.assertEqual(
+            datetime(2017, 8, 1),
+            retention.partition_upper_bound(
+                "FOR VALUES FROM ('2017-07-01 00:00:00') TO ('2017-08-01 00:00:00')"))
+
+    def test_date_bound(self):
+        self.assertEqual(
+            datetime(2017, 8, 1),
+            retention.partition_upper_bound("FOR VALUES FROM ('2017-07-01') TO ('2017-08-01')"))
+
+    def test_unbounded(self):
+        self.assertIsNone(retention.partition_upper_bound('DEFAULT'))
+        self.assertIsNone(retention.partition_upper_bound(
+            "FOR VALUES FROM ('2017-07-01 00:00:00') TO (MAXVALUE)"))
+
+
+class PurgeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = orm.connect('sqlite://')
+        self.system_id = orm.ensure_systems(self.db, ['localhost'])['localhost']
+
+        metrics_writer = writer.MetricsWriter(self.db)
+        for day in range(1, 11):
+            metrics_writer.add(self.system_id, {'cpu': day, 'memory': 50, 'uptime': 100},
+                               datetime(2017, 7, day))
+        metrics_writer.flush()
+
+    def test_tables_match_config(self):
+        self.assertEqual(sorted(config._RETENTION_TABLES), # pylint: disable=protected-access
+                         sorted(retention.TABLES))
+
+    def test_purge_table_in_chunks(self):
+        with unittest.mock.patch.object(self.db, 'commit', wraps=self.db.commit) as commit:
+            deleted, done = retention.purge_table(self.db, orm.CpuUsage.__table__,
+                                                  datetime(2017, 7, 6), chunk_size=2)
+        self.assertEqual((5, True), (deleted, done))
+        # one transaction per chunk
+        self.assertEqual(4, commit.call_count)
+
+        self.assertEqual(5, self.db.query(orm.CpuUsage).count())
+        oldest = self.db.query(orm.CpuUsage.usage).order_by(orm.CpuUsage.usage).first()
+        self.assertEqual(6, oldest[0])
+
+    def test_purge_table_stops_at_deadline(self):
+        deleted, done = retention.purge_table(self.db, orm.CpuUsage.__table__,
+                                              datetime(2017, 7, 6), deadline=0)
+        self.assertEqual((0, False), (deleted, done))
+        self.assertEqual(10, self.db.query(orm.CpuUsage).count())
+
+    def test_retention(self):
+        purger = retention.Retention(self.db, {'cpu_usage': 3, 'uptime': 8}, interval=3600)
+        self.assertTrue(purger.should_purge())
+
+        self.assertEqual({'cpu_usage': 7, 'uptime': 2}, purger.purge(now=datetime(2017, 7, 11)))
+        self.assertEqual(3, self.db.query(orm.CpuUsage).count())
+        self.assertEqual(10, self.db.query(orm.MemUsage).count())
+        self.assertEqual(8, self.db.query(orm.Uptime).count())
+
+        with unittest.mock.patch('time.time', return_value=purger._purged_at + 10): # pylint: disable=protected-access
+            self.assertFalse(purger.should_purge())
+        with unittest.mock.patch('time.time', return_value=purger._purged_at + 3600): # pylint: disable=protected-access
+            self.assertTrue(purger.should_purge())
+
+    def test_retention_continues_after_deadline(self):
+        purger = retention.Retention(self.db, {'cpu_usage': 3}, max_time=0)
+        self.assertEqual({'cpu_usage': 0}, purger.purge(now=datetime(2017, 7, 11)))
+        self.assertTrue(purger.should_purge(now=purger._purged_at)) # pylint: disable=protected-access
+
+    def test_nothing_to_purge(self):
+        self.assertFalse(retention.Retention(self.db, {}).should_purge())
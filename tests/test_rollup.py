@@ -0,0 +1,91 @@
+import unittest
+from datetime import datetime
+
+import orm
+import rollup
+import writer
+
+
+class BucketStartTestCase(unittest.TestCase):
+    def test_resolutions(self):
+        collected_at = datetime(2017, 7, 1, 14, 26, 5, 774505)
+        self.assertEqual(datetime(2017, 7, 1, 14, 26), rollup.bucket_start(collected_at, 60))
+        self.assertEqual(datetime(2017, 7, 1, 14, 0), rollup.bucket_start(collected_at, 3600))
+        self.assertEqual(datetime(2017, 7, 1), rollup.bucket_start(collected_at, 86400))
+
+
+class UpdateRollupsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = orm.connect('sqlite://')
+        self.system_id = orm.ensure_systems(self.db, ['localhost'])['localhost']
+
+    def _write(self, values, minute=26, layout='legacy'):
+        metrics_writer = writer.MetricsWriter(self.db, layout=layout)
+        for i, value in enumerate(values):
+            metrics_writer.add(self.system_id, {'cpu': value, 'memory': 50, 'uptime': 100 + i},
+                               datetime(2017, 7, 1, 14, minute, i))
+        metrics_writer.flush()
+
+    def _update(self, **kwargs):
+        # rows stored since the previous update are rolled up by the next one
+        rollup.update_rollups(self.db, **kwargs)
+        return rollup.update_rollups(self.db, **kwargs)
+
+    def _rollup(self, resolution, metric='cpu'):
+        return self.db.query(orm.Rollup).filter_by(resolution=resolution, metric=metric).all()
+
+    def test_aggregates_every_resolution(self):
+        self._write([10, 30, 20])
+        self.assertEqual(9, self._update())
+
+        for resolution in rollup.RESOLUTIONS:
+            cpu = self._rollup(resolution)
+            self.assertEqual(1, len(cpu))
+            self.assertEqual((10, 30, 60, 3), (cpu[0].min, cpu[0].max, cpu[0].sum, cpu[0].count))
+
+        self.assertEqual(datetime(2017, 7, 1, 14), self._rollup(3600)[0].bucket)
+        self.assertEqual(102, self._rollup(60, 'uptime')[0].max)
+
+    def test_is_incremental(self):
+        self._write([10, 30])
+        self.assertEqual(6, self._update(chunk_size=1))
+
+        # nothing new
+        self.assertEqual(0, rollup.update_rollups(self.db))
+
+        self._write([50])
+        self._write([5], minute=27)
+        self.assertEqual(6, self._update())
+
+        minutes = self._rollup(60)
+        self.assertEqual([3, 1], [row.count for row in sorted(minutes, key=lambda row: row.bucket)])
+
+        hour = self._rollup(3600)[0]
+        self.assertEqual((5, 50, 95, 4), (hour.min, hour.max, hour.sum, hour.count))
+
+    def test_late_commits_are_not_skipped(self):
+        self._write([10])
+        self.assertEqual(0, rollup.update_rollups(self.db))
+
+        # id 3 becomes visible before id 2 whose transaction commits late
+        cpu = orm.CpuUsage.__table__
+        self.db.execute(cpu.insert().values(id=3, system_id=self.system_id, usage=30,
+                                            collected_at=datetime(2017, 7, 1, 14, 26, 3)))
+        self.db.commit()
+        self.assertEqual(3, rollup.update_rollups(self.db))
+
+        self.db.execute(cpu.insert().values(id=2, system_id=self.system_id, usage=20,
+                                            collected_at=datetime(2017, 7, 1, 14, 26, 2)))
+        self.db.commit()
+        self.assertEqual(2, rollup.update_rollups(self.db))
+
+        hour = self._rollup(3600)[0]
+        self.assertEqual((10, 30, 60, 3), (hour.min, hour.max, hour.sum, hour.count))
+
+    def test_wide_layout(self):
+        self._write([10, 30], layout='wide')
+        self.assertEqual(2, self._update(layout='wide'))
+
+        self.assertEqual(2, self._rollup(86400, 'memory')[0].count)
+        # cpu_min and cpu_max weren't reported
+        self.assertEqual([], self._rollup(86400, 'cpu_min'))
@@ -0,0 +1,86 @@
+import unittest
+
+import scheduler
+
+def _client(ip, interval=None):
+    return {'ip': ip, 'port': 22, 'interval': interval}
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def test_new_clients_are_due_immediately_without_jitter(self):
+        schedule = scheduler.Scheduler(default_interval=60)
+        schedule.add(_client('10.0.0.1'), 1000)
+        schedule.add(_client('10.0.0.2'), 1000)
+
+        self.assertEqual(2, len(schedule))
+        self.assertEqual(1000, schedule.next_due())
+        self.assertEqual(2, len(schedule.due(1000)))
+
+    def test_jitter_delays_the_first_poll(self):
+        schedule = scheduler.Scheduler(default_interval=60, jitter=10)
+        for i in range(20):
+            schedule.add(_client('10.0.0.%d' % i), 1000)
+
+        self.assertTrue(1000 <= schedule.next_due() <= 1010)
+        self.assertEqual(20, len(schedule.due(1010)))
+
+    def test_per_client_interval(self):
+        schedule = scheduler.Scheduler(default_interval=60)
+        fast = _client('10.0.0.1', interval=10)
+        slow = _client('10.0.0.2')
+        schedule.add(fast, 1000)
+        schedule.add(slow, 1000)
+
+        for client in schedule.due(1000):
+            schedule.done(client, 1001)
+
+        self.assertEqual(1010, schedule.next_due())
+        self.assertEqual([fast], schedule.due(1010))
+        self.assertEqual([], schedule.due(1059))
+        self.assertEqual([slow], schedule.due(1060))
+
+    def test_in_flight_client_is_not_due_again(self):
+        schedule = scheduler.Scheduler(default_interval=10)
+        client = _client('10.0.0.1')
+        schedule.add(client, 1000)
+
+        self.assertEqual([client], schedule.due(1000))
+        self.assertEqual([], schedule.due(1050))
+        self.assertIsNone(schedule.next_due())
+
+    def test_overrun_coalesces_missed_ticks(self):
+        schedule = scheduler.Scheduler(default_interval=10)
+        client = _client('10.0.0.1')
+        schedule.add(client, 1000)
+        schedule.due(1000)
+
+        # the poll took 35 seconds, ticks at 1010, 1020 and 1030 are skipped
+        self.assertEqual(3, schedule.done(client, 1035))
+        self.assertEqual(1040, schedule.next_due())
+
+    def test_removed_client_is_not_polled(self):
+        schedule = scheduler.Scheduler(default_interval=10)
+        client = _client('10.0.0.1')
+        schedule.add(client, 1000)
+        schedule.remove(client)
+
+        self.assertEqual(0, len(schedule))
+        self.assertEqual([], schedule.due(1000))
+        self.assertEqual(0, schedule.done(client, 1000))
+
+    def test_update_keeps_schedule(self):
+        schedule = scheduler.Scheduler(default_interval=60)
+        schedule.add(_client('10.0.0.1'), 1000)
+        self.assertEqual(1, len(schedule.due(1000)))
+
+        updated = _client('10.0.0.1', interval=10)
+        schedule.update(updated)
+        # still in flight, the new interval applies after the poll
+        self.assertEqual([], schedule.due(1000))
+        schedule.done(updated, 1001)
+        self.assertEqual(1010, schedule.next_due())
+        self.assertIs(updated, schedule.due(1010)[0])
+
+        # unknown clients are ignored
+        schedule.update(_client('10.0.0.2'))
+        self.assertEqual(1, len(schedule))
@@ -0,0 +1,549 @@
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+import orm
+import agent
+import drain
+import config
+import server
+import scheduler
+import sharding
+
+class CollectAllTestCase(unittest.TestCase):
+    @unittest.mock.patch('server.collect_metrics')
+    def test_collects_from_all_clients(self, collect_metrics):
+        collect_metrics.side_effect = lambda ssh, client, last_id, *args: {
+            'ip': client['ip'],
+            'last_id': last_id,
+        }
+        clients = [{'ip': '10.0.0.%d' % i} for i in range(10)]
+
+        results = list(server.collect_all(clients, {'10.0.0.3': 42}, concurrency=4))
+
+        self.assertEqual(10, len(results))
+        for client, metrics in results:
+            self.assertEqual(client['ip'], metrics['ip'])
+            if client['ip'] == '10.0.0.3':
+                self.assertEqual(42, metrics['last_id'])
+            else:
+                self.assertEqual(0, metrics['last_id'])
+
+    @unittest.mock.patch('server.collect_metrics')
+    def test_each_worker_gets_its_own_ssh_client(self, collect_metrics):
+        used = []
+        lock = threading.Lock()
+
+        def _collect(ssh, client, last_id, *args): # pylint: disable=unused-argument
+            with lock:
+                used.append(ssh)
+            return {}
+
+        collect_metrics.side_effect = _collect
+        clients = [{'ip': '10.0.0.%d' % i} for i in range(5)]
+
+        list(server.collect_all(clients, {}, concurrency=5))
+        self.assertEqual(5, len(set(id(ssh) for ssh in used)))
+
+    @unittest.mock.patch('server.collect_metrics')
+    def test_errors_are_reported(self, collect_metrics):
+        def _collect(ssh, client, last_id, *args): # pylint: disable=unused-argument
+            if client['ip'] == '10.0.0.1':
+                raise RuntimeError('Execution on 10.0.0.1 failed')
+            return {}
+
+        collect_metrics.side_effect = _collect
+        clients = [{'ip': '10.0.0.%d' % i} for i in range(3)]
+
+        with unittest.mock.patch('sys.stderr') as stderr:
+            results = list(server.collect_all(clients, {}, concurrency=2))
+
+        self.assertEqual(['10.0.0.0', '10.0.0.2'], sorted(client['ip'] for client, _ in results))
+        self.assertIn('Execution on 10.0.0.1 failed', str(stderr.write.call_args_list))
+
+
+class RunOnceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = orm.connect('sqlite://')
+        config_xml = ET.fromstring(
+            "<config><smtp host='localhost' username='a@example.com' password='p'/></config>")
+        self.smtp_cfg = config.parse_smtp(config_xml)
+        self.collector_cfg = config.parse_collector(config_xml)
+        self.storage_cfg = config.parse_storage(config_xml)
+        self.clients = [{'ip': '10.0.0.%d' % i, 'port': 22, 'platform': 'Linux', 'alerts': {},
+                         'mail': 'a@example.com'} for i in range(1, 4)]
+
+    @unittest.mock.patch('server._collect_worker')
+    def test_failing_client_does_not_stop_the_others(self, _collect_worker):
+        def _collect(client, *args): # pylint: disable=unused-argument
+            if client['ip'] == '10.0.0.2':
+                raise EOFError('Connection lost')
+            return {'cpu': 10, 'memory': 20, 'uptime': 30}
+
+        _collect_worker.side_effect = _collect
+        with unittest.mock.patch('sys.stderr'):
+            server.run_once(self.db, self.clients, self.smtp_cfg, self.collector_cfg,
+                            self.storage_cfg)
+
+        stored = set(system.name for system in self.db.query(orm.System).join(
+            orm.CpuUsage, orm.CpuUsage.system_id == orm.System.id))
+        self.assertEqual(set(['10.0.0.1', '10.0.0.3']), stored)
+
+    @unittest.mock.patch('alerts.notify')
+    @unittest.mock.patch('server._collect_worker')
+    def test_only_basic_metrics_are_kept_for_alerts(self, _collect_worker, notify):
+        _collect_worker.return_value = {'cpu': 90, 'memory': 20, 'uptime': 30,
+                                        'security_event_logs': []}
+        self.clients[0]['alerts'] = {'cpu': 50}
+
+        server.run_once(self.db, self.clients, self.smtp_cfg, self.collector_cfg,
+                        self.storage_cfg)
+
+        violations = notify.call_args[0][1]
+        self.assertEqual([(self.clients[0], {'cpu': 90, 'memory': 20, 'uptime': 30}, 'cpu')],
+                         violations)
+
+
+class CollectWorkerTestCase(unittest.TestCase):
+    @unittest.mock.patch('server._run_agent')
+    def test_pooled_connection_is_retried_once(self, _run_agent):
+        _run_agent.side_effect = [EOFError(), {'cpu': 10}]
+        ssh_pool = unittest.mock.Mock()
+        client = {'ip': '10.0.0.1'}
+
+        metrics = server._collect_worker(client, 0, ssh_pool) # pylint: disable=protected-access
+
+        self.assertEqual({'cpu': 10}, metrics)
+        ssh_pool.discard.assert_called_once_with(client)
+        self.assertEqual(2, ssh_pool.get.call_count)
+        # the connection is given back after both attempts
+        self.assertEqual(2, ssh_pool.release.call_count)
+
+
+class EnsureAgentTestCase(unittest.TestCase):
+    def setUp(self):
+        server._UPLOADED.clear() # pylint: disable=protected-access
+        self.client = {'ip': '10.0.0.1', 'port': 22, 'platform': 'Linux', 'username': 'u'}
+        self.destination = server._agent_destination(self.client) # pylint: disable=protected-access
+
+    @staticmethod
+    def _ssh(size=None, directory_mode=0o40700, directory_uid=1000):
+        """
+            Returns a mock SSH client whose home directory, owned by uid 1000,
+            contains an existing agent directory and agent of @size bytes!
+        """
+        ssh = unittest.mock.Mock()
+        sftp = ssh.open_sftp.return_value
+        sftp.mkdir.side_effect = IOError('File exists')
+        sftp.lstat.return_value = unittest.mock.Mock(st_mode=directory_mode, st_uid=directory_uid)
+
+        def _stat(path):
+            if path == '.':
+                return unittest.mock.Mock(st_uid=1000)
+            if size is None:
+                raise IOError('No such file')
+            return unittest.mock.Mock(st_size=size)
+
+        sftp.stat.side_effect = _stat
+        return ssh
+
+    def test_destination_is_versioned(self):
+        self.assertRegex(self.destination, r'^\.metrics-collector/agent-[0-9a-f]{12}\.py$')
+        windows = server._agent_destination(dict(self.client, platform='Windows')) # pylint: disable=protected-access
+        self.assertEqual(self.destination, windows)
+
+    def test_unknown_platform(self):
+        with self.assertRaisesRegex(RuntimeError, 'Unknown platform'):
+            server._agent_destination(dict(self.client, platform='BeOS')) # pylint: disable=protected-access
+
+    def test_missing_agent_is_uploaded_once(self):
+        ssh = self._ssh()
+
+        server._ensure_agent(ssh, self.client, self.destination) # pylint: disable=protected-access
+        server._ensure_agent(ssh, self.client, self.destination) # pylint: disable=protected-access
+
+        sftp = ssh.open_sftp.return_value
+        sftp.put.assert_called_once_with(server.AGENT_PATH, self.destination)
+        self.assertEqual(1, ssh.open_sftp.call_count)
+
+    def test_private_directory_is_created(self):
+        ssh = self._ssh()
+        sftp = ssh.open_sftp.return_value
+        sftp.mkdir.side_effect = None
+
+        server._ensure_agent(ssh, self.client, self.destination) # pylint: disable=protected-access
+        sftp.mkdir.assert_called_once_with('.metrics-collector', 0o700)
+        sftp.chmod.assert_called_once_with('.metrics-collector', 0o700)
+        sftp.put.assert_called_once_with(server.AGENT_PATH, self.destination)
+
+    def test_up_to_date_agent_is_not_uploaded(self):
+        ssh = self._ssh(os.path.getsize(server.AGENT_PATH))
+
+        server._ensure_agent(ssh, self.client, self.destination) # pylint: disable=protected-access
+        ssh.open_sftp.return_value.put.assert_not_called()
+        # the name and the size are enough, the agent isn't read back
+        ssh.open_sftp.return_value.open.assert_not_called()
+
+    def test_incomplete_agent_is_replaced(self):
+        ssh = self._ssh(os.path.getsize(server.AGENT_PATH) // 2)
+
+        server._ensure_agent(ssh, self.client, self.destination) # pylint: disable=protected-access
+        ssh.open_sftp.return_value.put.assert_called_once_with(server.AGENT_PATH, self.destination)
+
+    def test_shared_directory_is_refused(self):
+        for ssh in [self._ssh(directory_mode=0o40777), self._ssh(directory_uid=0),
+                    self._ssh(directory_mode=0o120777)]:
+            with self.assertRaisesRegex(RuntimeError, 'not a private directory of u'):
+                server._ensure_agent(ssh, self.client, self.destination) # pylint: disable=protected-access
+            ssh.open_sftp.return_value.put.assert_not_called()
+
+    def test_forgotten_agent_is_checked_again(self):
+        ssh = self._ssh()
+
+        server._ensure_agent(ssh, self.client, self.destination) # pylint: disable=protected-access
+        server._forget_agent(self.client, self.destination) # pylint: disable=protected-access
+        server._ensure_agent(ssh, self.client, self.destination) # pylint: disable=protected-access
+
+        self.assertEqual(2, ssh.open_sftp.return_value.put.call_count)
+
+
+class StreamWorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = {'ip': '10.0.0.1', 'port': 22, 'platform': 'Linux'}
+        self.ssh_pool = unittest.mock.Mock()
+
+    @unittest.mock.patch('server._open_stream')
+    def test_stream_is_opened_once(self, _open_stream):
+        _open_stream.return_value.read_samples.return_value = [{'cpu': 1}]
+        streams = {}
+
+        for _ in range(3):
+            samples = server._stream_worker(self.client, 0, self.ssh_pool, streams, 60) # pylint: disable=protected-access
+            self.assertEqual([{'cpu': 1}], samples)
+
+        _open_stream.assert_called_once_with(self.ssh_pool.get.return_value, self.client, 0, 60, '')
+
+    @unittest.mock.patch('server._open_stream')
+    def test_stream_is_reopened_after_reconnect(self, _open_stream):
+        streams = {}
+        server._stream_worker(self.client, 0, self.ssh_pool, streams, 60) # pylint: disable=protected-access
+
+        self.ssh_pool.get.return_value = unittest.mock.Mock()
+        server._stream_worker(self.client, 0, self.ssh_pool, streams, 60) # pylint: disable=protected-access
+
+        self.assertEqual(2, _open_stream.call_count)
+        _open_stream.return_value.close.assert_called_once_with()
+
+    @unittest.mock.patch('server._open_stream')
+    def test_broken_stream_is_dropped(self, _open_stream):
+        _open_stream.return_value.read_samples.side_effect = EOFError()
+        streams = {}
+
+        with self.assertRaises(EOFError):
+            server._stream_worker(self.client, 0, self.ssh_pool, streams, 60) # pylint: disable=protected-access
+
+        self.assertEqual({}, streams)
+        _open_stream.return_value.close.assert_called_once_with()
+
+
+class CollectedAtTestCase(unittest.TestCase):
+    def test_time_sent_by_the_agent(self):
+        metrics = {'cpu': 5, 'collected_at': time.time() - 30}
+        collected_at = server._collected_at(metrics) # pylint: disable=protected-access
+
+        self.assertAlmostEqual(30, (datetime.now() - collected_at).total_seconds(), delta=5)
+        # isn't stored as a metric
+        self.assertEqual({'cpu': 5}, metrics)
+
+    def test_older_agents_and_clock_skew(self):
+        before = datetime.now()
+        for metrics in [{'cpu': 5}, {'collected_at': time.time() + 3600},
+                        {'collected_at': 'garbage'}]:
+            collected_at = server._collected_at(metrics) # pylint: disable=protected-access
+            self.assertTrue(before <= collected_at <= datetime.now())
+
+
+class AgentArgsTestCase(unittest.TestCase):
+    def test_agent_args(self):
+        collector_cfg = {'cpu_samples': 1, 'batch_size': 1000, 'nonblocking_cpu': False,
+                         'ordered_events': False, 'compress': False}
+        self.assertEqual('--cpu-samples 1 --batch-size 1000',
+                         server._agent_args(collector_cfg)) # pylint: disable=protected-access
+
+        collector_cfg = {'cpu_samples': 5, 'batch_size': 200, 'nonblocking_cpu': True,
+                         'ordered_events': True, 'compress': True}
+        self.assertEqual('--cpu-samples 5 --batch-size 200 --nonblocking --ordered-events '
+                         '--format zjson',
+                         server._agent_args(collector_cfg)) # pylint: disable=protected-access
+
+
+class DrainTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = {'ip': '10.0.0.1', 'port': 22, 'platform': 'Windows'}
+        self.ssh = unittest.mock.Mock()
+
+    @staticmethod
+    def _response(first, count):
+        return {'security_event_logs': [{'EventRecordID': i} for i in range(first, first + count)]}
+
+    @unittest.mock.patch('server._ensure_agent')
+    @unittest.mock.patch('server._exec_agent')
+    def test_backlog_is_drained(self, _exec_agent, _ensure_agent): # pylint: disable=unused-argument
+        backlog = 2345
+
+        def _respond(ssh, client, destination, args, last_id): # pylint: disable=unused-argument
+            response = self._response(last_id + 1, min(int(args.split()[-1]), backlog - last_id))
+            if '--events-only' not in args:
+                response['cpu'] = 5
+            return response
+
+        _exec_agent.side_effect = _respond
+        event_drain = drain.EventDrain(batch_size=100, max_time=60, max_events=10000)
+
+        metrics = server._run_agent(self.ssh, self.client, 0, '', event_drain) # pylint: disable=protected-access
+
+        self.assertEqual(5, metrics['cpu'])
+        self.assertEqual(list(range(1, backlog + 1)),
+                         [evt['EventRecordID'] for evt in metrics['security_event_logs']])
+        self.assertTrue(_exec_agent.call_count > 1)
+
+        # continuation rounds start after the highest EventRecordID received
+        self.assertEqual(100, _exec_agent.call_args_list[1][0][4])
+        self.assertIn('--events-only', _exec_agent.call_args_list[1][0][3])
+
+    @unittest.mock.patch('server._ensure_agent')
+    @unittest.mock.patch('server._exec_agent')
+    def test_event_budget_is_respected(self, _exec_agent, _ensure_agent): # pylint: disable=unused-argument
+        _exec_agent.side_effect = lambda ssh, client, dest, args, last_id: self._response(
+            last_id + 1, int(args.split()[-1]))
+        event_drain = drain.EventDrain(batch_size=10, max_time=60, max_events=25)
+
+        metrics = server._run_agent(self.ssh, self.client, 0, '', event_drain) # pylint: disable=protected-access
+        self.assertEqual(25, len(metrics['security_event_logs']))
+
+    @unittest.mock.patch('server._ensure_agent')
+    @unittest.mock.patch('server._exec_agent')
+    def test_first_round_is_capped(self, _exec_agent, _ensure_agent): # pylint: disable=unused-argument
+        _exec_agent.side_effect = lambda ssh, client, dest, args, last_id: self._response(
+            last_id + 1, int(args.split()[-1]))
+        event_drain = drain.EventDrain(batch_size=100, max_time=60, max_events=30)
+
+        metrics = server._run_agent(self.ssh, self.client, 0, '', event_drain) # pylint: disable=protected-access
+        self.assertEqual(30, len(metrics['security_event_logs']))
+        self.assertTrue(_exec_agent.call_args_list[0][0][3].endswith('--batch-size 30'))
+
+    @unittest.mock.patch('server._ensure_agent')
+    @unittest.mock.patch('server._exec_agent')
+    def test_linux_is_not_drained(self, _exec_agent, _ensure_agent): # pylint: disable=unused-argument
+        _exec_agent.return_value = {'cpu': 5}
+        event_drain = drain.EventDrain(batch_size=10, max_time=60)
+
+        server._run_agent(self.ssh, dict(self.client, platform='Linux'), 0, '', event_drain) # pylint: disable=protected-access
+        self.assertEqual(1, _exec_agent.call_count)
+
+
+class _ChannelFile(io.BytesIO):
+    """
+        Like paramiko.ChannelFile opened in the default mode,
+        readline() returns str while read() returns bytes!
+    """
+    def readline(self, *args):
+        return super().readline(*args).decode('utf8')
+
+
+class ExecAgentTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = {'ip': '10.0.0.1', 'port': 22, 'platform': 'Linux'}
+
+    @staticmethod
+    def _ssh(stdout, stderr=b''):
+        ssh = unittest.mock.Mock()
+        ssh.exec_command.return_value = (None, _ChannelFile(stdout), _ChannelFile(stderr))
+        return ssh
+
+    def test_response_is_decoded(self):
+        ssh = self._ssh(b'{"cpu": 5}\n')
+        metrics = server._exec_agent(ssh, self.client, '/tmp/agent.py', '--format zjson', 42) # pylint: disable=protected-access
+
+        self.assertEqual({'cpu': 5}, metrics)
+        ssh.exec_command.assert_called_once_with('python /tmp/agent.py --format zjson 42')
+
+    def test_multiline_response_is_decoded(self):
+        ssh = self._ssh(b'{"cpu": 5,\n "memory": 10}\n')
+        metrics = server._exec_agent(ssh, self.client, '/tmp/agent.py', '', 0) # pylint: disable=protected-access
+        self.assertEqual({'cpu': 5, 'memory': 10}, metrics)
+
+    def test_compressed_response_is_decoded(self):
+        response = agent.encode_response({'cpu': 5, 'security_event_logs': []}, 'zjson')
+        ssh = self._ssh(response.encode('ascii'))
+        metrics = server._exec_agent(ssh, self.client, '/tmp/agent.py', '--format zjson', 0) # pylint: disable=protected-access
+        self.assertEqual({'cpu': 5, 'security_event_logs': []}, metrics)
+
+    def test_client_errors_are_raised(self):
+        ssh = self._ssh(b'', b'ImportError: No module named psutil\n')
+        with self.assertRaisesRegex(RuntimeError,
+                                    'Execution on 10.0.0.1 failed with:\nImportError'):
+            server._exec_agent(ssh, self.client, '/tmp/agent.py', '', 0) # pylint: disable=protected-access
+
+    def test_invalid_response(self):
+        ssh = self._ssh(b'garbage\n')
+        with self.assertRaisesRegex(RuntimeError, 'Invalid response from 10.0.0.1'):
+            server._exec_agent(ssh, self.client, '/tmp/agent.py', '', 0) # pylint: disable=protected-access
+
+
+def _config_xml(*clients):
+    return """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+%s
+</config>
+""" % '\n'.join("<client ip='%s' username='u' password='%s' mail='a@example.com' "
+                "platform='Windows' />" % client for client in clients)
+
+
+class ReloadClientsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = orm.connect('sqlite://')
+        _, self.config_path = tempfile.mkstemp(prefix='config.xml-')
+        self.addCleanup(os.remove, self.config_path)
+
+    def _write(self, *clients):
+        with open(self.config_path, 'w') as config_file:
+            config_file.write(_config_xml(*clients))
+
+    def test_only_changed_clients_are_touched(self):
+        self._write(('10.0.0.1', 'p'), ('10.0.0.2', 'p'))
+        _, clients = config.load_config(self.config_path)
+        systems, last_event_record_ids = server._load_systems(self.db, clients) # pylint: disable=protected-access
+        schedule = scheduler.Scheduler()
+        for client in clients:
+            schedule.add(client, 1000)
+
+        self._write(('10.0.0.2', 's3cr3t'), ('10.0.0.3', 'p'))
+        new_clients, retired = server._reload_clients( # pylint: disable=protected-access
+            self.db, self.config_path, clients, schedule, systems, last_event_record_ids)
+
+        self.assertEqual(['10.0.0.2', '10.0.0.3'], [client['ip'] for client in new_clients])
+        # removed, and updated with a new password
+        self.assertEqual([clients[0], clients[1]], retired)
+        self.assertEqual(2, len(schedule))
+        self.assertEqual(['10.0.0.1', '10.0.0.2', '10.0.0.3'], sorted(systems))
+        self.assertEqual(0, last_event_record_ids['10.0.0.3'])
+
+        # new clients are added at the current time
+        due = schedule.due(time.time())
+        self.assertIn(new_clients[0], due)
+        self.assertIn(new_clients[1], due)
+
+    def test_invalid_config_is_ignored(self):
+        self._write(('10.0.0.1', 'p'))
+        _, clients = config.load_config(self.config_path)
+
+        with open(self.config_path, 'w') as config_file:
+            config_file.write('<config>')
+
+        with unittest.mock.patch('sys.stderr'):
+            new_clients, retired = server._reload_clients( # pylint: disable=protected-access
+                self.db, self.config_path, clients, scheduler.Scheduler(), {}, {})
+        self.assertIs(clients, new_clients)
+        self.assertEqual([], retired)
+
+    def test_invalid_port_is_ignored(self):
+        self._write(('10.0.0.1', 'p'))
+        _, clients = config.load_config(self.config_path)
+
+        with open(self.config_path, 'w') as config_file:
+            config_file.write(_config_xml(('10.0.0.1', 'p')).replace(
+                "ip='10.0.0.1'", "ip='10.0.0.1' port='22x'"))
+
+        with unittest.mock.patch('sys.stderr'):
+            new_clients, retired = server._reload_clients( # pylint: disable=protected-access
+                self.db, self.config_path, clients, scheduler.Scheduler(), {}, {})
+        self.assertIs(clients, new_clients)
+        self.assertEqual([], retired)
+
+    def test_sharded_clients_are_not_scheduled(self):
+        self._write(('10.0.0.1', 'p'))
+        _, clients = config.load_config(self.config_path)
+        self._write(('10.0.0.1', 'p'), ('10.0.0.2', 'p'))
+
+        schedule = scheduler.Scheduler()
+        new_clients, _ = server._reload_clients( # pylint: disable=protected-access
+            self.db, self.config_path, clients, schedule, {}, {}, sharded=True)
+        self.assertEqual(2, len(new_clients))
+        self.assertEqual(0, len(schedule))
+
+
+class RebalanceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = orm.connect('sqlite://')
+        self.clients = [{'ip': '10.0.0.%d' % i, 'port': 22, 'platform': 'Windows'}
+                        for i in range(1, 21)]
+        self.systems, self.last_event_record_ids = server._load_systems( # pylint: disable=protected-access
+            self.db, self.clients)
+
+    def _rebalance(self, shard, schedule, busy=(), retired=()):
+        with unittest.mock.patch('sys.stdout'):
+            return server._rebalance( # pylint: disable=protected-access
+                self.db, shard, self.clients, schedule, list(busy), list(retired),
+                self.systems, self.last_event_record_ids)
+
+    def test_owned_clients_are_scheduled(self):
+        first = sharding.Shard(self.db, 'first')
+        first_schedule = scheduler.Scheduler()
+        self.assertEqual([], self._rebalance(first, first_schedule))
+        self.assertEqual(20, len(first_schedule))
+
+        second = sharding.Shard(self.db, 'second')
+        second_schedule = scheduler.Scheduler()
+        self._rebalance(second, second_schedule)
+        self.assertEqual(0, len(second_schedule))
+
+        # the first worker gives up the clients of the second one
+        released = self._rebalance(first, first_schedule)
+        self.assertTrue(released)
+        self.assertEqual(20 - len(released), len(first_schedule))
+
+        # which picks up the events the first one has stored
+        self.last_event_record_ids[released[0]['ip']] = 0
+        system_id = self.systems[released[0]['ip']]
+        self.db.add(orm.EventWatermark(system_id=system_id, last_event_record_id=42))
+        self.db.commit()
+
+        self._rebalance(second, second_schedule)
+        self.assertEqual(len(released), len(second_schedule))
+        self.assertEqual(42, self.last_event_record_ids[released[0]['ip']])
+
+    def test_busy_clients_are_not_scheduled_twice(self):
+        first = sharding.Shard(self.db, 'first')
+        schedule = scheduler.Scheduler()
+        self._rebalance(first, schedule)
+        self._rebalance(sharding.Shard(self.db, 'second'), scheduler.Scheduler())
+        released = self._rebalance(first, schedule)
+
+        # the second worker goes away while a released client is still being polled
+        sharding.Shard(self.db, 'second').leave([])
+        changed = dict(released[0], password='old')
+        retired = self._rebalance(first, schedule, busy=released[:1],
+                                  retired=released + [changed])
+        self.assertEqual(19, len(schedule))
+        self.assertNotIn(released[0], schedule.clients())
+        # the released clients are owned again, only the one changed by a reload is closed
+        self.assertEqual([changed], retired)
+
+        # the client is scheduled once its poll is done
+        self._rebalance(first, schedule)
+        self.assertEqual(20, len(schedule))
+
+    def test_failures_are_reported(self):
+        shard = sharding.Shard(self.db, 'first')
+        schedule = scheduler.Scheduler()
+        with unittest.mock.patch.object(shard, 'assign', side_effect=RuntimeError('DB down')), \
+                unittest.mock.patch('sys.stderr') as stderr:
+            self.assertEqual([], self._rebalance(shard, schedule))
+        self.assertIn('DB down', str(stderr.write.call_args_list))
@@ -0,0 +1,105 @@
+import unittest
+
+import orm
+import sharding
+
+
+def _clients(count):
+    return [{'ip': '10.0.%d.%d' % (i // 250, i % 250 + 1), 'port': 22} for i in range(count)]
+
+
+def _ips(clients):
+    return set(client['ip'] for client in clients)
+
+
+class RendezvousOwnerTestCase(unittest.TestCase):
+    def test_only_the_hosts_of_a_leaving_worker_move(self):
+        hosts = ['10.0.0.%d' % i for i in range(200)]
+        before = dict((host, sharding.rendezvous_owner(host, ['a', 'b', 'c'])) for host in hosts)
+        after = dict((host, sharding.rendezvous_owner(host, ['a', 'c'])) for host in hosts)
+
+        # every worker gets a share
+        self.assertEqual(set(['a', 'b', 'c']), set(before.values()))
+        for host in hosts:
+            if before[host] != 'b':
+                self.assertEqual(before[host], after[host])
+            else:
+                self.assertIn(after[host], ['a', 'c'])
+
+    def test_independent_of_order(self):
+        self.assertEqual(sharding.rendezvous_owner('10.0.0.1', ['a', 'b', 'c']),
+                         sharding.rendezvous_owner('10.0.0.1', ['c', 'b', 'a']))
+
+
+class ShardTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = orm.connect('sqlite://')
+        self.clients = _clients(100)
+        self.first = sharding.Shard(self.db, 'first', lease_time=30)
+        self.second = sharding.Shard(self.db, 'second', lease_time=30)
+
+    def test_single_worker_polls_everything(self):
+        self.assertEqual(self.clients, self.first.assign(self.clients, now=1000))
+        self.assertTrue(self.first.holds(sharding.LEADER, 1000))
+        self.assertTrue(self.first.holds('10.0.0.1', 1029))
+        self.assertFalse(self.first.holds('10.0.0.1', 1030))
+
+    def test_workers_split_the_clients(self):
+        self.first.assign(self.clients, now=1000)
+        second = self.second.assign(self.clients, now=1001)
+        # the leases of the first worker haven't been released yet
+        self.assertEqual([], second)
+
+        first = self.first.assign(self.clients, now=1010)
+        second = self.second.assign(self.clients, now=1011)
+        self.assertTrue(first)
+        self.assertTrue(second)
+        self.assertEqual(set(), _ips(first) & _ips(second))
+        self.assertEqual(_ips(self.clients), _ips(first) | _ips(second))
+
+        # exactly one leader
+        self.assertNotEqual(self.first.holds(sharding.LEADER, 1011),
+                            self.second.holds(sharding.LEADER, 1011))
+
+        # and the split is stable
+        self.assertEqual(first, self.first.assign(self.clients, now=1020))
+        self.assertEqual(second, self.second.assign(self.clients, now=1021))
+
+    def test_clients_of_a_dead_worker_move_after_lease_time(self):
+        self.first.assign(self.clients, now=1000)
+        self.second.assign(self.clients, now=1001)
+        self.first.assign(self.clients, now=1010)
+        second = self.second.assign(self.clients, now=1011)
+
+        # the second worker dies, its leases expire 30 seconds later
+        self.assertEqual(len(self.clients) - len(second),
+                         len(self.first.assign(self.clients, now=1030)))
+        self.assertEqual(self.clients, self.first.assign(self.clients, now=1042))
+        self.assertTrue(self.first.holds(sharding.LEADER, 1042))
+
+    def test_busy_clients_are_kept_until_done(self):
+        self.first.assign(self.clients, now=1000)
+        self.second.assign(self.clients, now=1001)
+
+        moving = [client for client in self.clients
+                  if sharding.rendezvous_owner(client['ip'], ['first', 'second']) == 'second']
+        busy = moving[0]['ip']
+
+        first = self.first.assign(self.clients, [busy], now=1010)
+        # not polled again by the first worker but its lease is renewed
+        self.assertNotIn(busy, _ips(first))
+        self.assertTrue(self.first.holds(busy, 1030))
+        self.assertNotIn(busy, _ips(self.second.assign(self.clients, now=1011)))
+
+        self.first.assign(self.clients, now=1020)
+        self.assertIn(busy, _ips(self.second.assign(self.clients, now=1021)))
+
+    def test_leave_hands_over_immediately(self):
+        self.first.assign(self.clients, now=1000)
+        self.second.assign(self.clients, now=1001)
+        self.first.leave()
+
+        self.assertEqual(self.clients, self.second.assign(self.clients, now=1002))
+        self.assertFalse(self.first.holds('10.0.0.1', 1002))
+        self.assertEqual(['second'], [worker.name for worker in
+                                      self.db.query(orm.CollectorWorker)])
@@ -0,0 +1,203 @@
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+from datetime import datetime
+
+import orm
+import spool
+
+COLLECTED_AT = datetime(2017, 7, 1, 14, 26, 5, 774505)
+
+LINUX = {'system': 'Linux', 'cpu': 12.5, 'memory': 40.1, 'uptime': 3600}
+
+WINDOWS = {
+    'system': 'Windows',
+    'cpu': 50,
+    'memory': 60,
+    'uptime': 7200,
+    'security_event_logs': [{
+        'EventRecordID': record_id,
+        'TimeCreated': '2017-07-01T14:26:%02d.774505' % record_id,
+        'EventID': 4624,
+        'Computer': 'EC2AMAZ-BBN7IEM',
+        'EventData': '{}',
+    } for record_id in range(1, 4)],
+}
+
+
+class RecordTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        line = spool.encode_record(3, LINUX, COLLECTED_AT)
+        self.assertTrue(line.endswith(b'\n'))
+        self.assertEqual((3, LINUX, COLLECTED_AT), spool.decode_record(line))
+
+    def test_corrupted(self):
+        line = spool.encode_record(3, LINUX, COLLECTED_AT)
+        self.assertIsNone(spool.decode_record(line.replace(b'12.5', b'13.5')))
+        self.assertIsNone(spool.decode_record(b'garbage\n'))
+        self.assertIsNone(spool.decode_record(line[:20]))
+
+
+class SpoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='spool-')
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.seg'))
+
+    def test_invalid_fsync_policy(self):
+        with self.assertRaisesRegex(RuntimeError, 'Invalid spool fsync policy sometimes'):
+            spool.Spool(self.directory, fsync='sometimes')
+
+    def test_read_and_commit(self):
+        samples = spool.Spool(self.directory, segment_size=200)
+        for system_id in range(1, 11):
+            samples.append(system_id, LINUX, COLLECTED_AT)
+        self.assertTrue(len(self._segments()) > 2)
+
+        records, position = samples.read(4)
+        self.assertEqual([1, 2, 3, 4], [record[0] for record in records])
+        # not committed yet
+        self.assertEqual(records, samples.read(4)[0])
+
+        samples.commit(position)
+        records, position = samples.read()
+        self.assertEqual(list(range(5, 11)), [record[0] for record in records])
+        samples.commit(position)
+
+        self.assertEqual([], samples.read()[0])
+        # only the segment being written is left
+        self.assertEqual(1, len(self._segments()))
+
+    def test_replay_after_restart(self):
+        samples = spool.Spool(self.directory)
+        samples.append(1, LINUX, COLLECTED_AT)
+        samples.append(2, WINDOWS, COLLECTED_AT)
+        samples.commit(samples.read(1)[1])
+        samples.append(3, LINUX, COLLECTED_AT)
+        samples.close()
+
+        samples = spool.Spool(self.directory)
+        records, position = samples.read()
+        self.assertEqual([2, 3], [record[0] for record in records])
+        self.assertEqual(WINDOWS, records[0][1])
+        samples.commit(position)
+        samples.close()
+
+        self.assertEqual([], spool.Spool(self.directory).read()[0])
+
+    def test_torn_line_is_skipped(self):
+        samples = spool.Spool(self.directory)
+        samples.append(1, LINUX, COLLECTED_AT)
+        samples.close()
+
+        # a crash while a line was being written
+        with open(os.path.join(self.directory, self._segments()[-1]), 'ab') as segment:
+            segment.write(spool.encode_record(2, LINUX, COLLECTED_AT)[:30])
+
+        samples = spool.Spool(self.directory)
+        samples.append(3, LINUX, COLLECTED_AT)
+        self.assertEqual([1, 3], [record[0] for record in samples.read()[0]])
+        self.assertEqual(1, samples.corrupted)
+
+    def test_oldest_segments_are_dropped_when_full(self):
+        line_size = len(spool.encode_record(1, LINUX, COLLECTED_AT))
+        samples = spool.Spool(self.directory, segment_size=line_size * 2, max_size=line_size * 5)
+        with unittest.mock.patch('sys.stderr'):
+            for system_id in range(1, 11):
+                samples.append(system_id, LINUX, COLLECTED_AT)
+
+        self.assertTrue(samples.size() <= line_size * 5)
+        self.assertEqual(6, samples.dropped)
+        self.assertEqual([7, 8, 9, 10], [record[0] for record in samples.read()[0]])
+
+    def test_dropped_records_of_previous_run_are_counted(self):
+        line_size = len(spool.encode_record(1, LINUX, COLLECTED_AT))
+        samples = spool.Spool(self.directory, segment_size=line_size * 3)
+        for system_id in range(1, 4):
+            samples.append(system_id, LINUX, COLLECTED_AT)
+        samples.close()
+
+        samples = spool.Spool(self.directory, segment_size=line_size, max_size=line_size)
+        with unittest.mock.patch('sys.stderr'):
+            samples.append(4, LINUX, COLLECTED_AT)
+
+        self.assertEqual(3, samples.dropped)
+        self.assertEqual([4], [record[0] for record in samples.read()[0]])
+
+    @unittest.mock.patch('os.fsync')
+    def test_fsync_policies(self, fsync):
+        samples = spool.Spool(self.directory, fsync='always')
+        samples.append(1, LINUX, COLLECTED_AT)
+        samples.append(2, LINUX, COLLECTED_AT)
+        self.assertEqual(2, fsync.call_count)
+        samples.close()
+
+        fsync.reset_mock()
+        samples = spool.Spool(self.directory, fsync='interval', fsync_interval=3600)
+        samples.append(1, LINUX, COLLECTED_AT)
+        samples.append(2, LINUX, COLLECTED_AT)
+        self.assertEqual(0, fsync.call_count)
+        samples.close()
+        self.assertEqual(1, fsync.call_count)
+
+        fsync.reset_mock()
+        samples = spool.Spool(self.directory, fsync='never')
+        samples.append(1, LINUX, COLLECTED_AT)
+        samples.commit(samples.read()[1])
+        samples.close()
+        self.assertEqual(0, fsync.call_count)
+
+
+class SpoolFlusherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='spool-')
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        # the flusher uses its own connection which must see the same DB
+        self.db = orm.connect('sqlite:///%s' % os.path.join(self.directory, 'metrics.db'))
+        self.addCleanup(self.db.close)
+        self.system = orm.System(name='localhost')
+        self.db.add(self.system)
+        self.db.commit()
+
+        self.samples = spool.Spool(os.path.join(self.directory, 'spool'))
+
+    def test_flush(self):
+        self.samples.append(self.system.id, LINUX, COLLECTED_AT)
+        self.samples.append(self.system.id, WINDOWS, COLLECTED_AT)
+
+        flusher = spool.SpoolFlusher(self.samples, self.db, flush_size=1)
+        self.assertEqual(2, flusher.flush())
+        flusher.stop()
+
+        self.assertEqual([12.5, 50], [row.usage for row in self.db.query(orm.CpuUsage)])
+        self.assertEqual(3, self.db.query(orm.WinEventLog).count())
+        self.assertEqual([], self.samples.read()[0])
+
+    def test_failed_samples_stay_in_the_spool(self):
+        self.samples.append(self.system.id, WINDOWS, COLLECTED_AT)
+        flusher = spool.SpoolFlusher(self.samples, self.db)
+
+        with unittest.mock.patch('writer.MetricsWriter.flush', side_effect=RuntimeError('DB down')):
+            with self.assertRaisesRegex(RuntimeError, 'DB down'):
+                flusher.flush()
+        self.assertEqual(1, len(self.samples.read()[0]))
+
+        # the events were stored already and aren't duplicated
+        self.assertEqual(1, flusher.flush())
+        self.assertEqual(1, self.db.query(orm.CpuUsage).count())
+        self.assertEqual(3, self.db.query(orm.WinEventLog).count())
+        flusher.stop()
+
+    def test_background_thread_writes_on_stop(self):
+        flusher = spool.SpoolFlusher(self.samples, self.db, flush_age=3600)
+        flusher.start()
+        self.samples.append(self.system.id, LINUX, COLLECTED_AT)
+        flusher.stop()
+
+        self.assertEqual(1, flusher.written)
+        self.assertEqual(1, self.db.query(orm.CpuUsage).count())
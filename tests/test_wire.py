@@ -0,0 +1,73 @@
+import io
+import json
+import unittest
+import unittest.mock
+
+import agent
+import wire
+
+METRICS = {
+    'system': 'Windows',
+    'cpu': 12.5,
+    'memory': 40.1,
+    'uptime': 3600,
+    'security_event_logs': [
+        {'EventRecordID': i, 'EventData': {'SubjectUserName': 'SYSTEM', 'PrivilegeList': ['SeTcb']}}
+        for i in range(200)
+    ],
+}
+
+def _stream(response):
+    # agent.py output as read from the channel, print() adds a newline
+    return io.BytesIO((response + '\n').encode('utf8'))
+
+
+class DecodeTestCase(unittest.TestCase):
+    def test_plain_json(self):
+        metrics = {'system': 'Linux', 'cpu': 1, 'memory': 2, 'uptime': 3}
+        self.assertEqual(metrics, wire.decode(_stream(agent.encode_response(metrics))))
+
+    def test_compressed(self):
+        response = agent.encode_response(METRICS, 'zjson')
+        self.assertTrue(response.startswith('MC1 zlib\n'))
+        self.assertTrue(len(response) < len(agent.encode_response(METRICS)))
+
+        metrics = wire.decode(_stream(response))
+        self.assertEqual(12.5, metrics['cpu'])
+        self.assertEqual(200, len(metrics['security_event_logs']))
+
+        # EventData is converted back to a JSON string
+        event_data = metrics['security_event_logs'][0]['EventData']
+        self.assertEqual(METRICS['security_event_logs'][0]['EventData'], json.loads(event_data))
+
+    def test_compressed_in_small_chunks(self):
+        response = agent.encode_response(METRICS, 'zjson')
+        with unittest.mock.patch('wire._CHUNK_SIZE', 7):
+            metrics = wire.decode(_stream(response))
+        self.assertEqual(200, len(metrics['security_event_logs']))
+
+    def test_compressed_with_windows_line_endings(self):
+        response = agent.encode_response(METRICS, 'zjson').replace('\n', '\r\n')
+        self.assertEqual(200, len(wire.decode(_stream(response))['security_event_logs']))
+
+    def test_text_mode_readline(self):
+        # like the stdout of paramiko's exec_command(), readline() returns str
+        class _TextLines(io.BytesIO):
+            def readline(self, *args):
+                return io.BytesIO.readline(self, *args).decode('utf8')
+
+        metrics = {'system': 'Linux', 'cpu': 1, 'memory': 2, 'uptime': 3}
+        response = (agent.encode_response(metrics) + '\n').encode('utf8')
+        self.assertEqual(metrics, wire.decode(_TextLines(response)))
+
+        response = (agent.encode_response(METRICS, 'zjson') + '\n').encode('utf8')
+        self.assertEqual(200, len(wire.decode(_TextLines(response))['security_event_logs']))
+
+    def test_truncated_response(self):
+        response = agent.encode_response(METRICS, 'zjson')[:-20]
+        with self.assertRaisesRegex(ValueError, 'Truncated|Invalid'):
+            wire.decode(_stream(response))
+
+    def test_invalid_response(self):
+        with self.assertRaises(ValueError):
+            wire.decode(_stream('Traceback (most recent call last):'))
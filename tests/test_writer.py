@@ -0,0 +1,239 @@
+import unittest
+import unittest.mock
+from datetime import datetime
+
+import orm
+import writer
+
+class MetricsWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = orm.connect('sqlite://')
+        self.system = orm.System(name='localhost')
+        self.db.add(self.system)
+        self.db.commit()
+
+    def _add(self, metrics_writer, count):
+        for i in range(count):
+            metrics_writer.add(self.system.id, {'cpu': i, 'memory': 50, 'uptime': 100 + i},
+                               datetime(2017, 7, 1, 14, 26, i))
+
+    def test_flush_writes_all_tables(self):
+        metrics_writer = writer.MetricsWriter(self.db)
+        self._add(metrics_writer, 3)
+        self.assertEqual(0, self.db.query(orm.CpuUsage).count())
+
+        self.assertEqual(3, metrics_writer.flush())
+        self.assertEqual(0, len(metrics_writer))
+        self.assertEqual(3, self.db.query(orm.CpuUsage).count())
+        self.assertEqual(3, self.db.query(orm.MemUsage).count())
+        self.assertEqual(3, self.db.query(orm.Uptime).count())
+
+        uptime = self.db.query(orm.Uptime).order_by(orm.Uptime.uptime.desc()).first()
+        self.assertEqual(102, uptime.uptime)
+        self.assertEqual(self.system.id, uptime.system_id)
+
+    def test_flush_empty_buffer(self):
+        metrics_writer = writer.MetricsWriter(self.db)
+        self.assertFalse(metrics_writer.should_flush())
+        self.assertEqual(0, metrics_writer.flush())
+
+    def test_should_flush_by_size(self):
+        metrics_writer = writer.MetricsWriter(self.db, flush_size=3, flush_age=3600)
+        self._add(metrics_writer, 2)
+        self.assertFalse(metrics_writer.should_flush())
+        self._add(metrics_writer, 1)
+        self.assertTrue(metrics_writer.should_flush())
+
+    def test_should_flush_by_age(self):
+        metrics_writer = writer.MetricsWriter(self.db, flush_size=100, flush_age=10)
+        with unittest.mock.patch('time.time', return_value=1000):
+            self._add(metrics_writer, 1)
+
+        self.assertFalse(metrics_writer.should_flush(now=1005))
+        self.assertTrue(metrics_writer.should_flush(now=1010))
+
+    def test_failed_flush_keeps_samples(self):
+        metrics_writer = writer.MetricsWriter(self.db)
+        self._add(metrics_writer, 2)
+
+        with unittest.mock.patch.object(self.db, 'execute', side_effect=RuntimeError('DB is down')):
+            with self.assertRaises(RuntimeError):
+                metrics_writer.flush()
+
+        self.assertEqual(2, len(metrics_writer))
+        self.assertEqual(2, metrics_writer.flush())
+
+    def test_samples_are_dropped_after_repeated_failures(self):
+        metrics_writer = writer.MetricsWriter(self.db)
+        self._add(metrics_writer, 2)
+
+        with unittest.mock.patch.object(self.db, 'execute', side_effect=RuntimeError('DB is down')):
+            for _ in range(writer._MAX_FLUSH_ATTEMPTS): # pylint: disable=protected-access
+                with self.assertRaises(RuntimeError):
+                    metrics_writer.flush()
+
+        self.assertEqual(0, len(metrics_writer))
+        self.assertFalse(metrics_writer.should_flush())
+
+        # the next failure starts counting from zero
+        self._add(metrics_writer, 1)
+        with unittest.mock.patch.object(self.db, 'execute', side_effect=RuntimeError('DB is down')):
+            with self.assertRaises(RuntimeError):
+                metrics_writer.flush()
+        self.assertEqual(1, metrics_writer.flush())
+
+    def test_failed_flush_is_retried_later(self):
+        metrics_writer = writer.MetricsWriter(self.db, flush_size=1, flush_age=10)
+        self._add(metrics_writer, 2)
+
+        with unittest.mock.patch('time.time', return_value=1000), \
+                unittest.mock.patch.object(self.db, 'execute',
+                                           side_effect=RuntimeError('DB is down')):
+            with self.assertRaises(RuntimeError):
+                metrics_writer.flush()
+
+        # a short outage doesn't use up the attempts
+        self.assertFalse(metrics_writer.should_flush(now=1001))
+        self.assertFalse(metrics_writer.should_flush(now=1009))
+        self.assertTrue(metrics_writer.should_flush(now=1010))
+        self.assertEqual(2, metrics_writer.flush())
+        self.assertEqual(2, self.db.query(orm.CpuUsage).count())
+
+    def test_wide_layout_writes_samples(self):
+        metrics_writer = writer.MetricsWriter(self.db, layout='wide')
+        metrics_writer.add(self.system.id, {'cpu': 10, 'cpu_min': 5, 'cpu_max': 20,
+                                            'memory': 50, 'uptime': 100},
+                           datetime(2017, 7, 1, 14, 26, 0))
+        self._add(metrics_writer, 2)
+
+        self.assertEqual(3, metrics_writer.flush())
+        self.assertEqual(0, self.db.query(orm.CpuUsage).count())
+        self.assertEqual(3, self.db.query(orm.Sample).count())
+
+        sample = self.db.query(orm.Sample).filter_by(cpu_min=5).one()
+        self.assertEqual(20, sample.cpu_max)
+        self.assertEqual(50, sample.memory)
+        self.assertEqual(100, sample.uptime)
+        # agents which don't report min/max leave them empty
+        self.assertEqual(2, self.db.query(orm.Sample).filter(orm.Sample.cpu_max.is_(None)).count())
+
+
+def _event(event_record_id, time_created='2017-07-01T14:26:05.774505'):
+    return {
+        'EventID': 4672,
+        'Version': 0,
+        'Level': 0,
+        'Task': 12548,
+        'Opcode': 0,
+        'EventRecordID': event_record_id,
+        'ProcessID': 708,
+        'Keywords': '0x8020000000000000',
+        'Computer': 'EC2AMAZ-BBN7IEM',
+        'Security': None,
+        'Correlation': '{9675755E-F26F-0000-8275-75966FF2D201}',
+        'EventData': '{}',
+        'TimeCreated': time_created,
+    }
+
+
+class ParseTimeCreatedTestCase(unittest.TestCase):
+    def test_fast_path(self):
+        self.assertEqual(datetime(2017, 7, 1, 14, 26, 5, 774505),
+                         writer.parse_time_created('2017-07-01T14:26:05.774505'))
+
+    def test_fallback(self):
+        self.assertEqual(datetime(2017, 7, 1, 14, 26, 5, 774000),
+                         writer.parse_time_created('2017-07-01T14:26:05.774'))
+
+    def test_datetime_is_returned_as_is(self):
+        value = datetime(2017, 7, 1)
+        self.assertIs(value, writer.parse_time_created(value))
+
+
+class SaveEventLogsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = orm.connect('sqlite://')
+        self.system = orm.System(name='windows')
+        self.db.add(self.system)
+        self.db.commit()
+        self.now = datetime(2017, 7, 1, 15, 0, 0)
+
+    def test_saves_new_events(self):
+        events = [_event(1), _event(2)]
+        self.assertEqual(2, writer.save_event_logs(self.db, self.system.id, events, self.now))
+
+        event = self.db.query(orm.WinEventLog).filter_by(EventRecordID=2).one()
+        self.assertEqual(datetime(2017, 7, 1, 14, 26, 5, 774505), event.TimeCreated)
+        self.assertEqual(self.now, event.collected_at)
+        self.assertEqual(self.system.id, event.system_id)
+
+        # the agent response isn't modified
+        self.assertEqual('2017-07-01T14:26:05.774505', events[0]['TimeCreated'])
+
+    def test_skips_existing_and_duplicate_events(self):
+        writer.save_event_logs(self.db, self.system.id, [_event(1), _event(2)], self.now)
+
+        events = [_event(2), _event(3), _event(3), _event(2, '2017-07-02T00:00:00.000000')]
+        self.assertEqual(2, writer.save_event_logs(self.db, self.system.id, events, self.now))
+        self.assertEqual(4, self.db.query(orm.WinEventLog).count())
+
+    def test_same_event_of_other_system_is_saved(self):
+        other = orm.System(name='other')
+        self.db.add(other)
+        self.db.commit()
+
+        writer.save_event_logs(self.db, self.system.id, [_event(1)], self.now)
+        self.assertEqual(1, writer.save_event_logs(self.db, other.id, [_event(1)], self.now))
+
+    def test_large_batch(self):
+        events = [_event(i) for i in range(1, 1201)]
+        self.assertEqual(1200, writer.save_event_logs(self.db, self.system.id, events, self.now))
+        self.assertEqual(0, writer.save_event_logs(self.db, self.system.id, events, self.now))
+
+    def test_empty_batch(self):
+        self.assertEqual(0, writer.save_event_logs(self.db, self.system.id, [], self.now))
+
+    def test_updates_watermark(self):
+        writer.save_event_logs(self.db, self.system.id, [_event(5), _event(3)], self.now)
+        self.assertEqual({self.system.id: 5},
+                         writer.last_event_record_ids(self.db, [self.system.id]))
+
+        # older events don't move the watermark back
+        writer.save_event_logs(self.db, self.system.id, [_event(1)], self.now)
+        self.assertEqual({self.system.id: 5},
+                         writer.last_event_record_ids(self.db, [self.system.id]))
+        self.assertEqual(1, self.db.query(orm.EventWatermark).count())
+
+    def test_failed_insert_keeps_watermark(self):
+        writer.save_event_logs(self.db, self.system.id, [_event(1)], self.now)
+
+        with unittest.mock.patch('writer._insert_ignore', side_effect=RuntimeError('DB is down')):
+            with self.assertRaises(RuntimeError):
+                writer.save_event_logs(self.db, self.system.id, [_event(2)], self.now)
+
+        self.assertEqual({self.system.id: 1},
+                         writer.last_event_record_ids(self.db, [self.system.id]))
+
+
+class LastEventRecordIdsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = orm.connect('sqlite://')
+        self.system = orm.System(name='windows')
+        self.db.add(self.system)
+        self.db.commit()
+
+    def test_without_events(self):
+        self.assertEqual({self.system.id: 0},
+                         writer.last_event_record_ids(self.db, [self.system.id]))
+        self.assertEqual(0, self.db.query(orm.EventWatermark).count())
+
+    def test_creates_missing_watermark(self):
+        # stored before EventWatermark existed
+        for event_record_id in [7, 9, 8]:
+            self.db.add(orm.WinEventLog(system_id=self.system.id, EventRecordID=event_record_id,
+                                        collected_at=datetime(2017, 7, 1)))
+        self.db.commit()
+
+        self.assertEqual({self.system.id: 9},
+                         writer.last_event_record_ids(self.db, [self.system.id]))
+        self.assertEqual(9, self.db.query(orm.EventWatermark).one().last_event_record_id)